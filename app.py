@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import polars as pl
 import time
 import gspread
 import json
@@ -8,10 +9,23 @@ import pytz
 import uuid
 import numpy as np
 import gc
-from gspread_dataframe import set_with_dataframe, get_as_dataframe
+import threading
+import itertools
+import csv
+import io
+from gspread_dataframe import set_with_dataframe
+from pandas.io.parsers import TextParser
 from datetime import datetime
 from google.oauth2 import service_account
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from smart_filter import apply_smart_filter, apply_smart_filter_polars
+from sheets_api import (CircuitOpenError, reset_circuit_breaker, bind_run_context, safe_api_call, get_gspread_client,
+                        get_sh_with_retry, invalidate_sh_pool, get_wks_map, get_wks_with_retry, add_wks_pooled, quote_sheet_title,
+                        get_grid_size)
+from sheet_lock import lock_resource, acquire_leases, renew_lease, release_leases
+from sheet_writer import (SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, APPEND_SLICE_ROWS, union_columns, task_keys, iter_aligned_slices,
+                          AppendBatcher, get_rows_to_delete_dynamic, batch_delete_rows, report_write_results, write_diff_sync, write_atomic_sync)
 from st_copy_to_clipboard import st_copy_to_clipboard
 
 # ==========================================
@@ -31,7 +45,6 @@ BOT_EMAIL_DISPLAY = "getdulieu@kin-kin-477902.iam.gserviceaccount.com"
 SHEET_CONFIG_NAME = "luu_cau_hinh" 
 SHEET_LOG_NAME = "log_lanthucthi"
 SHEET_ACTIVITY_NAME = "log_hanh_vi"
-SHEET_LOCK_NAME = "sys_lock"
 SHEET_SYS_CONFIG = "sys_config"
 SHEET_NOTE_NAME = "database_ghi_chu"
 
@@ -65,7 +78,6 @@ REQUIRED_COLS_SCHED = [SCHED_COL_BLOCK, SCHED_COL_TYPE, SCHED_COL_VAL1, SCHED_CO
 NOTE_COL_ID = "ID"; NOTE_COL_BLOCK = "Tên Khối"; NOTE_COL_CONTENT = "Nội dung Note"
 REQUIRED_COLS_NOTE = [NOTE_COL_ID, NOTE_COL_BLOCK, NOTE_COL_CONTENT]
 
-SYS_COL_LINK = "Link file nguồn"; SYS_COL_SHEET = "Sheet nguồn"; SYS_COL_MONTH = "Tháng"
 DEFAULT_BLOCK_NAME = "Block_Mac_Dinh"
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
@@ -73,6 +85,40 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapi
 LOG_BUFFER_SIZE = 5 
 LOG_FLUSH_INTERVAL = 10 
 
+# Chế độ ghi đích: "replace" = xóa hết dòng cùng key rồi ghi lại, "diff" = chỉ ghi dòng thay đổi (so hash),
+# "atomic" = như replace nhưng dữ liệu mới ghi trước xuống dưới, header + xóa dòng cũ trong 1 batchUpdate (đích hoặc toàn cũ, hoặc toàn mới)
+WRITE_SYNC_MODE = "replace"
+
+# Số luồng tải nguồn song song cho mỗi nhóm đích
+FETCH_MAX_WORKERS = 4
+
+# Tab nguồn có nhiều dòng hơn ngưỡng này (theo lưới sheet) được đọc theo trang STREAM_PAGE_ROWS dòng
+# và biến đổi/ghi từng trang -> bộ nhớ tối đa ~ 1 trang thay vì cả tab
+STREAM_PAGE_ROWS = 50000
+
+# Engine biến đổi dữ liệu nguồn: "pandas" (mặc định) hoặc "polars" (lazy, đa luồng) - chọn được mỗi lần chạy
+ETL_ENGINE = "pandas"
+NULL_LIKE_VALUES = ['nan', 'None', '<NA>', 'null']
+
+# Snapshot các tab điều khiển trên Sheet Master: đọc gộp 1 values:batchGet, dùng chung mọi session trong TTL (giây)
+MASTER_SNAPSHOT_TTL = 30
+MASTER_PREFETCH_TABS = [SHEET_SYS_CONFIG, SHEET_NOTE_NAME]  # luu_cau_hinh chỉ đọc khi cần, log đọc đuôi riêng, sys_lock luôn đọc mới
+MASTER_VALUE_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}  # như get_as_dataframe
+
+# Log: chỉ đọc N dòng cuối; lọc theo user/block chạy phía server bằng Google Visualization Query
+GVIZ_URL = "https://docs.google.com/spreadsheets/d/{}/gviz/tq"
+LOG_FILTER_SCAN_ROWS = 2000   # gviz lỗi -> lọc phía client trên ngần này dòng cuối
+LOG_ACT_COL_USER = "B"        # log_hanh_vi: Thời gian | Người dùng | Hành vi | Trạng thái
+LOG_RUN_COL_USER = "D"        # log_lanthucthi: ... | User (D) | ... | Block (L)
+LOG_RUN_COL_BLOCK = "L"
+
+# Log xoay vòng theo tháng: ghi vào tab <log>_YYYY_MM của tháng hiện tại; khi sang tháng mới, tab cũ hơn
+# LOG_RETENTION_MONTHS tháng được chép sang file secrets log_archive_sheet_id (nếu có) rồi xóa khỏi Sheet Master
+LOG_PARTITION_FMT = "%Y_%m"
+LOG_RETENTION_MONTHS = 6
+LOG_RUN_HEADER = ["Thời gian", "Vùng lấy", "Tháng", "User", "Link Nguồn", "Link Đích", "Sheet Đích", "Sheet Nguồn", "Kết Quả", "Số Dòng", "Range", "Block"]
+LOG_ACT_HEADER = ["Thời gian", "Người dùng", "Hành vi", "Trạng thái"]
+
 # ==========================================
 # 2. AUTHENTICATION & UTILS (SAFE API)
 # ==========================================
@@ -85,26 +131,6 @@ def get_creds():
     if "private_key" in creds_info: creds_info["private_key"] = creds_info["private_key"].replace("\\n", "\n")
     return service_account.Credentials.from_service_account_info(creds_info, scopes=SCOPES)
 
-def safe_api_call(func, *args, **kwargs):
-    """Bọc API Call để chống lỗi 429 Quota Exceeded"""
-    max_retries = 5
-    for i in range(max_retries):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            error_str = str(e).lower()
-            if "429" in error_str or "quota" in error_str:
-                wait_time = (2 ** i) + 5 
-                print(f"⚠️ Quota exceeded. Waiting {wait_time}s...")
-                time.sleep(wait_time)
-            elif i == max_retries - 1: raise e
-            else: time.sleep(2)
-    return None
-
-def get_sh_with_retry(creds, sheet_id_or_key):
-    gc = gspread.authorize(creds)
-    return safe_api_call(gc.open_by_key, sheet_id_or_key)
-
 def col_name_to_index(col_name):
     col_name = col_name.upper()
     index = 0
@@ -124,93 +150,77 @@ def ensure_sheet_headers(wks, required_columns):
         if not current_headers: wks.append_row(required_columns)
     except: pass
 
-# --- [V77] SMART FILTER ENGINE (MULTI CONDITION ; & DATE) ---
-def apply_smart_filter_v77(df, filter_str):
-    # 1. Kiểm tra rỗng
-    if not filter_str or str(filter_str).strip().lower() in ['nan', 'none', 'null', '']:
-        return df, None
+# --- SMART FILTER: xem smart_filter.py (dùng chung với auto_job.py) ---
 
-    # 2. Tách điều kiện bằng dấu CHẤM PHẨY (;)
-    conditions = str(filter_str).split(';')
-    
-    current_df = df.copy()
-    
-    for cond in conditions:
-        fs = cond.strip()
-        if not fs: continue 
-        
-        # Danh sách toán tử
-        operators = [" contains ", "==", "!=", ">=", "<=", ">", "<", "="]
-        selected_op = None
-        for op in operators:
-            if op in fs: selected_op = op; break
-                
-        if not selected_op: 
-            return None, f"Lỗi cú pháp: Không tìm thấy toán tử trong '{fs}'"
-
-        parts = fs.split(selected_op, 1)
-        user_col = parts[0].strip().replace("`", "").replace("'", "").replace('"', "")
-        
-        # Tìm cột
-        real_col_name = None
-        if user_col in current_df.columns: 
-            real_col_name = user_col
-        else:
-            for col in current_df.columns:
-                if str(col).strip() == user_col: real_col_name = col; break
-        
-        if not real_col_name: 
-            return None, f"Không tìm thấy cột '{user_col}'"
-
-        # Xử lý giá trị người dùng nhập
-        user_val = parts[1].strip()
-        if (user_val.startswith("'") and user_val.endswith("'")) or (user_val.startswith('"') and user_val.endswith('"')):
-            clean_val = user_val[1:-1]
-        else:
-            clean_val = user_val
-
-        # --- THỰC THI LỌC ---
+# --- LOGGING SYSTEM ---
+def log_partition_title(base, now):
+    return f"{base}_{now.strftime(LOG_PARTITION_FMT)}"
+
+def log_partition_month(base, title):
+    """Tab phân vùng của base -> số tháng (năm*12 + tháng) để so sánh; tab khác (kể cả tab log cũ chưa chia) -> None"""
+    m = re.fullmatch(re.escape(base) + r"_(\d{4})_(\d{2})", title)
+    return int(m.group(1)) * 12 + int(m.group(2)) if m else None
+
+def log_read_titles(sh, base):
+    """Các tab log của base, mới nhất trước; tab log cũ chưa chia (nếu còn) đọc sau cùng"""
+    wks_map = get_wks_map(sh)
+    parts = sorted((t for t in wks_map if log_partition_month(base, t) is not None), key=lambda t: log_partition_month(base, t), reverse=True)
+    return parts + ([base] if base in wks_map else [])
+
+# Lỗi API/mạng khi lưu trữ log: ghi vào tab log hoạt động, không làm hỏng lần ghi log đang chạy
+LOG_ARCHIVE_ERRORS = (gspread.exceptions.GSpreadException, CircuitOpenError, OSError)
+
+def archive_log_partitions(creds, sh, base, now):
+    """Phân vùng cũ hơn LOG_RETENTION_MONTHS: chép sang file lưu trữ (nếu cấu hình) rồi xóa khỏi Sheet Master.
+    Tab đã có trong file lưu trữ (lần trước chép xong nhưng chưa xóa) thì không chép lại; đổi tên bản chép lỗi thì
+    xóa bản "Copy of ..." vừa tạo và giữ tab gốc cho lần sau. Trả về các dòng log hoạt động của phân vùng bị lỗi."""
+    keep_from = now.year * 12 + now.month - LOG_RETENTION_MONTHS + 1
+    archive_id = st.secrets["gcp_service_account"].get("log_archive_sheet_id", "")
+    stamp = now.strftime("%d/%m/%Y %H:%M:%S")
+    errors, arch, arch_titles = [], None, set()
+    wks_map = get_wks_map(sh)
+    for title, wks in list(wks_map.items()):
+        month = log_partition_month(base, title)
+        if month is None or month >= keep_from: continue
         try:
-            col_series = current_df[real_col_name]
-            col_str = col_series.astype(str)
-
-            if selected_op == " contains ":
-                current_df = current_df[col_str.str.contains(clean_val, case=False, na=False)]
-            
-            elif selected_op in ["=", "=="]:
-                current_df = current_df[col_str == str(clean_val)]
-                
-            elif selected_op == "!=":
-                current_df = current_df[col_str != str(clean_val)]
-                
-            else:
-                # So sánh Lớn/Bé (Số hoặc Ngày tháng dạng chuỗi)
-                is_numeric = False
-                try:
-                    numeric_col = pd.to_numeric(col_series, errors='raise')
-                    numeric_val = float(clean_val)
-                    is_numeric = True
-                except: 
-                    is_numeric = False
-
-                if is_numeric:
-                    if selected_op == ">": current_df = current_df[numeric_col > numeric_val]
-                    if selected_op == "<": current_df = current_df[numeric_col < numeric_val]
-                    if selected_op == ">=": current_df = current_df[numeric_col >= numeric_val]
-                    if selected_op == "<=": current_df = current_df[numeric_col <= numeric_val]
-                else:
-                    # So sánh chuỗi (Date)
-                    if selected_op == ">": current_df = current_df[col_str > str(clean_val)]
-                    if selected_op == "<": current_df = current_df[col_str < str(clean_val)]
-                    if selected_op == ">=": current_df = current_df[col_str >= str(clean_val)]
-                    if selected_op == "<=": current_df = current_df[col_str <= str(clean_val)]
-                
-        except Exception as e:
-            return None, f"Lỗi xử lý điều kiện '{fs}': {str(e)}"
-
-    return current_df, None
+            if archive_id:
+                if arch is None:
+                    arch = get_sh_with_retry(creds, archive_id)
+                    if arch is None: raise gspread.SpreadsheetNotFound(archive_id)
+                    arch_titles = {w.title for w in safe_api_call(arch.worksheets)}
+                if title not in arch_titles:
+                    copied = safe_api_call(wks.copy_to, archive_id)
+                    try:
+                        safe_api_call(arch.batch_update, {"requests": [{"updateSheetProperties": {
+                            "properties": {"sheetId": copied["sheetId"], "title": title}, "fields": "title"}}]})
+                    except LOG_ARCHIVE_ERRORS:
+                        try: safe_api_call(arch.batch_update, {"requests": [{"deleteSheet": {"sheetId": copied["sheetId"]}}]})
+                        except LOG_ARCHIVE_ERRORS as e:
+                            errors.append([stamp, "SYSTEM", "Lưu trữ log lỗi", f"{title}: không xóa được bản chép thừa {copied.get('title', '')}: {str(e)[:200]}"])
+                        raise
+                    arch_titles.add(title)
+            safe_api_call(sh.del_worksheet, wks)
+            wks_map.pop(title, None)
+        except LOG_ARCHIVE_ERRORS as e:
+            errors.append([stamp, "SYSTEM", "Lưu trữ log lỗi", f"{title}: {str(e)[:200]}"])
+    return errors
+
+def get_log_partition(creds, sh, base, header):
+    """Tab log của tháng hiện tại (tạo + xoay vòng khi sang tháng mới). Chỉ tra tên trong pool metadata, không đọc tab cũ"""
+    now = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
+    title = log_partition_title(base, now)
+    try: return get_wks_with_retry(sh, title)
+    except gspread.WorksheetNotFound: pass
+    wks = add_wks_pooled(sh, title, rows=1000, cols=len(header))
+    safe_api_call(wks.update, range_name="A1", values=[header])
+    errors = archive_log_partitions(creds, sh, base, now)
+    if errors:
+        try:
+            act = wks if base == SHEET_ACTIVITY_NAME else get_log_partition(creds, sh, SHEET_ACTIVITY_NAME, LOG_ACT_HEADER)
+            safe_api_call(act.append_rows, errors)
+        except LOG_ARCHIVE_ERRORS as e: st.toast(f"⚠️ Không ghi được log lưu trữ: {str(e)[:100]}")
+    return wks
 
-# --- LOGGING SYSTEM ---
 def init_log_buffer():
     if 'log_buffer' not in st.session_state: st.session_state['log_buffer'] = []
     if 'last_log_flush' not in st.session_state: st.session_state['last_log_flush'] = time.time()
@@ -221,11 +231,9 @@ def flush_logs(creds, force=False):
     if (force or len(buffer) >= LOG_BUFFER_SIZE or (time.time() - last_flush > LOG_FLUSH_INTERVAL)) and buffer:
         try:
             sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-            try: wks = sh.worksheet(SHEET_ACTIVITY_NAME)
-            except: 
-                wks = sh.add_worksheet(SHEET_ACTIVITY_NAME, rows=1000, cols=4)
-                wks.append_row(["Thời gian", "Người dùng", "Hành vi", "Trạng thái"])
+            wks = get_log_partition(creds, sh, SHEET_ACTIVITY_NAME, LOG_ACT_HEADER)
             safe_api_call(wks.append_rows, buffer)
+            invalidate_master_snapshot(SHEET_ACTIVITY_NAME)
             st.session_state['log_buffer'] = []
             st.session_state['last_log_flush'] = time.time()
         except: pass
@@ -278,46 +286,160 @@ def check_login():
 # ==========================================
 # 3. SYSTEM MANAGERS
 # ==========================================
-def get_system_lock_status(creds):
-    try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        try: wks = sh.worksheet(SHEET_LOCK_NAME)
-        except: wks = sh.add_worksheet(SHEET_LOCK_NAME, rows=10, cols=5); wks.update([["is_locked", "user", "time_start"], ["FALSE", "", ""]]); return False, "", ""
-        val = wks.cell(2, 1).value; user = wks.cell(2, 2).value; time_str = wks.cell(2, 3).value
-        if val == "TRUE":
-            try:
-                if (datetime.now() - datetime.strptime(time_str, "%d/%m/%Y %H:%M:%S")).total_seconds() > 300: return False, "", ""
-            except: pass
-            return True, user, time_str
-        return False, "", ""
-    except: return False, "", ""
-
-def acquire_lock(creds, user_id):
-    is_locked, locking_user, t = get_system_lock_status(creds)
-    if is_locked and locking_user != user_id: return False
+# --- SNAPSHOT SHEET MASTER (DÙNG CHUNG GIỮA CÁC SESSION) ---
+@st.cache_resource
+def get_master_snapshot_store():
+    """Cache toàn process {title: (values, ts)}; gen[title] tăng mỗi lần invalidate (bỏ kết quả đọc đã cũ đang bay)"""
+    return {"lock": threading.Lock(), "tabs": {}, "gen": defaultdict(int)}
+
+def invalidate_master_snapshot(*titles):
+    """App vừa ghi vào tab nào thì gọi với tab đó; không truyền -> bỏ toàn bộ"""
+    store = get_master_snapshot_store()
+    with store["lock"]:
+        for key in list(store["tabs"]):
+            title = key[1] if isinstance(key, tuple) else key  # ("tail", title, ...) = đuôi log đã lọc/cắt
+            if not titles or title in titles: store["tabs"].pop(key, None)
+        for t in (titles or list(store["gen"])): store["gen"][t] += 1
+
+def get_master_values(creds, titles, fresh=False):
+    """Giá trị các tab Sheet Master {title: values | None nếu tab chưa có}. Tab hết TTL được đọc lại cùng các tab
+    MASTER_PREFETCH_TABS đã cũ trong 1 values:batchGet -> 1 lượt rerun chỉ tốn tối đa 1 request đọc.
+    Cùng valueRenderOption với get_as_dataframe(evaluate_formulas=True)."""
+    store = get_master_snapshot_store()
+    now = time.time()
+    with store["lock"]:
+        cached = {t: ent[0] for t, ent in store["tabs"].items() if now - ent[1] < MASTER_SNAPSHOT_TTL}
+        if fresh:
+            for t in titles: cached.pop(t, None)
+        if all(t in cached for t in titles): return {t: cached[t] for t in titles}
+        gens = dict(store["gen"])
+    sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
+    wks_map = get_wks_map(sh)
+    if any(t not in wks_map for t in titles): wks_map = get_wks_map(sh, refresh=True)
+    stale = [t for t in dict.fromkeys(list(titles) + MASTER_PREFETCH_TABS) if t not in cached and t in wks_map]
+    fetched = {}
+    if stale:
+        resp = safe_api_call(sh.values_batch_get, [quote_sheet_title(t) for t in stale],
+                             params=MASTER_VALUE_PARAMS)
+        fetched = {t: vr.get("values", []) for t, vr in zip(stale, resp.get("valueRanges", []))}
+        ts = time.time()
+        with store["lock"]:
+            for t, values in fetched.items():
+                if store["gen"][t] == gens.get(t, 0): store["tabs"][t] = (values, ts)
+    return {t: fetched[t] if t in fetched else cached.get(t) for t in titles}
+
+def values_to_dataframe(values):
+    """Giá trị 1 tab -> DataFrame giống get_as_dataframe(dtype=str): dòng 1 là header, bỏ dòng trống + cột trống không tên"""
+    if not values: return pd.DataFrame()
+    width = max(len(r) for r in values) + 1  # thêm 1 cột trống như lưới thật (dòng toàn ô trống không bị coi là dòng bỏ qua)
+    df = TextParser([list(r) + [""] * (width - len(r)) for r in values], dtype=str).read().dropna(how='all')
+    unnamed = [c for c in df.columns if re.match(r'^Unnamed:\s\d+$', str(c)) and df[c].isna().all()]
+    return df.drop(columns=unnamed) if unnamed else df
+
+# --- ĐỌC ĐUÔI LOG (KHÔNG TẢI CẢ TAB) ---
+def column_letter(col):
+    return re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, col))
+
+def read_log_tail(sh, wks, limit):
+    """(header, limit dòng cuối) của tab log. 1 values:batchGet: header + cửa sổ cuối lưới, để hở cuối nên lưới vừa
+    nở thêm (metadata trong pool cũ) vẫn đọc đủ. Lưới còn trống phía dưới dữ liệu -> tìm dòng cuối thật rồi đọc đoạn thiếu."""
+    q = quote_sheet_title(wks.title); last_col = column_letter(max(1, wks.col_count))
+    start = max(2, wks.row_count - limit + 1)
+    resp = safe_api_call(sh.values_batch_get, [f"{q}!A1:{last_col}1", f"{q}!A{start}:{last_col}"], params=MASTER_VALUE_PARAMS)
+    vr = [v.get("values", []) for v in resp.get("valueRanges", [])] + [[], []]
+    header, rows = (vr[0][0] if vr[0] else []), vr[1]
+    if len(rows) < limit and start > 2:
+        if rows: end = start - 1  # dữ liệu kết thúc trong cửa sổ -> chỉ thiếu đoạn ngay phía trên
+        else: end = len(safe_api_call(sh.values_get, f"{q}!A1:A{start - 1}", params=MASTER_VALUE_PARAMS).get("values", []))
+        begin = max(2, end - (limit - len(rows)) + 1)
+        if end >= begin:
+            more = safe_api_call(sh.values_get, f"{q}!A{begin}:{last_col}{end}", params=MASTER_VALUE_PARAMS).get("values", [])
+            rows = more + [[]] * (end - begin + 1 - len(more)) + rows
+    return header, rows[-limit:]
+
+def gviz_query(creds, sheet_id, title, query):
+    """Google Visualization Query trên 1 tab (lọc/cắt phía server). Trả về các dòng CSV, dòng đầu là nhãn cột"""
+    resp = safe_api_call(get_gspread_client(creds).http_client.request, "get", GVIZ_URL.format(sheet_id),
+                         params={"sheet": title, "tq": query, "tqx": "out:csv", "headers": 1})
+    return list(csv.reader(io.StringIO(resp.content.decode("utf-8"))))
+
+def read_log_tail_filtered(creds, sh, wks, limit, col, value):
+    """(header, limit dòng cuối có cột `col` (chữ cái) == value): đếm rồi lấy đúng đoạn cuối bằng limit/offset phía server,
+    2 request nhỏ dù tab lớn cỡ nào. gviz lỗi -> lọc phía client trên LOG_FILTER_SCAN_ROWS dòng cuối."""
+    val = str(value)
     try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        wks = sh.worksheet(SHEET_LOCK_NAME)
-        now_str = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        wks.update("A2:C2", [["TRUE", user_id, now_str]])
-        return True
-    except: return False
+        if "'" in val and '"' in val: raise ValueError("giá trị lọc chứa cả ' và \"")
+        cond = f"where {col} = " + (f'"{val}"' if "'" in val else f"'{val}'")
+        counted = gviz_query(creds, sh.id, wks.title, f"select count(A) {cond}")
+        total = int(float(counted[1][0])) if len(counted) > 1 and counted[1] else 0
+        out = gviz_query(creds, sh.id, wks.title, f"select * {cond} limit {limit} offset {max(0, total - limit)}")
+        return (out[0] if out else []), out[1:]
+    except Exception:
+        header, rows = read_log_tail(sh, wks, LOG_FILTER_SCAN_ROWS)
+        idx = col_name_to_index(col)
+        return header, [r for r in rows if len(r) > idx and str(r[idx]) == val][-limit:]
+
+def get_log_tail(creds, title, limit, filter_col=None, filter_val=None):
+    """DataFrame limit dòng log mới nhất (mới nhất lên đầu), đọc phân vùng mới nhất trước, chỉ lùi sang tháng trước khi chưa đủ.
+    Cache chung trong snapshot Sheet Master (TTL + invalidate theo tab log gốc)"""
+    store = get_master_snapshot_store()
+    key = ("tail", title, limit, filter_col, filter_val if filter_col else None)
+    with store["lock"]:
+        ent = store["tabs"].get(key); gen = store["gen"][title]
+        if ent and time.time() - ent[1] < MASTER_SNAPSHOT_TTL: return ent[0]
+    sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
+    header, rows = [], []
+    for part in log_read_titles(sh, title):
+        wks = get_wks_with_retry(sh, part)
+        if filter_col: h, r = read_log_tail_filtered(creds, sh, wks, limit - len(rows), filter_col, filter_val)
+        else: h, r = read_log_tail(sh, wks, limit - len(rows))
+        header = header or h; rows = r + rows
+        if len(rows) >= limit: break
+    df = values_to_dataframe([header] + rows) if header else pd.DataFrame()
+    if not df.empty: df = df.tail(limit).iloc[::-1]
+    with store["lock"]:
+        if store["gen"][title] == gen: store["tabs"][key] = (df, time.time())
+    return df
 
-def release_lock(creds, user_id):
-    try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        wks = sh.worksheet(SHEET_LOCK_NAME)
-        val = wks.cell(2, 2).value
-        if val == user_id: wks.update("A2:C2", [["FALSE", "", ""]])
-    except: pass
+# --- KHÓA THUÊ (LEASE) THEO ĐÍCH ---
+# Giao thức sys_lock nằm ở sheet_lock.py (dùng chung với auto_job.py); app giữ khóa trên Sheet Master của lịch sử
+def get_lock_sh(creds):
+    return get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
+
+def acquire_lock(creds, user_id, resources):
+    """Lấy lease trên các resource (lock_resource của đích / tab), tất cả hoặc không. Trả về lease hoặc None (đang bận / lỗi)"""
+    if not resources: return acquire_leases(None, user_id, [])
+    try: sh = get_lock_sh(creds)
+    except Exception as e:
+        print(f"⚠️ Không lấy được khóa: {e}"); return None
+    lease = acquire_leases(sh, user_id, resources, all_or_none=True)
+    return lease if lease["resources"] else None
+
+def renew_lock(creds, lease):
+    """Fencing trước mỗi lần ghi: còn giữ lease (gia hạn khi đã qua nửa thời hạn)? False = đã mất khóa, không được ghi"""
+    if not lease: return False
+    try: sh = get_lock_sh(creds)
+    except Exception as e:
+        print(f"⚠️ Không gia hạn được khóa: {e}"); return False
+    return renew_lease(sh, lease)
+
+def release_lock(creds, lease):
+    if not lease or not lease["resources"]: return
+    try: sh = get_lock_sh(creds)
+    except Exception as e:
+        print(f"⚠️ Không trả được khóa: {e}"); return
+    release_leases(sh, lease)
 
 def load_notes_data(creds):
     try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        try: wks = sh.worksheet(SHEET_NOTE_NAME)
-        except: wks = sh.add_worksheet(SHEET_NOTE_NAME, rows=100, cols=5); ensure_sheet_headers(wks, REQUIRED_COLS_NOTE)
-        ensure_sheet_headers(wks, REQUIRED_COLS_NOTE)
-        df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
+        values = get_master_values(creds, [SHEET_NOTE_NAME])[SHEET_NOTE_NAME]
+        if not values:
+            sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
+            if values is None: wks = add_wks_pooled(sh, SHEET_NOTE_NAME, rows=100, cols=5)
+            else: wks = get_wks_with_retry(sh, SHEET_NOTE_NAME)
+            wks.append_row(REQUIRED_COLS_NOTE); invalidate_master_snapshot(SHEET_NOTE_NAME)
+            return pd.DataFrame(columns=REQUIRED_COLS_NOTE)
+        df = values_to_dataframe(values)
         if df.empty: return pd.DataFrame(columns=REQUIRED_COLS_NOTE)
         return df.dropna(how='all')
     except: return pd.DataFrame(columns=REQUIRED_COLS_NOTE)
@@ -325,11 +447,12 @@ def load_notes_data(creds):
 def save_notes_data(df_notes, creds, user_id, block_name):
     try:
         sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        wks = sh.worksheet(SHEET_NOTE_NAME)
+        wks = get_wks_with_retry(sh, SHEET_NOTE_NAME)
         if not df_notes.empty:
             for idx, row in df_notes.iterrows():
                 if not row[NOTE_COL_ID]: df_notes.at[idx, NOTE_COL_ID] = str(uuid.uuid4())[:8]
         set_with_dataframe(wks, df_notes, row=1, col=1)
+        invalidate_master_snapshot(SHEET_NOTE_NAME)
         log_user_action_buffered(creds, user_id, "Lưu Ghi Chú", f"Cập nhật note cho {block_name}", force_flush=True)
         return True
     except: return False
@@ -353,13 +476,14 @@ def show_note_popup(creds, all_blocks, user_id):
 
 def load_scheduler_config(creds):
     try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        try: wks = sh.worksheet(SHEET_SYS_CONFIG)
-        except: 
-            wks = sh.add_worksheet(SHEET_SYS_CONFIG, rows=50, cols=5)
-            wks.append_row(REQUIRED_COLS_SCHED)
-        ensure_sheet_headers(wks, REQUIRED_COLS_SCHED)
-        df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
+        values = get_master_values(creds, [SHEET_SYS_CONFIG])[SHEET_SYS_CONFIG]
+        if not values:
+            sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
+            if values is None: wks = add_wks_pooled(sh, SHEET_SYS_CONFIG, rows=50, cols=5)
+            else: wks = get_wks_with_retry(sh, SHEET_SYS_CONFIG)
+            wks.append_row(REQUIRED_COLS_SCHED); invalidate_master_snapshot(SHEET_SYS_CONFIG)
+            return pd.DataFrame(columns=REQUIRED_COLS_SCHED)
+        df = values_to_dataframe(values)
         if SCHED_COL_BLOCK not in df.columns: return pd.DataFrame(columns=REQUIRED_COLS_SCHED)
         return df.dropna(how='all')
     except: return pd.DataFrame(columns=REQUIRED_COLS_SCHED)
@@ -367,56 +491,145 @@ def load_scheduler_config(creds):
 def save_scheduler_config(df_sched, creds, user_id, type_run, v1, v2):
     try:
         sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        wks = sh.worksheet(SHEET_SYS_CONFIG)
+        wks = get_wks_with_retry(sh, SHEET_SYS_CONFIG)
         cols = REQUIRED_COLS_SCHED
         for c in cols:
             if c not in df_sched.columns: df_sched[c] = ""
         wks.clear(); set_with_dataframe(wks, df_sched[cols].fillna(""), row=1, col=1)
+        invalidate_master_snapshot(SHEET_SYS_CONFIG)
         msg = f"Cài đặt: {type_run} | {v1} {v2}".strip()
         log_user_action_buffered(creds, user_id, "Cài Lịch Chạy", msg, force_flush=True)
         return True
     except: return False
 
-def fetch_activity_logs(creds, limit=50):
-    try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        wks = sh.worksheet(SHEET_ACTIVITY_NAME)
-        df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
-        if df.empty: return pd.DataFrame()
-        return df.tail(limit).iloc[::-1]
+def fetch_activity_logs(creds, limit=50, user=None):
+    try: return get_log_tail(creds, SHEET_ACTIVITY_NAME, limit, LOG_ACT_COL_USER if user else None, user)
+    except: return pd.DataFrame()
+
+def fetch_run_logs(creds, limit=50, block=None):
+    try: return get_log_tail(creds, SHEET_LOG_NAME, limit, LOG_RUN_COL_BLOCK if block else None, block)
     except: return pd.DataFrame()
 
 def write_detailed_log(creds, log_data_list):
     if not log_data_list: return
     try:
         sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        try: wks = sh.worksheet(SHEET_LOG_NAME)
-        except: 
-            wks = sh.add_worksheet(SHEET_LOG_NAME, rows=1000, cols=15)
-            wks.append_row(["Thời gian", "Vùng lấy", "Tháng", "User", "Link Nguồn", "Link Đích", "Sheet Đích", "Sheet Nguồn", "Kết Quả", "Số Dòng", "Range", "Block"])
-        
+        wks = get_log_partition(creds, sh, SHEET_LOG_NAME, LOG_RUN_HEADER)
         cleaned_list = []
         for row in log_data_list:
             cleaned_list.append([str(x) for x in row])
             
         safe_api_call(wks.append_rows, cleaned_list)
+        invalidate_master_snapshot(SHEET_LOG_NAME)
     except Exception as e:
         st.warning(f"Lỗi ghi log (V78): {str(e)}")
 
 # ==========================================
 # 4. CORE ETL
 # ==========================================
-def fetch_data_v4(row_config, creds, target_headers=None):
+def make_unique_headers(header_row):
+    """Đổi tên cột trùng: A, A -> A, A_1"""
+    unique_headers = []
+    seen = {}
+    for col in header_row:
+        if col in seen:
+            seen[col] += 1
+            unique_headers.append(f"{col}_{seen[col]}")
+        else:
+            seen[col] = 0
+            unique_headers.append(col)
+    return unique_headers
+
+def transform_source_polars(data, plan, raw_filter, include_header, link_src, source_label, month_val):
+    """Cùng phép biến đổi như nhánh pandas của fetch_data_v4 nhưng chạy bằng Polars (lazy, đa luồng).
+    Trả về (df pandas, lỗi lọc); None nếu trường hợp này phải để pandas xử lý (không có header, tên cột trùng, dòng lệch cột)."""
+    out_names = [name for _, name in plan]
+    if not data[0] or not out_names or len(set(out_names)) != len(out_names): return None
+
+    # Dựng 1 Series phẳng rồi tách cột bằng gather (chạy trong Rust), nhanh hơn hẳn zip(*rows) bên Python
+    n_rows = len(data) - 1; width = len(data[0])
+    flat = pl.Series("v", list(itertools.chain.from_iterable(data[1:])), dtype=pl.Utf8)
+    if len(flat) != n_rows * width: return None
+    df = pl.select(pl.lit(flat).gather(pl.int_range(i, n_rows * width, width)).alias(name) for i, name in plan) if n_rows else \
+        pl.DataFrame(schema={name: pl.Utf8 for name in out_names})
+
+    if raw_filter:
+        df, err = apply_smart_filter_polars(df, raw_filter)
+        if err: return None, err
+
+    lf = df.lazy()
+    if include_header:
+        lf = pl.concat([pl.select(pl.lit(name, dtype=pl.Utf8).alias(name) for name in out_names).lazy(), lf])
+    lf = lf.with_columns(pl.all().fill_null("").replace(NULL_LIKE_VALUES, "")).with_columns(
+        pl.lit(link_src.strip()).alias(SYS_COL_LINK),
+        pl.lit(source_label.strip()).alias(SYS_COL_SHEET),
+        pl.lit(month_val.strip()).alias(SYS_COL_MONTH),
+    )
+    return lf.collect().to_arrow().to_pandas(), None
+
+def get_data_range_str(row_config):
+    raw_range = str(row_config.get(COL_DATA_RANGE, '')).strip()
+    if raw_range.lower() in ['nan', 'none', 'null', '', 'lấy hết']: return "Lấy hết"
+    return raw_range
+
+def parse_col_range(data_range_str):
+    """'B:F' -> (1, 5); None nếu lấy hết / không hợp lệ"""
+    if data_range_str == "Lấy hết" or ":" not in data_range_str: return None
+    try:
+        s_str, e_str = data_range_str.split(":")
+        s_idx = col_name_to_index(s_str.strip()); e_idx = col_name_to_index(e_str.strip())
+        return (s_idx, e_idx) if s_idx >= 0 else None
+    except: return None
+
+def source_read_window(row_config):
+    """Vùng cần đọc của 1 dòng cấu hình: (cột đầu, cột cuối, dòng đầu, dòng cuối) - cột tính từ 0, dòng là số dòng
+    trên sheet của phần thân (header luôn là dòng 1), None = không giới hạn. None nếu phải đọc cả tab."""
+    col_range = parse_col_range(get_data_range_str(row_config))
+    if not col_range or col_range[1] < col_range[0]: return None
+    return (col_range[0], col_range[1], None, None)
+
+def source_read_ranges(title, window):
+    """(range header, range dữ liệu) A1 cho 1 lần đọc; đọc cả tab thì range header = None.
+    window có cột đầu/cuối = None nghĩa là mọi cột (chỉ giới hạn dòng, dùng cho đọc theo trang)."""
+    if window is None: return None, quote_sheet_title(title)
+    c0, c1, r0, r1 = window
+    if c0 is None:
+        if not r1: return None, quote_sheet_title(title)
+        return f"{quote_sheet_title(title)}!1:1", f"{quote_sheet_title(title)}!{r0 or 2}:{r1}"
+    col_a = gspread.utils.rowcol_to_a1(1, c0 + 1).rstrip("0123456789")
+    col_b = gspread.utils.rowcol_to_a1(1, c1 + 1).rstrip("0123456789")
+    return f"{quote_sheet_title(title)}!1:1", f"{quote_sheet_title(title)}!{col_a}{r0 or 2}:{col_b}{r1 or ''}"
+
+def assemble_source_values(data_values, header_values=None, window=None):
+    """Kết quả batchGet -> (data, header_prefix). data giống get_all_values (dòng 0 là header, pad đều cột) nhưng
+    chỉ gồm các cột trong vùng đọc; header_prefix là các ô header nằm trước vùng (để đặt tên cột trùng như đọc cả tab)."""
+    if window is None: return gspread.utils.fill_gaps(data_values or [[]]), []
+    c0, c1 = window[0], window[1]
+    header_full = (header_values or [[]])[0]
+    if c0 is None: return gspread.utils.fill_gaps([list(header_full)] + list(data_values or [])), []
+    header_prefix = (list(header_full[:c0]) + [''] * c0)[:c0]
+    return gspread.utils.fill_gaps([list(header_full[c0:c1 + 1])] + list(data_values or [])), header_prefix
+
+def plan_source_columns(header_row, target_headers=None, data_range_str="Lấy hết", header_prefix=None):
+    """[(vị trí cột trong data, tên cột đầu ra)]: đổi tên theo header đích (theo vị trí) rồi cắt Vùng lấy dữ liệu.
+    Vị trí/tên tính trên cả tab nên đọc cả tab hay chỉ đọc vùng (header_prefix) đều ra cùng kết quả."""
+    header_prefix = header_prefix or []
+    offset = len(header_prefix)
+    names = make_unique_headers(list(header_prefix) + list(header_row))
+    if target_headers:
+        names = [target_headers[p] if p < len(target_headers) else n for p, n in enumerate(names)][:len(target_headers)]
+    positions = list(range(len(names)))
+    col_range = parse_col_range(data_range_str)
+    if col_range: positions = positions[col_range[0] : col_range[1] + 1]
+    return [(p - offset, names[p]) for p in positions if p >= offset]
+
+def fetch_data_v4(row_config, creds, target_headers=None, data=None, engine=ETL_ENGINE, header_prefix=None):
     link_src = str(row_config.get(COL_SRC_LINK, '')).strip()
     source_label = str(row_config.get(COL_SRC_SHEET, '')).strip()
     month_val = str(row_config.get(COL_MONTH, ''))
     
     # 1. Range
-    raw_range = str(row_config.get(COL_DATA_RANGE, '')).strip()
-    if raw_range.lower() in ['nan', 'none', 'null', '', 'lấy hết']:
-        data_range_str = "Lấy hết"
-    else:
-        data_range_str = raw_range
+    data_range_str = get_data_range_str(row_config)
 
     # 2. Filter
     raw_filter = str(row_config.get(COL_FILTER, '')).strip()
@@ -427,48 +640,30 @@ def fetch_data_v4(row_config, creds, target_headers=None):
     if not sheet_id: return None, sheet_id, "Link lỗi"
     
     try:
-        sh_source = get_sh_with_retry(creds, sheet_id)
-        if source_label:
-            try: wks_source = sh_source.worksheet(source_label)
-            except: return None, sheet_id, f"❌ 404 Sheet: {source_label}"
-        else: wks_source = sh_source.sheet1
-            
-        data = safe_api_call(wks_source.get_all_values)
+        if data is None:
+            # Đọc lẻ 1 dòng (luồng batch đã đọc sẵn thì truyền data vào)
+            data, err, header_prefix = read_source_batch(creds, sheet_id, [row_config])[0]
+            if err: return None, sheet_id, err
+            if not isinstance(data, list):  # tab lớn -> đọc theo trang rồi gộp
+                try: return pd.concat(list(fetch_data_stream(row_config, creds, target_headers, data, engine)), ignore_index=True), sheet_id, "Thành công"
+                except RuntimeError as e: return None, sheet_id, str(e)
         if not data: return pd.DataFrame(), sheet_id, "Sheet trắng/Lỗi tải"
 
-        header_row = data[0]
-        body_rows = data[1:]
-        
-        unique_headers = []
-        seen = {}
-        for col in header_row:
-            if col in seen:
-                seen[col] += 1
-                unique_headers.append(f"{col}_{seen[col]}")
-            else:
-                seen[col] = 0
-                unique_headers.append(col)
-        
-        df_working = pd.DataFrame(body_rows, columns=unique_headers)
-
-        if target_headers:
-            num_src = len(df_working.columns); num_tgt = len(target_headers)
-            min_cols = min(num_src, num_tgt)
-            old_cols = df_working.columns.tolist()
-            rename_map = {old_cols[i]: target_headers[i] for i in range(min_cols)}
-            df_working = df_working.rename(columns=rename_map)
-            if num_src > num_tgt: df_working = df_working.iloc[:, :num_tgt]
-
-        if data_range_str != "Lấy hết" and ":" in data_range_str:
-            try:
-                s_str, e_str = data_range_str.split(":")
-                s_idx = col_name_to_index(s_str.strip()); e_idx = col_name_to_index(e_str.strip())
-                if s_idx >= 0: df_working = df_working.iloc[:, s_idx : e_idx + 1]
-            except: pass
+        # data có thể chỉ là vùng cột đã đọc (header_prefix = các ô header trước vùng)
+        plan = plan_source_columns(data[0], target_headers, data_range_str, header_prefix)
+
+        if engine == "polars":
+            res = transform_source_polars(data, plan, raw_filter, include_header, link_src, source_label, month_val)
+            if res is not None:
+                df_final, err = res
+                if err: return None, sheet_id, f"⚠️ {err}"
+                return df_final, sheet_id, "Thành công"
+
+        df_working = pd.DataFrame(data[1:], columns=range(len(data[0]))).iloc[:, [i for i, _ in plan]]
+        df_working.columns = [name for _, name in plan]
 
         if raw_filter:
-            # [V77] Sử dụng hàm Filter mới
-            df_filtered, err = apply_smart_filter_v77(df_working, raw_filter)
+            df_filtered, err = apply_smart_filter(df_working, raw_filter)
             if err: return None, sheet_id, f"⚠️ {err}"
             df_working = df_filtered
 
@@ -478,7 +673,7 @@ def fetch_data_v4(row_config, creds, target_headers=None):
         else:
             df_final = df_working
 
-        df_final = df_final.astype(str).replace(['nan', 'None', '<NA>', 'null'], '')
+        df_final = df_final.astype(str).replace(NULL_LIKE_VALUES, '')
         
         df_final[SYS_COL_LINK] = link_src.strip()
         df_final[SYS_COL_SHEET] = source_label.strip()
@@ -488,41 +683,125 @@ def fetch_data_v4(row_config, creds, target_headers=None):
 
     except Exception as e: return None, sheet_id, f"Lỗi tải: {str(e)}"
 
-def get_rows_to_delete_dynamic(wks, keys_to_delete, log_container):
-    all_values = safe_api_call(wks.get_all_values)
-    if not all_values: return []
-    headers = all_values[0]
-    try:
-        idx_link = headers.index(SYS_COL_LINK); idx_sheet = headers.index(SYS_COL_SHEET); idx_month = headers.index(SYS_COL_MONTH)
-    except ValueError: return [] 
-    rows_to_delete = []
-    for i, row in enumerate(all_values[1:], start=2): 
-        l = row[idx_link].strip() if len(row) > idx_link else ""
-        s = row[idx_sheet].strip() if len(row) > idx_sheet else ""
-        m = row[idx_month].strip() if len(row) > idx_month else ""
-        if (l, s, m) in keys_to_delete: rows_to_delete.append(i)
-    return rows_to_delete
-
-def batch_delete_rows(sh, sheet_id, row_indices, log_container=None):
-    if not row_indices: return
-    row_indices.sort(reverse=True) 
-    ranges = []
-    if len(row_indices) > 0:
-        start = row_indices[0]; end = start
-        for r in row_indices[1:]:
-            if r == start - 1: start = r
-            else: ranges.append((start, end)); start = r; end = r
-        ranges.append((start, end))
-    requests = []
-    for start, end in ranges:
-        requests.append({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}}})
-    batch_size = 100
-    for i in range(0, len(requests), batch_size):
-        if log_container: log_container.write(f"✂️ Xóa batch {i//batch_size + 1}...")
-        safe_api_call(sh.batch_update, {'requests': requests[i:i+batch_size]})
-        time.sleep(1)
-
-def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, creds, log_container):
+def fetch_data_stream(row_config, creds, target_headers, pages, engine=ETL_ENGINE):
+    """Biến đổi + lọc nguồn đọc theo trang (stream_source_pages): yield 1 DataFrame / trang. Lỗi -> RuntimeError"""
+    cfg = dict(row_config)
+    for data, header_prefix in pages:
+        df, _, msg = fetch_data_v4(cfg, creds, target_headers, data=data, engine=engine, header_prefix=header_prefix)
+        if df is None: raise RuntimeError(msg)
+        cfg[COL_HEADER] = 'FALSE'  # dòng tiêu đề chỉ chèn ở trang đầu
+        yield df
+
+def read_source_batch(creds, sheet_id, row_configs):
+    """Đọc tất cả tab cần cho các dòng cùng 1 file nguồn bằng 1 lần values:batchGet.
+    Dòng có Vùng lấy dữ liệu (VD A:F) chỉ đọc đúng các cột đó (+ dòng header), không tải cả tab.
+    Tab lớn hơn STREAM_PAGE_ROWS dòng không đọc ở đây: data là generator các trang (stream_source_pages, chưa đọc).
+    Trả về [(data, lỗi, header_prefix)] theo thứ tự row_configs (xem assemble_source_values)."""
+    sh = get_sh_with_retry(creds, sheet_id)
+    wks_map = get_wks_map(sh)
+    row_reads = []
+    for r in row_configs:
+        label = str(r.get(COL_SRC_SHEET, '')).strip()
+        if label and label not in wks_map: wks_map = get_wks_map(sh, refresh=True)
+        if label and label not in wks_map: row_reads.append(None); continue
+        window = source_read_window(r)
+        title = label or next(iter(wks_map))
+        if wks_map[title].row_count - 1 > STREAM_PAGE_ROWS: row_reads.append((window, title, wks_map[title].row_count)); continue
+        row_reads.append((window, source_read_ranges(title, window)))
+
+    ranges = list(dict.fromkeys(rng for rr in row_reads if rr and len(rr) == 2 for rng in rr[1] if rng))
+    values_by_range = {}
+    if ranges:
+        resp = safe_api_call(sh.values_batch_get, ranges)
+        for rng, vr in zip(ranges, resp.get("valueRanges", [])):
+            values_by_range[rng] = vr.get("values", [])
+
+    out = []
+    for r, rr in zip(row_configs, row_reads):
+        if rr is None: out.append((None, f"❌ 404 Sheet: {str(r.get(COL_SRC_SHEET, '')).strip()}", None)); continue
+        if len(rr) == 3: out.append((stream_source_pages(creds, sheet_id, rr[1], rr[0], rr[2]), None, [])); continue
+        window, (header_rng, data_rng) = rr
+        data, header_prefix = assemble_source_values(values_by_range.get(data_rng), values_by_range.get(header_rng), window)
+        out.append((data, None, header_prefix))
+    return out
+
+def stream_source_pages(creds, sheet_id, title, window, row_count, page_rows=STREAM_PAGE_ROWS):
+    """Đọc 1 tab lớn theo từng cửa sổ page_rows dòng thay vì 1 lần get_all_values.
+    Yield (data, header_prefix) như read_source_batch cho từng trang (data[0] luôn là dòng header).
+    Dòng trống giữa sheet được giữ nguyên, dòng trống cuối sheet bị bỏ - giống đọc cả tab."""
+    sh = get_sh_with_retry(creds, sheet_id)
+    c0, c1 = (window[0], window[1]) if window else (None, None)
+    header_values, pending_blank, yielded = None, 0, False
+    r0 = 2
+    while True:
+        r1 = r0 + page_rows - 1
+        header_rng, data_rng = source_read_ranges(title, (c0, c1, r0, r1))
+        ranges = [data_rng] + ([header_rng] if header_values is None else [])
+        resp = safe_api_call(sh.values_batch_get, ranges).get("valueRanges", [])
+        body = resp[0].get("values", []) if resp else []
+        if header_values is None: header_values = resp[1].get("values", []) if len(resp) > 1 else []
+        if body:
+            data, header_prefix = assemble_source_values([[]] * pending_blank + body, header_values, (c0, c1, None, None))
+            yield data, header_prefix
+            yielded = True
+        pending_blank = (pending_blank if not body else 0) + page_rows - len(body)
+        if r1 >= row_count and len(body) < page_rows: break
+        r0 = r1 + 1
+    if not yielded: yield assemble_source_values([], header_values, (c0, c1, None, None))
+
+def is_source_stream(df):
+    """Nguồn lớn được đọc theo trang: df là generator các DataFrame thay vì 1 DataFrame"""
+    return df is not None and not isinstance(df, pd.DataFrame)
+
+def open_task_streams(tasks_list, materialize=False):
+    """tasks -> ([(chunk đầu, phần còn lại | None, src, r_idx)] giữ đúng thứ tự tasks, {r_idx: lỗi}).
+    Nguồn thường: chunk đầu là cả DataFrame, phần còn lại None.
+    Đọc trước tới chunk có dữ liệu đầu tiên của mỗi nguồn đọc theo trang để lỗi đọc lộ ra TRƯỚC khi xóa dữ liệu cũ.
+    materialize=True (chế độ diff) thì gom hết trang thành 1 DataFrame."""
+    opened, failed = [], {}
+    for df, src, r_idx in tasks_list:
+        if not is_source_stream(df): opened.append((df, None, src, r_idx)); continue
+        try:
+            if materialize:
+                opened.append((pd.concat(list(df), ignore_index=True), None, src, r_idx)); continue
+            it = iter(df); first = next(it, None)
+            while first is not None and first.empty:
+                nxt = next(it, None)
+                if nxt is None: break
+                first = nxt
+            if first is not None: opened.append((first, it, src, r_idx))
+        except Exception as e: failed[r_idx] = str(e)
+    return opened, failed
+
+def fetch_group_concurrent(group_rows, creds, target_headers=None, max_workers=FETCH_MAX_WORKERS, engine=ETL_ENGINE):
+    """Tải song song các nguồn của 1 nhóm đích: mỗi file nguồn là 1 tác vụ (1 batchGet cho mọi tab cần),
+    tối đa max_workers file cùng lúc. Trả về (df, sheet_id, msg) theo ĐÚNG thứ tự group_rows."""
+    by_sheet = defaultdict(list)
+    for pos, r in enumerate(group_rows): by_sheet[extract_id(str(r.get(COL_SRC_LINK, '')).strip())].append(pos)
+
+    def _fetch_sheet(sid, positions):
+        rows = [group_rows[p] for p in positions]
+        if not sid: return [(None, sid, "Link lỗi")] * len(rows)
+        try: batch = read_source_batch(creds, sid, rows)
+        except Exception as e: return [(None, sid, f"Lỗi tải: {str(e)}")] * len(rows)
+        res = []
+        for r, (data, err, header_prefix) in zip(rows, batch):
+            if err: res.append((None, sid, err))
+            elif not isinstance(data, list): res.append((fetch_data_stream(r, creds, target_headers, data, engine), sid, "Thành công"))
+            else: res.append(fetch_data_v4(r, creds, target_headers, data=data, engine=engine, header_prefix=header_prefix))
+        return res
+
+    if not group_rows: return
+    slot = {p: (sid, k) for sid, positions in by_sheet.items() for k, p in enumerate(positions)}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(by_sheet)))) as ex:
+        fetch_sheet = bind_run_context(_fetch_sheet)
+        futs = {sid: ex.submit(fetch_sheet, sid, positions) for sid, positions in by_sheet.items()}
+        for p in range(len(group_rows)):
+            sid, k = slot[p]
+            yield futs[sid].result()[k]
+
+# --- GHI ĐÍCH (replace ở đây; diff / atomic ở sheet_writer.py) ---
+def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, creds, log_container, sync_mode=WRITE_SYNC_MODE, fence=None):
     result_map = {} 
     try:
         target_id = extract_id(target_link)
@@ -531,22 +810,23 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, creds, log_
         real_sheet_name = str(target_sheet_name).strip() or "Tong_Hop_Data"
         log_container.write(f"📂 Đích: ...{target_link[-10:]} | Sheet: {real_sheet_name}")
         
-        all_titles = [s.title for s in safe_api_call(sh.worksheets)]
-        if real_sheet_name in all_titles:
-            wks = sh.worksheet(real_sheet_name)
-        else:
-            wks = sh.add_worksheet(title=real_sheet_name, rows=1000, cols=20)
+        try:
+            wks = get_wks_with_retry(sh, real_sheet_name)
+        except gspread.WorksheetNotFound:
+            wks = add_wks_pooled(sh, real_sheet_name, rows=1000, cols=20)
             log_container.write(f"✨ Tạo mới sheet: {real_sheet_name}")
         
-        df_new_all = pd.DataFrame()
-        for df, src_link, r_idx in tasks_list:
-            df_new_all = pd.concat([df_new_all, df], ignore_index=True)
-        
-        if df_new_all.empty: return True, "No Data", {}
+        # Nguồn đọc theo trang được ghi từng trang (diff cần toàn bộ dữ liệu nên gom lại)
+        opened, failed = open_task_streams(tasks_list, materialize=(sync_mode == "diff"))
+        for err in failed.values(): log_container.error(f"❌ Lỗi đọc theo trang: {err[:120]}")
+        result_map.update({r_idx: ("Lỗi tải", "", 0) for r_idx in failed})
+
+        if all(first.empty for first, _, _, _ in opened): return True, "No Data", result_map
+        if sync_mode == "atomic": return write_atomic_sync(sh, wks, opened, result_map, log_container, fence)
 
         existing_headers = safe_api_call(wks.row_values, 1)
         if not existing_headers:
-            final_headers = df_new_all.columns.tolist()
+            final_headers = union_columns([first for first, _, _, _ in opened])
             wks.update(range_name="A1", values=[final_headers])
             existing_headers = final_headers
             log_container.write("🆕 Tạo Header mới.")
@@ -556,39 +836,33 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, creds, log_
                 if col not in updated: updated.append(col); added = True
             if added: wks.update(range_name="A1", values=[updated]); existing_headers = updated; log_container.write("➕ Cập nhật cột hệ thống.")
 
-        df_aligned = pd.DataFrame()
-        for col in existing_headers:
-            if col in df_new_all.columns: df_aligned[col] = df_new_all[col]
-            else: df_aligned[col] = ""
-        
+        if sync_mode == "diff":
+            return write_diff_sync(sh, wks, opened, existing_headers, log_container, fence)
+
         keys = set()
-        for idx, row in df_new_all.iterrows():
-            keys.add((str(row[SYS_COL_LINK]).strip(), str(row[SYS_COL_SHEET]).strip(), str(row[SYS_COL_MONTH]).strip()))
+        for first, _, _, _ in opened: keys |= task_keys(first)
         
         log_container.write("🔍 Quét dữ liệu cũ...")
-        rows_to_del = get_rows_to_delete_dynamic(wks, keys, log_container)
+        all_values = safe_api_call(wks.get_all_values) or [existing_headers]
+        rows_to_del = get_rows_to_delete_dynamic(all_values, keys)
+        batcher = AppendBatcher(wks, fence)
         if rows_to_del:
             log_container.write(f"✂️ Xóa {len(rows_to_del)} dòng cũ...")
-            batch_delete_rows(sh, wks.id, rows_to_del, log_container)
+            batch_delete_rows(sh, wks, rows_to_del, log_container)
             log_container.write("✅ Đã xóa.")
+        start_row = len(all_values) - len(rows_to_del) + 1
         
-        log_container.write(f"🚀 Ghi {len(df_aligned)} dòng mới...")
-        start_row = len(safe_api_call(wks.get_all_values)) + 1
+        log_container.write(f"🚀 Ghi {sum(len(first) for first, rest, _, _ in opened if rest is None)} dòng mới...")
+        for _, rest, src_link, _ in opened:
+            if rest is not None: log_container.write(f"📄 Ghi theo trang: ...{src_link[-10:]}")
         
-        chunk_size = 5000
-        new_vals = df_aligned.fillna('').values.tolist()
-        for i in range(0, len(new_vals), chunk_size):
-            safe_api_call(wks.append_rows, new_vals[i:i+chunk_size], value_input_option='USER_ENTERED')
-            time.sleep(1)
-
-        current_cursor = start_row
-        for df, src_link, r_idx in tasks_list:
-            count = len(df)
-            end = current_cursor + count - 1
-            result_map[r_idx] = ("Thành công", f"{current_cursor} - {end}", count)
-            current_cursor += count
-            
-        return True, f"Cập nhật {len(df_aligned)} dòng", result_map
+        counts, stream_failed = {}, {}
+        for vals in iter_aligned_slices(opened, existing_headers, APPEND_SLICE_ROWS, counts, stream_failed):
+            batcher.add(vals)
+        batcher.flush()
+
+        report_write_results(opened, counts, stream_failed, start_row, result_map, log_container)
+        return True, f"Cập nhật {sum(counts.values())} dòng", result_map
 
     except Exception as e: return False, f"Lỗi Ghi: {str(e)}", {}
 
@@ -596,7 +870,7 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, creds, log_
 def verify_access_fast(url, creds):
     sheet_id = extract_id(url)
     if not sheet_id: return False, "Link lỗi"
-    try: get_sh_with_retry(creds, sheet_id); return True, "OK"
+    try: get_sh_with_retry(creds, sheet_id, fresh=True); return True, "OK"
     except: return False, "Chặn quyền"
 
 def check_permissions_ui(rows, creds, container, user_id):
@@ -624,7 +898,6 @@ def check_permissions_ui(rows, creds, container, user_id):
     
     for i, link in enumerate(all_unique_links):
         prog.progress((i + 1) / total)
-        time.sleep(0.2)
         
         ok, msg = verify_access_fast(link, creds)
         
@@ -645,18 +918,20 @@ def check_permissions_ui(rows, creds, container, user_id):
         
     log_user_action_buffered(creds, user_id, "Quét Quyền", f"Hoàn tất. Lỗi: {err_count}", force_flush=True)
 
-def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_container):
+def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_container, sync_mode=WRITE_SYNC_MODE, engine=ETL_ENGINE):
     creds = get_creds()
-    if not acquire_lock(creds, user_id): 
-        st.error("⚠️ Hệ thống đang bận. Vui lòng thử lại sau."); return False, {}, 0
+    grouped = defaultdict(list)
+    for r in rows_to_run:
+        if str(r.get(COL_STATUS, '')).strip() == "Chưa chốt & đang cập nhật":
+            grouped[(str(r.get(COL_TGT_LINK, '')).strip(), str(r.get(COL_TGT_SHEET, '')).strip())].append(r)
+    # Chỉ khóa các đích của lần chạy này: đội khác ghi đích khác vẫn chạy song song
+    lease = acquire_lock(creds, user_id, [lock_resource(extract_id(t_link) or t_link, t_sheet or "Tong_Hop_Data") for t_link, t_sheet in grouped])
+    if not lease: 
+        st.error("⚠️ Đích đang được người khác ghi. Vui lòng thử lại sau."); return False, {}, 0
+    reset_circuit_breaker()
     
     log_user_action_buffered(creds, user_id, f"Chạy: {block_name_run}", "Đang xử lý...", force_flush=True)
     try:
-        grouped = defaultdict(list)
-        for r in rows_to_run:
-            if str(r.get(COL_STATUS, '')).strip() == "Chưa chốt & đang cập nhật":
-                grouped[(str(r.get(COL_TGT_LINK, '')).strip(), str(r.get(COL_TGT_SHEET, '')).strip())].append(r)
-        
         final_res_map = {}; all_ok = True; total_rows = 0; log_ents = []
         tz = pytz.timezone('Asia/Ho_Chi_Minh'); now = datetime.now(tz).strftime("%d/%m/%Y %H:%M:%S")
 
@@ -667,33 +942,41 @@ def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_containe
                     tid = extract_id(t_link)
                     if tid:
                         sh_t = get_sh_with_retry(creds, tid)
-                        all_titles = [s.title for s in safe_api_call(sh_t.worksheets)]
-                        if t_sheet in all_titles:
-                            wks_t = sh_t.worksheet(t_sheet)
+                        if t_sheet in get_wks_map(sh_t):
+                            wks_t = get_wks_with_retry(sh_t, t_sheet)
                             target_headers = safe_api_call(wks_t.row_values, 1)
                 except: pass
 
                 tasks = []
-                for i, r in enumerate(group_rows):
+                st.write(f"⬇️ Tải {len(group_rows)} nguồn ({FETCH_MAX_WORKERS} luồng)...")
+                fetched = fetch_group_concurrent(group_rows, creds, target_headers, engine=engine)
+                for r, (df, sid, msg) in zip(group_rows, fetched):
                     lnk = r.get(COL_SRC_LINK, ''); lbl = r.get(COL_SRC_SHEET, '')
                     row_idx = r.get('_index', -1)
-                    st.write(f"⬇️ Tải: {lnk[-10:]} ({lbl})")
-                    df, sid, msg = fetch_data_v4(r, creds, target_headers)
-                    time.sleep(1.5)
                     
-                    if df is not None: 
+                    if is_source_stream(df):
+                        st.write(f"✔️ Tab lớn: {lnk[-10:]} ({lbl}) - đọc & ghi theo trang {STREAM_PAGE_ROWS} dòng")
+                        tasks.append((df, lnk, row_idx))
+                    elif df is not None: 
+                        st.write(f"✔️ Tải: {lnk[-10:]} ({lbl}) - {len(df)} dòng")
                         tasks.append((df, lnk, row_idx))
                         total_rows += len(df)
                     else: 
-                        st.error(f"❌ {msg}")
+                        st.error(f"❌ {lnk[-10:]} ({lbl}): {msg}")
                         final_res_map[row_idx] = ("Lỗi tải", "", 0)
-                    del df; gc.collect()
+                    del df
+                gc.collect()
 
+                if tasks and not renew_lock(creds, lease):
+                    st.error("❌ Đã mất khóa đích (hết hạn và có người khác lấy) - không ghi."); all_ok = False
+                    tasks = []
                 if tasks:
-                    ok, msg, batch_res_map = write_strict_sync_v2(tasks, t_link, t_sheet, creds, st)
+                    stream_idx = [row_idx for df, _, row_idx in tasks if is_source_stream(df)]
+                    ok, msg, batch_res_map = write_strict_sync_v2(tasks, t_link, t_sheet, creds, st, sync_mode, fence=lambda: renew_lock(creds, lease))
                     if not ok: st.error(msg); all_ok = False
                     else: st.success(msg)
                     final_res_map.update(batch_res_map)
+                    total_rows += sum(batch_res_map.get(i, ("", "", 0))[2] for i in stream_idx)
                     del tasks; gc.collect()
                 
                 for r in group_rows:
@@ -711,17 +994,20 @@ def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_containe
         log_user_action_buffered(creds, user_id, f"Kết quả chạy {block_name_run}", status_msg, force_flush=True)
         
         return all_ok, final_res_map, total_rows
-    finally: release_lock(creds, user_id)
+    finally: release_lock(creds, lease)
 
 # ==========================================
 # 5. UI & MAIN
 # ==========================================
 @st.cache_data
 def load_full_config(_creds):
-    sh = get_sh_with_retry(_creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-    wks = sh.worksheet(SHEET_CONFIG_NAME)
-    ensure_sheet_headers(wks, REQUIRED_COLS_CONFIG)
-    df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str).dropna(how='all')
+    values = get_master_values(_creds, [SHEET_CONFIG_NAME])[SHEET_CONFIG_NAME]
+    if values is None: raise gspread.WorksheetNotFound(SHEET_CONFIG_NAME)
+    if not values:
+        sh = get_sh_with_retry(_creds, st.secrets["gcp_service_account"]["history_sheet_id"])
+        get_wks_with_retry(sh, SHEET_CONFIG_NAME).append_row(REQUIRED_COLS_CONFIG); invalidate_master_snapshot(SHEET_CONFIG_NAME)
+        return pd.DataFrame(columns=REQUIRED_COLS_CONFIG)
+    df = values_to_dataframe(values)
     if df.empty: return pd.DataFrame(columns=REQUIRED_COLS_CONFIG)
     
     df[COL_BLOCK_NAME] = df[COL_BLOCK_NAME].replace('', DEFAULT_BLOCK_NAME).fillna(DEFAULT_BLOCK_NAME)
@@ -731,16 +1017,95 @@ def load_full_config(_creds):
     if 'Che_Do_Ghi' in df.columns: df = df.drop(columns=['Che_Do_Ghi'])
     return df
 
+# --- GHI CẤU HÌNH THEO KHỐI (UPSERT TẠI CHỖ, KHÔNG CLEAR CẢ TAB) ---
+def read_config_values(creds):
+    values = get_master_values(creds, [SHEET_CONFIG_NAME], fresh=True)[SHEET_CONFIG_NAME]
+    if values is None: raise gspread.WorksheetNotFound(SHEET_CONFIG_NAME)
+    return values
+
+def config_row_positions(values, select):
+    """Chỉ số (trong values = dòng sheet - 1) các dòng dữ liệu thỏa select({header: giá trị chuỗi})"""
+    header = [str(h) for h in values[0]] if values else []
+    out = []
+    for i, r in enumerate(values[1:], start=1):
+        row = dict(zip(header, [str(v) for v in r] + [""] * (len(header) - len(r))))
+        if select(row): out.append(i)
+    return out
+
+def config_block_positions(values, blk_name):
+    return config_row_positions(values, lambda r: r.get(COL_BLOCK_NAME, DEFAULT_BLOCK_NAME) == blk_name)
+
+def config_row_values(df, header):
+    """DataFrame -> các dòng theo thứ tự cột header (cột df không có -> ô trống)"""
+    recs = df.fillna("").astype(str).replace(['nan', 'None'], '').to_dict('records')
+    return [[rec.get(h, "") for h in header] for rec in recs]
+
+def cell_runs(cols):
+    """[2, 3, 4, 7, 9, 10] -> [(2, 4), (7, 7), (9, 10)]"""
+    runs = []
+    for c in cols:
+        if runs and c == runs[-1][1] + 1: runs[-1][1] = c
+        else: runs.append([c, c])
+    return [tuple(r) for r in runs]
+
+CONFIG_NUM_RE = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?")
+
+def config_cell(v):
+    """Chuỗi ô cấu hình -> userEnteredValue cho updateCells, cùng kết quả set_with_dataframe (USER_ENTERED, escape dấu ')
+    với các kiểu luu_cau_hinh dùng: TRUE/FALSE -> checkbox, số -> số, "=..." -> công thức, còn lại giữ nguyên chuỗi
+    (kể cả khoảng trắng liên tiếp và dấu ' đầu); chuỗi rỗng -> xóa ô"""
+    if v == "": return {}
+    if v.upper() in ("TRUE", "FALSE"): return {"userEnteredValue": {"boolValue": v.upper() == "TRUE"}}
+    if CONFIG_NUM_RE.fullmatch(v): return {"userEnteredValue": {"numberValue": float(v)}}
+    if v.startswith("="): return {"userEnteredValue": {"formulaValue": v}}
+    return {"userEnteredValue": {"stringValue": v}}
+
+
+def cells_request(sheet_id, row_index, col_index, rows):
+    return {"updateCells": {"start": {"sheetId": sheet_id, "rowIndex": row_index, "columnIndex": col_index},
+                            "rows": [{"values": [config_cell(str(v)) for v in r]} for r in rows], "fields": "userEnteredValue"}}
+
+def upsert_config_rows(sh, wks, values, positions, new_rows, new_cols=()):
+    """Thay các dòng `positions` của luu_cau_hinh bằng new_rows (theo header hiện có + new_cols) trong 1 batchUpdate
+    (nguyên tử, tab không lúc nào trống): dòng giữ vị trí và chỉ ghi ô đổi, dòng thừa bị xóa, dòng thiếu chèn ngay dưới
+    dòng cuối của nhóm (nhóm mới -> cuối dữ liệu). Trả về số request con (0 = không có gì đổi, không gọi API)."""
+    header = [str(h) for h in values[0]] if values else []
+    width = len(header) + len(new_cols)
+    reqs = []
+    if new_cols:
+        grid_cols = get_grid_size(sh, wks)[1]
+        if width > grid_cols: reqs.append({"appendDimension": {"sheetId": wks.id, "dimension": "COLUMNS", "length": width - grid_cols}})
+        reqs.append(cells_request(wks.id, 0, len(header), [list(new_cols)]))
+    for pos, new in zip(positions, new_rows):
+        old = [str(v) for v in values[pos]] + [""] * width
+        new = [str(v) for v in new] + [""] * (width - len(new))
+        for c0, c1 in cell_runs([j for j in range(width) if old[j] != new[j]]):
+            reqs.append(cells_request(wks.id, pos, c0, [new[c0:c1 + 1]]))
+    for r0, r1 in reversed(cell_runs(positions[len(new_rows):])):
+        reqs.append({"deleteDimension": {"range": {"sheetId": wks.id, "dimension": "ROWS", "startIndex": r0, "endIndex": r1 + 1}}})
+    extra = new_rows[len(positions):]
+    if extra:
+        at = positions[-1] + 1 if positions else max(len(values), 1)
+        if at < len(values):
+            reqs.append({"insertDimension": {"range": {"sheetId": wks.id, "dimension": "ROWS", "startIndex": at, "endIndex": at + len(extra)},
+                                             "inheritFromBefore": True}})
+        else: reqs.append({"appendDimension": {"sheetId": wks.id, "dimension": "ROWS", "length": len(extra)}})  # dưới dữ liệu là dòng trống
+        reqs.append(cells_request(wks.id, at, 0, extra))
+    if reqs: safe_api_call(sh.batch_update, {"requests": reqs})
+    invalidate_master_snapshot(SHEET_CONFIG_NAME)
+    return len(reqs)
+
 def save_block_config_to_sheet(df_ui, blk_name, creds, uid):
-    if not acquire_lock(creds, uid): st.error("Busy!"); return
+    lease = acquire_lock(creds, uid, [lock_resource(st.secrets["gcp_service_account"]["history_sheet_id"], SHEET_CONFIG_NAME)])
+    if not lease: st.error("Busy!"); return
     try:
         sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        wks = sh.worksheet(SHEET_CONFIG_NAME)
-        
-        df_svr = get_as_dataframe(wks, evaluate_formulas=True, dtype=str).dropna(how='all')
-        if COL_BLOCK_NAME not in df_svr.columns: df_svr[COL_BLOCK_NAME] = DEFAULT_BLOCK_NAME
+        wks = get_wks_with_retry(sh, SHEET_CONFIG_NAME)
         
-        df_old_blk = df_svr[df_svr[COL_BLOCK_NAME] == blk_name].copy().reset_index(drop=True)
+        values = read_config_values(creds)
+        positions = config_block_positions(values, blk_name)
+        df_old_blk = values_to_dataframe([values[0]] + [values[p] for p in positions]) if positions else pd.DataFrame()
+        df_old_blk = df_old_blk.reset_index(drop=True)
         df_new_blk = df_ui.copy().reset_index(drop=True)
         
         action_type = "Cập nhật Khối"
@@ -755,45 +1120,55 @@ def save_block_config_to_sheet(df_ui, blk_name, creds, uid):
         
         log_user_action_buffered(creds, uid, f"{action_type} {blk_name}", change_msg, force_flush=True)
         
-        df_oth = df_svr[df_svr[COL_BLOCK_NAME] != blk_name]
         if 'STT' in df_new_blk.columns: df_new_blk = df_new_blk.drop(columns=['STT'])
         if COL_COPY_FLAG in df_new_blk.columns: df_new_blk = df_new_blk.drop(columns=[COL_COPY_FLAG])
         if '_index' in df_new_blk.columns: df_new_blk = df_new_blk.drop(columns=['_index'])
         if 'Che_Do_Ghi' in df_new_blk.columns: df_new_blk = df_new_blk.drop(columns=['Che_Do_Ghi'])
         
-        df_fin = pd.concat([df_oth, df_new_blk], ignore_index=True).astype(str).replace(['nan', 'None'], '')
-        wks.clear(); set_with_dataframe(wks, df_fin, row=1, col=1)
+        header = [str(h) for h in values[0]] if values else []
+        new_cols = [c for c in df_new_blk.columns if c not in header]
+        upsert_config_rows(sh, wks, values, positions, config_row_values(df_new_blk, header + new_cols), new_cols)
         st.toast("Saved!", icon="💾")
-    finally: release_lock(creds, uid)
+    finally: release_lock(creds, lease)
 
 def rename_block_action(old, new, creds, uid):
-    if not acquire_lock(creds, uid): return False
+    lease = acquire_lock(creds, uid, [lock_resource(st.secrets["gcp_service_account"]["history_sheet_id"], SHEET_CONFIG_NAME)])
+    if not lease: return False
     try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"]); wks = sh.worksheet(SHEET_CONFIG_NAME)
-        df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
-        df.loc[df[COL_BLOCK_NAME] == old, COL_BLOCK_NAME] = new
-        wks.clear(); set_with_dataframe(wks, df, row=1, col=1)
+        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"]); wks = get_wks_with_retry(sh, SHEET_CONFIG_NAME)
+        values = read_config_values(creds)
+        header = [str(h) for h in values[0]] if values else []
+        new_cols = [] if COL_BLOCK_NAME in header else [COL_BLOCK_NAME]
+        bi = (header + new_cols).index(COL_BLOCK_NAME)
+        positions = config_block_positions(values, old)
+        rows = [(list(values[p]) + [""] * (len(header) + len(new_cols)))[:len(header) + len(new_cols)] for p in positions]
+        for r in rows: r[bi] = new
+        upsert_config_rows(sh, wks, values, positions, rows, new_cols)
         log_user_action_buffered(creds, uid, "Đổi tên Khối", f"{old} -> {new}", force_flush=True)
         return True
-    finally: release_lock(creds, uid)
+    finally: release_lock(creds, lease)
 
 def delete_block_direct(blk, creds, uid):
-    if not acquire_lock(creds, uid): return
+    lease = acquire_lock(creds, uid, [lock_resource(st.secrets["gcp_service_account"]["history_sheet_id"], SHEET_CONFIG_NAME)])
+    if not lease: return
     try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"]); wks = sh.worksheet(SHEET_CONFIG_NAME)
-        df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str).dropna(how='all')
-        df_new = df[df[COL_BLOCK_NAME] != blk]
-        wks.clear(); set_with_dataframe(wks, df_new, row=1, col=1)
+        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"]); wks = get_wks_with_retry(sh, SHEET_CONFIG_NAME)
+        values = read_config_values(creds)
+        upsert_config_rows(sh, wks, values, config_block_positions(values, blk), [])
         log_user_action_buffered(creds, uid, "Xóa Khối", f"Đã xóa: {blk}", force_flush=True)
-    finally: release_lock(creds, uid)
+    finally: release_lock(creds, lease)
 
 def save_full_direct(df, creds, uid):
-    if not acquire_lock(creds, uid): return
+    lease = acquire_lock(creds, uid, [lock_resource(st.secrets["gcp_service_account"]["history_sheet_id"], SHEET_CONFIG_NAME)])
+    if not lease: return
     try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"]); wks = sh.worksheet(SHEET_CONFIG_NAME)
-        df = df.astype(str).replace(['nan', 'None'], '')
-        wks.clear(); set_with_dataframe(wks, df, row=1, col=1)
-    finally: release_lock(creds, uid)
+        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"]); wks = get_wks_with_retry(sh, SHEET_CONFIG_NAME)
+        values = read_config_values(creds)
+        header = [str(h) for h in values[0]] if values else []
+        new_cols = [c for c in df.columns if c not in header]
+        positions = config_row_positions(values, lambda r: any(v != "" for v in r.values()))
+        upsert_config_rows(sh, wks, values, positions, config_row_values(df, header + new_cols), new_cols)
+    finally: release_lock(creds, lease)
 
 def main_ui():
     init_log_buffer()
@@ -805,7 +1180,7 @@ def main_ui():
 
     with st.sidebar:
         if 'df_full_config' not in st.session_state: st.session_state['df_full_config'] = load_full_config(creds)
-        if st.button("🔄 Reload"): st.cache_data.clear(); st.session_state['df_full_config'] = load_full_config(creds); st.rerun()
+        if st.button("🔄 Reload"): st.cache_data.clear(); invalidate_sh_pool(); invalidate_master_snapshot(); st.session_state['df_full_config'] = load_full_config(creds); st.rerun()
         df_cfg = st.session_state['df_full_config']
         blks = df_cfg[COL_BLOCK_NAME].unique().tolist() if not df_cfg.empty else [DEFAULT_BLOCK_NAME]
         if 'target_block_display' not in st.session_state: st.session_state['target_block_display'] = blks[0]
@@ -912,6 +1287,11 @@ def main_ui():
         st.rerun()
 
     st.divider()
+    use_diff = st.toggle("⚡ Ghi kiểu Diff (chỉ ghi dòng thay đổi)", value=(WRITE_SYNC_MODE == "diff"), key="sync_mode_diff")
+    use_atomic = st.toggle("🔒 Ghi nguyên tử (lỗi giữa chừng -> đích giữ nguyên dữ liệu cũ)", value=(WRITE_SYNC_MODE == "atomic"), key="sync_mode_atomic", disabled=use_diff)
+    sync_mode = "diff" if use_diff else ("atomic" if use_atomic else "replace")
+    use_polars = st.toggle("🚀 Engine Polars (nhanh hơn với nguồn lớn)", value=(ETL_ENGINE == "polars"), key="etl_engine_polars")
+    etl_engine = "polars" if use_polars else "pandas"
     # [V75+V78] Nút chức năng nâng cấp
     c1, c2, c3, c4 = st.columns(4)
     with c1:
@@ -923,7 +1303,7 @@ def main_ui():
                     r_dict = r.to_dict(); r_dict['_index'] = i; rows.append(r_dict)
             if not rows: st.warning("Không có dòng nào để chạy."); st.stop()
             st_cont = st.status(f"🚀 Đang chạy {sel_blk}...", expanded=True)
-            ok, res, tot = process_pipeline_mixed(rows, uid, sel_blk, st_cont)
+            ok, res, tot = process_pipeline_mixed(rows, uid, sel_blk, st_cont, sync_mode, etl_engine)
             if isinstance(res, dict):
                 for i, r in edt_df.iterrows():
                     if i in res: 
@@ -949,7 +1329,7 @@ def main_ui():
                         r_dict = r.to_dict(); r_dict['_index'] = i; rows_to_run.append(r_dict)
                 if not rows_to_run:
                     main_status.write(f"⚪ {blk}: Không có dòng active. Bỏ qua."); continue
-                ok, res, tot = process_pipeline_mixed(rows_to_run, uid, blk, main_status)
+                ok, res, tot = process_pipeline_mixed(rows_to_run, uid, blk, main_status, sync_mode, etl_engine)
                 total_processed += tot
                 if isinstance(res, dict):
                     has_change = False
@@ -972,9 +1352,16 @@ def main_ui():
 
     flush_logs(creds, force=True)
     st.divider(); st.caption("Logs")
-    if st.button("Refresh Logs"): st.cache_data.clear()
-    logs = fetch_activity_logs(creds, 50)
+    lc1, lc2 = st.columns([1, 1])
+    with lc1: only_me = st.toggle("👤 Chỉ log của tôi", key="log_only_me")
+    with lc2: show_runs = st.toggle(f"📜 Lịch sử chạy khối {sel_blk}", key="log_show_runs")
+    if st.button("Refresh Logs"): st.cache_data.clear(); invalidate_master_snapshot(SHEET_ACTIVITY_NAME, SHEET_LOG_NAME)
+    logs = fetch_activity_logs(creds, 50, user=uid if only_me else None)
     if not logs.empty: st.dataframe(logs, use_container_width=True, hide_index=True)
+    if show_runs:
+        run_logs = fetch_run_logs(creds, 50, block=sel_blk)
+        if not run_logs.empty: st.dataframe(run_logs, use_container_width=True, hide_index=True)
+        else: st.caption("Chưa có lần chạy nào.")
 
 if __name__ == "__main__":
     main_ui()
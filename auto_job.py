@@ -1,17 +1,41 @@
-import pandas as pd
 import time
 import gspread
 import json
 import re
 import pytz
 import os
-import uuid
-import numpy as np
-import gc
-from gspread_dataframe import get_as_dataframe, set_with_dataframe
+import threading
+import random
+import hashlib
+import itertools
+import heapq
+import sys
+import importlib
 from datetime import datetime, timedelta
 from google.oauth2 import service_account
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sheets_api import (CircuitOpenError, reset_circuit_breaker, bind_run_context, safe_api_call, get_gspread_client,
+                        get_sh_with_retry, get_wks_map, get_wks_with_retry, add_wks_pooled, quote_sheet_title)
+from sheet_lock import lock_resource, acquire_leases, renew_lease, release_leases
+from sheet_writer import (SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, APPEND_SLICE_ROWS, PrintLog, union_columns, task_keys,
+                          iter_aligned_slices, AppendBatcher, get_rows_to_delete_dynamic, contiguous_ranges, batch_delete_rows,
+                          report_write_results, write_diff_sync, write_atomic_sync)
+
+class LazyModule:
+    """Module nặng chỉ import ở lần dùng đầu tiên: lượt chạy không có lịch (chỉ đọc sys_config) không nạp pandas/polars"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+pd = LazyModule("pandas")
+pl = LazyModule("polars")
+gspread_dataframe = LazyModule("gspread_dataframe")
+smart_filter = LazyModule("smart_filter")
 
 # ==========================================
 # 1. CẤU HÌNH & CONSTANTS
@@ -20,7 +44,8 @@ SHEET_CONFIG_NAME = "luu_cau_hinh"
 SHEET_SYS_CONFIG = "sys_config"
 SHEET_LOG_NAME = "log_lanthucthi"
 SHEET_ACTIVITY_NAME = "log_hanh_vi"
-SHEET_LOCK_NAME = "sys_lock"
+SHEET_SOURCE_LEDGER = "sys_source_ledger"
+SHEET_SCHED_LEDGER = "sys_schedule_ledger"
 
 COL_BLOCK_NAME = "Block_Name"
 COL_STATUS = "Trạng thái"
@@ -38,15 +63,66 @@ SCHED_COL_TYPE = "Loai_Lich"
 SCHED_COL_VAL1 = "Thong_So_Chinh" # Giờ (08:00) hoặc Số phút (50)
 SCHED_COL_VAL2 = "Thong_So_Phu"   # Ngày (4,8) hoặc Thứ (T2,T3)
 
-SYS_COL_LINK = "Link file nguồn"
-SYS_COL_SHEET = "Sheet nguồn"
-SYS_COL_MONTH = "Tháng"
-
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
 # Khoảng thời gian nhìn lại (phút) để bắt dính lịch khi GitHub bị trễ
 LOOKBACK_MINUTES = 18 
 
+# Ledger lịch (SHEET_SCHED_LEDGER): mỗi mốc lịch chỉ chạy đúng 1 lần; mốc bị lỡ (GitHub bỏ/trễ run) được chạy bù
+# nếu chưa quá SCHEDULE_CATCHUP_HOURS giờ, quá hạn thì bỏ qua. Mốc được đánh dấu đang chạy (Started_Slot) trước khi
+# chạy và chỉ ghi vào Last_Slot khi chạy xong; lượt bị dừng giữa chừng quá SCHEDULE_RUN_TIMEOUT_MINUTES phút thì chạy lại
+SCHED_LEDGER_COLS = ["Slot_Key", "Block_Name", "Last_Slot", "Updated_At", "Decision", "Started_Slot", "Started_At"]
+SCHED_SLOT_FMT = "%d/%m/%Y %H:%M"
+SCHEDULE_CATCHUP_HOURS = float(os.environ.get("SCHEDULE_CATCHUP_HOURS", "6"))
+SCHEDULE_RUN_TIMEOUT_MINUTES = float(os.environ.get("SCHEDULE_RUN_TIMEOUT_MINUTES", "120"))
+SCHED_LEDGER_LOCK_RETRIES = 3
+
+# Log xoay vòng theo tháng: ghi vào tab <log>_YYYY_MM của tháng hiện tại; khi sang tháng mới, tab cũ hơn
+# LOG_RETENTION_MONTHS tháng được chép sang file LOG_ARCHIVE_SHEET_ID (nếu có) rồi xóa khỏi Sheet Master
+LOG_PARTITION_FMT = "%Y_%m"
+LOG_RETENTION_MONTHS = int(os.environ.get("LOG_RETENTION_MONTHS", "6"))
+LOG_ARCHIVE_SHEET_ID = os.environ.get("LOG_ARCHIVE_SHEET_ID", "")
+LOG_RUN_HEADER = ["Thời gian", "Vùng lấy", "Tháng", "User", "Link Nguồn", "Link Đích", "Sheet Đích", "Sheet Nguồn", "Kết Quả", "Số Dòng", "Range", "Block"]
+LOG_ACT_HEADER = ["Thời gian", "Người dùng", "Hành vi", "Trạng thái"]
+
+# Daemon (--daemon): chu kỳ (giây) kiểm tra các tab cấu hình của Sheet Master có đổi không
+DAEMON_POLL_SECONDS = int(os.environ.get("DAEMON_POLL_SECONDS", "60"))
+VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Chế độ ghi đích: "replace" = xóa hết dòng cùng key rồi ghi lại, "diff" = chỉ ghi dòng thay đổi (so hash),
+# "atomic" = như replace nhưng dữ liệu mới ghi trước xuống dưới, header + xóa dòng cũ trong 1 batchUpdate (đích hoặc toàn cũ, hoặc toàn mới)
+WRITE_SYNC_MODE = os.environ.get("WRITE_SYNC_MODE", "replace")
+JOB_LOG = PrintLog()  # log_container của các hàm ghi dùng chung (sheet_writer.py)
+
+# Bỏ qua nguồn không đổi (so modifiedTime/version trên Drive với ledger ở SHEET_SOURCE_LEDGER)
+SKIP_UNCHANGED_SOURCES = os.environ.get("SKIP_UNCHANGED_SOURCES", "1") == "1"
+LEDGER_COLS = ["Row_Key", "Source_ID", "Source_Version", "Updated_At", "Content_Hash"]
+LEDGER_RETENTION_DAYS = 30
+STATUS_SKIPPED = "Bỏ qua (nguồn không đổi)"
+STATUS_LOCKED = "Bỏ qua (đích đang bị khóa)"
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files/"
+
+# Snapshot cache nguồn trên đĩa (Parquet), giữ qua các lần chạy GitHub Actions bằng actions/cache
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_CACHE_DIR", os.path.join(".cache", "snapshots"))
+SNAPSHOT_CACHE_ENABLED = os.environ.get("SNAPSHOT_CACHE", "1") == "1"
+SNAPSHOT_MAX_BYTES = int(os.environ.get("SNAPSHOT_MAX_MB", "500")) * 1024 * 1024
+SNAPSHOT_MAX_AGE_DAYS = 7
+STATUS_SAME_CONTENT = "Bỏ qua (nội dung không đổi)"
+
+# Engine biến đổi dữ liệu nguồn: "pandas" (mặc định) hoặc "polars" (lazy, đa luồng)
+ETL_ENGINE = os.environ.get("ETL_ENGINE", "pandas")
+NULL_LIKE_VALUES = ['nan', 'None', '<NA>', 'null']
+
+# Tab nguồn có nhiều dòng hơn ngưỡng này (theo lưới sheet) được đọc theo trang STREAM_PAGE_ROWS dòng
+# và biến đổi/ghi từng trang -> bộ nhớ tối đa ~ 1 trang thay vì cả tab
+STREAM_PAGE_ROWS = int(os.environ.get("STREAM_PAGE_ROWS", "50000"))
+
+# Số luồng tải nguồn song song cho mỗi nhóm đích (override bằng env FETCH_MAX_WORKERS)
+FETCH_MAX_WORKERS = int(os.environ.get("FETCH_MAX_WORKERS", "4"))
+
+# Số nhóm đích chạy song song trong 1 lượt (các nhóm ghi cùng file + tab đích luôn chạy nối tiếp)
+BLOCK_MAX_WORKERS = int(os.environ.get("BLOCK_MAX_WORKERS", "3"))
+
 # ==========================================
 # 2. CORE UTILS (SERVER SIDE)
 # ==========================================
@@ -75,26 +151,68 @@ def get_history_sheet_id():
     if extracted: return extracted
     return raw_id
 
-def safe_api_call(func, *args, **kwargs):
-    max_retries = 5
-    for i in range(max_retries):
+# --- LOG XOAY VÒNG THEO THÁNG ---
+def log_partition_title(base, now):
+    return f"{base}_{now.strftime(LOG_PARTITION_FMT)}"
+
+def log_partition_month(base, title):
+    """Tab phân vùng của base -> số tháng (năm*12 + tháng) để so sánh; tab khác (kể cả tab log cũ chưa chia) -> None"""
+    m = re.fullmatch(re.escape(base) + r"_(\d{4})_(\d{2})", title)
+    return int(m.group(1)) * 12 + int(m.group(2)) if m else None
+
+# Lỗi API/mạng khi lưu trữ log: ghi vào tab log hoạt động, không làm hỏng lần ghi log đang chạy
+LOG_ARCHIVE_ERRORS = (gspread.exceptions.GSpreadException, CircuitOpenError, OSError)
+
+def archive_log_partitions(creds, sh, base, now):
+    """Phân vùng cũ hơn LOG_RETENTION_MONTHS: chép sang file lưu trữ (nếu cấu hình) rồi xóa khỏi Sheet Master.
+    Tab đã có trong file lưu trữ (lần trước chép xong nhưng chưa xóa) thì không chép lại; đổi tên bản chép lỗi thì
+    xóa bản "Copy of ..." vừa tạo và giữ tab gốc cho lần sau. Trả về các dòng log hoạt động của phân vùng bị lỗi."""
+    keep_from = now.year * 12 + now.month - LOG_RETENTION_MONTHS + 1
+    stamp = now.strftime("%d/%m/%Y %H:%M:%S")
+    errors, arch, arch_titles = [], None, set()
+    wks_map = get_wks_map(sh)
+    for title, wks in list(wks_map.items()):
+        month = log_partition_month(base, title)
+        if month is None or month >= keep_from: continue
         try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            error_str = str(e).lower()
-            if "429" in error_str or "quota" in error_str:
-                wait_time = (2 ** i) + 5
-                print(f"⚠️ Quota exceeded. Waiting {wait_time}s...")
-                time.sleep(wait_time)
-            elif i == max_retries - 1: raise e
-            else: time.sleep(2)
-    return None
+            if LOG_ARCHIVE_SHEET_ID:
+                if arch is None:
+                    arch = get_sh_with_retry(creds, LOG_ARCHIVE_SHEET_ID)
+                    if arch is None: raise gspread.SpreadsheetNotFound(LOG_ARCHIVE_SHEET_ID)
+                    arch_titles = {w.title for w in safe_api_call(arch.worksheets)}
+                if title not in arch_titles:
+                    copied = safe_api_call(wks.copy_to, LOG_ARCHIVE_SHEET_ID)
+                    try:
+                        safe_api_call(arch.batch_update, {"requests": [{"updateSheetProperties": {
+                            "properties": {"sheetId": copied["sheetId"], "title": title}, "fields": "title"}}]})
+                    except LOG_ARCHIVE_ERRORS:
+                        try: safe_api_call(arch.batch_update, {"requests": [{"deleteSheet": {"sheetId": copied["sheetId"]}}]})
+                        except LOG_ARCHIVE_ERRORS as e:
+                            errors.append([stamp, "AUTO_BOT", "Lưu trữ log lỗi", f"{title}: không xóa được bản chép thừa {copied.get('title', '')}: {str(e)[:200]}"])
+                        raise
+                    arch_titles.add(title)
+            safe_api_call(sh.del_worksheet, wks)
+            wks_map.pop(title, None)
+            print(f"🗄️ Đã lưu trữ log {title}")
+        except LOG_ARCHIVE_ERRORS as e:
+            print(f"⚠️ Không lưu trữ được log {title}: {e}")
+            errors.append([stamp, "AUTO_BOT", "Lưu trữ log lỗi", f"{title}: {str(e)[:200]}"])
+    return errors
 
-def get_sh_with_retry(creds, sheet_id):
-    gc_client = gspread.authorize(creds)
-    masked_id = sheet_id[:5] + "..." + sheet_id[-5:] if sheet_id and len(sheet_id) > 10 else "N/A"
-    print(f"🔗 Connecting to Master Sheet ID: {masked_id}")
-    return safe_api_call(gc_client.open_by_key, sheet_id)
+def get_log_partition(creds, sh, base, header, now):
+    """Tab log của tháng hiện tại (tạo + xoay vòng khi sang tháng mới). Chỉ tra tên trong pool metadata, không đọc tab cũ"""
+    title = log_partition_title(base, now)
+    try: return get_wks_with_retry(sh, title)
+    except gspread.WorksheetNotFound: pass
+    wks = add_wks_pooled(sh, title, rows=1000, cols=len(header))
+    safe_api_call(wks.update, range_name="A1", values=[header])
+    errors = archive_log_partitions(creds, sh, base, now)
+    if errors:
+        try:
+            act = wks if base == SHEET_ACTIVITY_NAME else get_log_partition(creds, sh, SHEET_ACTIVITY_NAME, LOG_ACT_HEADER, now)
+            safe_api_call(act.append_rows, errors)
+        except LOG_ARCHIVE_ERRORS as e: print(f"⚠️ Không ghi được log lưu trữ: {e}")
+    return wks
 
 def extract_id(url):
     if not isinstance(url, str): return None
@@ -114,53 +232,108 @@ def col_name_to_index(col_name):
 # ==========================================
 # 3. LOGIC SMART FILTER & ETL
 # ==========================================
-def apply_smart_filter(df, filter_str):
-    if not filter_str or str(filter_str).strip().lower() in ['nan', 'none', 'null', '']:
-        return df, None
-    fs = filter_str.strip()
-    operators = [" contains ", "==", "!=", ">=", "<=", ">", "<", "="]
-    selected_op = None
-    for op in operators:
-        if op in fs: selected_op = op; break
-    if not selected_op: return None, f"Lỗi cú pháp: Không tìm thấy toán tử trong '{fs}'"
-
-    parts = fs.split(selected_op, 1)
-    user_col = parts[0].strip().replace("`", "").replace("'", "").replace('"', "")
-    real_col_name = None
-    if user_col in df.columns: real_col_name = user_col
-    else:
-        for col in df.columns:
-            if str(col).strip() == user_col: real_col_name = col; break
-    if not real_col_name: return None, f"Không tìm thấy cột '{user_col}'"
+def make_unique_headers(header_row):
+    """Đổi tên cột trùng: A, A -> A, A_1"""
+    unique_headers = []
+    seen = {}
+    for col in header_row:
+        if col in seen:
+            seen[col] += 1
+            unique_headers.append(f"{col}_{seen[col]}")
+        else:
+            seen[col] = 0
+            unique_headers.append(col)
+    return unique_headers
+
+# --- [POLARS] ENGINE BIẾN ĐỔI ---
+def transform_source_polars(data, plan, raw_filter, include_header, link_src, source_label, month_val):
+    """Cùng phép biến đổi như nhánh pandas của fetch_data nhưng chạy bằng Polars (lazy, đa luồng).
+    Trả về (df pandas, msg); None nếu trường hợp này phải để pandas xử lý (không có header, tên cột trùng, dòng lệch cột)."""
+    out_names = [name for _, name in plan]
+    if not data[0] or not out_names or len(set(out_names)) != len(out_names): return None
 
-    user_val = parts[1].strip()
-    if (user_val.startswith("'") and user_val.endswith("'")) or (user_val.startswith('"') and user_val.endswith('"')):
-        clean_val = user_val[1:-1]
-    else: clean_val = user_val
+    # Dựng 1 Series phẳng rồi tách cột bằng gather (chạy trong Rust), nhanh hơn hẳn zip(*rows) bên Python
+    n_rows = len(data) - 1; width = len(data[0])
+    flat = pl.Series("v", list(itertools.chain.from_iterable(data[1:])), dtype=pl.Utf8)
+    if len(flat) != n_rows * width: return None  # dòng không đều cột -> để pandas xử lý
+    df = pl.select(pl.lit(flat).gather(pl.int_range(i, n_rows * width, width)).alias(name) for i, name in plan) if n_rows else \
+        pl.DataFrame(schema={name: pl.Utf8 for name in out_names})
 
+    if raw_filter:
+        df, err = smart_filter.apply_smart_filter_polars(df, raw_filter)
+        if err: return None, f"Filter Error: {err}"
+
+    lf = df.lazy()
+    if include_header:
+        lf = pl.concat([pl.select(pl.lit(name, dtype=pl.Utf8).alias(name) for name in out_names).lazy(), lf])
+    lf = lf.with_columns(pl.all().fill_null("").replace(NULL_LIKE_VALUES, "")).with_columns(
+        pl.lit(link_src.strip()).alias(SYS_COL_LINK),
+        pl.lit(source_label.strip()).alias(SYS_COL_SHEET),
+        pl.lit(month_val.strip()).alias(SYS_COL_MONTH),
+    )
+    return lf.collect().to_arrow().to_pandas(), "OK"
+
+def get_data_range_str(row_config):
+    raw_range = str(row_config.get(COL_DATA_RANGE, '')).strip()
+    return "Lấy hết" if raw_range.lower() in ['nan', 'none', 'null', '', 'lấy hết'] else raw_range
+
+def parse_col_range(data_range_str):
+    """'B:F' -> (1, 5); None nếu lấy hết / không hợp lệ"""
+    if data_range_str == "Lấy hết" or ":" not in data_range_str: return None
     try:
-        col_str = df[real_col_name].astype(str)
-        if selected_op == " contains ": return df[col_str.str.contains(clean_val, case=False, na=False)], None
-        elif selected_op in ["=", "=="]: return df[col_str == str(clean_val)], None
-        elif selected_op == "!=": return df[col_str != str(clean_val)], None
-        else:
-            numeric_col = pd.to_numeric(df[real_col_name], errors='coerce')
-            try: numeric_val = float(clean_val)
-            except: return None, f"Giá trị '{clean_val}' không phải là số"
-            if selected_op == ">": return df[numeric_col > numeric_val], None
-            if selected_op == "<": return df[numeric_col < numeric_val], None
-            if selected_op == ">=": return df[numeric_col >= numeric_val], None
-            if selected_op == "<=": return df[numeric_col <= numeric_val], None
-    except Exception as e: return None, f"Lỗi thực thi lọc: {str(e)}"
-    return df, None
-
-def fetch_data(row_config, creds, target_headers=None):
+        s_str, e_str = data_range_str.split(":")
+        s_idx = col_name_to_index(s_str.strip()); e_idx = col_name_to_index(e_str.strip())
+        return (s_idx, e_idx) if s_idx >= 0 else None
+    except: return None
+
+def source_read_window(row_config):
+    """Vùng cần đọc của 1 dòng cấu hình: (cột đầu, cột cuối, dòng đầu, dòng cuối) - cột tính từ 0, dòng là số dòng
+    trên sheet của phần thân (header luôn là dòng 1), None = không giới hạn. None nếu phải đọc cả tab."""
+    col_range = parse_col_range(get_data_range_str(row_config))
+    if not col_range or col_range[1] < col_range[0]: return None
+    return (col_range[0], col_range[1], None, None)
+
+def source_read_ranges(title, window):
+    """(range header, range dữ liệu) A1 cho 1 lần đọc; đọc cả tab thì range header = None.
+    window có cột đầu/cuối = None nghĩa là mọi cột (chỉ giới hạn dòng, dùng cho đọc theo trang)."""
+    if window is None: return None, quote_sheet_title(title)
+    c0, c1, r0, r1 = window
+    if c0 is None:
+        if not r1: return None, quote_sheet_title(title)
+        return f"{quote_sheet_title(title)}!1:1", f"{quote_sheet_title(title)}!{r0 or 2}:{r1}"
+    col_a = gspread.utils.rowcol_to_a1(1, c0 + 1).rstrip("0123456789")
+    col_b = gspread.utils.rowcol_to_a1(1, c1 + 1).rstrip("0123456789")
+    return f"{quote_sheet_title(title)}!1:1", f"{quote_sheet_title(title)}!{col_a}{r0 or 2}:{col_b}{r1 or ''}"
+
+def assemble_source_values(data_values, header_values=None, window=None):
+    """Kết quả batchGet -> (data, header_prefix). data giống get_all_values (dòng 0 là header, pad đều cột) nhưng
+    chỉ gồm các cột trong vùng đọc; header_prefix là các ô header nằm trước vùng (để đặt tên cột trùng như đọc cả tab)."""
+    if window is None: return gspread.utils.fill_gaps(data_values or [[]]), []
+    c0, c1 = window[0], window[1]
+    header_full = (header_values or [[]])[0]
+    if c0 is None: return gspread.utils.fill_gaps([list(header_full)] + list(data_values or [])), []
+    header_prefix = (list(header_full[:c0]) + [''] * c0)[:c0]
+    return gspread.utils.fill_gaps([list(header_full[c0:c1 + 1])] + list(data_values or [])), header_prefix
+
+def plan_source_columns(header_row, target_headers=None, data_range_str="Lấy hết", header_prefix=None):
+    """[(vị trí cột trong data, tên cột đầu ra)]: đổi tên theo header đích (theo vị trí) rồi cắt Vùng lấy dữ liệu.
+    Vị trí/tên tính trên cả tab nên đọc cả tab hay chỉ đọc vùng (header_prefix) đều ra cùng kết quả."""
+    header_prefix = header_prefix or []
+    offset = len(header_prefix)
+    names = make_unique_headers(list(header_prefix) + list(header_row))
+    if target_headers:
+        names = [target_headers[p] if p < len(target_headers) else n for p, n in enumerate(names)][:len(target_headers)]
+    positions = list(range(len(names)))
+    col_range = parse_col_range(data_range_str)
+    if col_range: positions = positions[col_range[0] : col_range[1] + 1]
+    return [(p - offset, names[p]) for p in positions if p >= offset]
+
+def fetch_data(row_config, creds, target_headers=None, data=None, engine=ETL_ENGINE, header_prefix=None):
     link_src = str(row_config.get(COL_SRC_LINK, '')).strip()
     source_label = str(row_config.get(COL_SRC_SHEET, '')).strip()
     month_val = str(row_config.get(COL_MONTH, ''))
     
-    raw_range = str(row_config.get(COL_DATA_RANGE, '')).strip()
-    data_range_str = "Lấy hết" if raw_range.lower() in ['nan', 'none', 'null', '', 'lấy hết'] else raw_range
+    data_range_str = get_data_range_str(row_config)
 
     raw_filter = str(row_config.get(COL_FILTER, '')).strip()
     if raw_filter.lower() in ['nan', 'none', 'null']: raw_filter = ""
@@ -170,43 +343,27 @@ def fetch_data(row_config, creds, target_headers=None):
     if not sheet_id: return None, "Link lỗi"
     
     try:
-        sh_source = get_sh_with_retry(creds, sheet_id)
-        wks_source = sh_source.worksheet(source_label) if source_label else sh_source.sheet1
-        data = safe_api_call(wks_source.get_all_values)
+        if data is None:
+            # Đọc lẻ 1 dòng (luồng batch đã đọc sẵn thì truyền data vào)
+            data, err, _, header_prefix = read_source_batch(creds, sheet_id, [row_config])[0]
+            if err: return None, err
+            if not isinstance(data, list):  # tab lớn -> đọc theo trang rồi gộp
+                try: return pd.concat(list(fetch_data_stream(row_config, creds, target_headers, data, engine)), ignore_index=True), "OK"
+                except RuntimeError as e: return None, str(e)
         if not data: return pd.DataFrame(), "Sheet trắng"
 
-        header_row = data[0]
-        body_rows = data[1:]
-        
-        unique_headers = []
-        seen = {}
-        for col in header_row:
-            if col in seen:
-                seen[col] += 1
-                unique_headers.append(f"{col}_{seen[col]}")
-            else:
-                seen[col] = 0
-                unique_headers.append(col)
-        
-        df_working = pd.DataFrame(body_rows, columns=unique_headers)
-
-        if target_headers:
-            num_src = len(df_working.columns); num_tgt = len(target_headers)
-            min_cols = min(num_src, num_tgt)
-            old_cols = df_working.columns.tolist()
-            rename_map = {old_cols[i]: target_headers[i] for i in range(min_cols)}
-            df_working = df_working.rename(columns=rename_map)
-            if num_src > num_tgt: df_working = df_working.iloc[:, :num_tgt]
-
-        if data_range_str != "Lấy hết" and ":" in data_range_str:
-            try:
-                s_str, e_str = data_range_str.split(":")
-                s_idx = col_name_to_index(s_str.strip()); e_idx = col_name_to_index(e_str.strip())
-                if s_idx >= 0: df_working = df_working.iloc[:, s_idx : e_idx + 1]
-            except: pass
+        # data có thể chỉ là vùng cột đã đọc (header_prefix = các ô header trước vùng)
+        plan = plan_source_columns(data[0], target_headers, data_range_str, header_prefix)
+
+        if engine == "polars":
+            res = transform_source_polars(data, plan, raw_filter, include_header, link_src, source_label, month_val)
+            if res is not None: return res
+
+        df_working = pd.DataFrame(data[1:], columns=range(len(data[0]))).iloc[:, [i for i, _ in plan]]
+        df_working.columns = [name for _, name in plan]
 
         if raw_filter:
-            df_filtered, err = apply_smart_filter(df_working, raw_filter)
+            df_filtered, err = smart_filter.apply_smart_filter(df_working, raw_filter)
             if err: return None, f"Filter Error: {err}"
             df_working = df_filtered
 
@@ -216,7 +373,7 @@ def fetch_data(row_config, creds, target_headers=None):
         else:
             df_final = df_working
 
-        df_final = df_final.astype(str).replace(['nan', 'None', '<NA>', 'null'], '')
+        df_final = df_final.astype(str).replace(NULL_LIKE_VALUES, '')
         df_final[SYS_COL_LINK] = link_src.strip()
         df_final[SYS_COL_SHEET] = source_label.strip()
         df_final[SYS_COL_MONTH] = month_val.strip()
@@ -225,62 +382,228 @@ def fetch_data(row_config, creds, target_headers=None):
 
     except Exception as e: return None, f"Lỗi tải: {str(e)}"
 
-def get_rows_to_delete_dynamic(wks, keys_to_delete):
-    all_values = safe_api_call(wks.get_all_values)
-    if not all_values: return []
-    headers = all_values[0]
+def fetch_data_stream(row_config, creds, target_headers, pages, engine=ETL_ENGINE):
+    """Biến đổi + lọc nguồn đọc theo trang (stream_source_pages): yield 1 DataFrame / trang. Lỗi -> RuntimeError"""
+    cfg = dict(row_config)
+    for data, header_prefix in pages:
+        df, msg = fetch_data(cfg, creds, target_headers, data=data, engine=engine, header_prefix=header_prefix)
+        if df is None: raise RuntimeError(msg)
+        cfg[COL_HEADER] = 'FALSE'  # dòng tiêu đề chỉ chèn ở trang đầu
+        yield df
+
+def read_source_batch(creds, sheet_id, row_configs, version=None):
+    """Đọc tất cả tab cần cho các dòng cùng 1 file nguồn bằng 1 lần values:batchGet.
+    Dòng có Vùng lấy dữ liệu (VD A:F) chỉ đọc đúng các cột đó (+ dòng header), không tải cả tab.
+    Vùng nào có snapshot trên đĩa cùng `version` (Drive) thì đọc từ đĩa, không gọi API.
+    Tab lớn hơn STREAM_PAGE_ROWS dòng không đọc ở đây: data là generator các trang (stream_source_pages, chưa đọc).
+    Trả về [(data, lỗi, content_hash, header_prefix)] theo thứ tự row_configs (xem assemble_source_values)."""
+    reads = [(str(r.get(COL_SRC_SHEET, '')).strip(), source_read_window(r)) for r in row_configs]
+    cached = {}
+    for label, window in dict.fromkeys(reads):
+        snap = load_snapshot(sheet_id, label, version, range_spec=window_spec(window))
+        if snap is not None: cached[(label, window)] = snap
+
+    missing = [key for key in dict.fromkeys(reads) if key not in cached]
+    fetched, paged, not_found = {}, {}, set()
+    if missing:
+        sh = get_sh_with_retry(creds, sheet_id)
+        wks_map = get_wks_map(sh)
+        ranges = {}
+        for label, window in missing:
+            if label and label not in wks_map: wks_map = get_wks_map(sh, refresh=True)
+            if label and label not in wks_map: not_found.add(label); continue
+            title = label or next(iter(wks_map))
+            if wks_map[title].row_count - 1 > STREAM_PAGE_ROWS: paged[(label, window)] = (title, wks_map[title].row_count); continue
+            ranges[(label, window)] = source_read_ranges(title, window)
+        req = list(dict.fromkeys(rng for pair in ranges.values() for rng in pair if rng))
+        if req:
+            resp = safe_api_call(sh.values_batch_get, req)
+            values_by_range = {rng: vr.get("values", []) for rng, vr in zip(req, resp.get("valueRanges", []))}
+            for (label, window), (header_rng, data_rng) in ranges.items():
+                values, header_prefix = assemble_source_values(values_by_range.get(data_rng), values_by_range.get(header_rng), window)
+                content_hash = values_content_hash([header_prefix] + values if header_prefix else values)
+                save_snapshot(sheet_id, label, version, values, content_hash, range_spec=window_spec(window), header_prefix=header_prefix)
+                fetched[(label, window)] = (values, content_hash, header_prefix)
+
+    out = []
+    for label, window in reads:
+        if label in not_found: out.append((None, f"404 Sheet: {label}", None, None))
+        elif (label, window) in paged:
+            title, row_count = paged[(label, window)]
+            out.append((stream_source_pages(creds, sheet_id, title, window, row_count), None, None, []))
+        else:
+            values, content_hash, header_prefix = cached.get((label, window)) or fetched.get((label, window), (None, None, None))
+            out.append((values, None, content_hash, header_prefix))
+    return out
+
+def stream_source_pages(creds, sheet_id, title, window, row_count, page_rows=STREAM_PAGE_ROWS):
+    """Đọc 1 tab lớn theo từng cửa sổ page_rows dòng thay vì 1 lần get_all_values.
+    Yield (data, header_prefix) như read_source_batch cho từng trang (data[0] luôn là dòng header).
+    Dòng trống giữa sheet được giữ nguyên, dòng trống cuối sheet bị bỏ - giống đọc cả tab."""
+    sh = get_sh_with_retry(creds, sheet_id)
+    c0, c1 = (window[0], window[1]) if window else (None, None)
+    header_values, pending_blank, yielded = None, 0, False
+    r0 = 2
+    while True:
+        r1 = r0 + page_rows - 1
+        header_rng, data_rng = source_read_ranges(title, (c0, c1, r0, r1))
+        ranges = [data_rng] + ([header_rng] if header_values is None else [])
+        resp = safe_api_call(sh.values_batch_get, ranges).get("valueRanges", [])
+        body = resp[0].get("values", []) if resp else []
+        if header_values is None: header_values = resp[1].get("values", []) if len(resp) > 1 else []
+        if body:
+            data, header_prefix = assemble_source_values([[]] * pending_blank + body, header_values, (c0, c1, None, None))
+            yield data, header_prefix
+            yielded = True
+        pending_blank = (pending_blank if not body else 0) + page_rows - len(body)
+        if r1 >= row_count and len(body) < page_rows: break
+        r0 = r1 + 1
+    if not yielded: yield assemble_source_values([], header_values, (c0, c1, None, None))
+
+def is_source_stream(df):
+    """Nguồn lớn được đọc theo trang: df là generator các DataFrame thay vì 1 DataFrame"""
+    return df is not None and not isinstance(df, pd.DataFrame)
+
+def open_task_streams(tasks_list, materialize=False):
+    """tasks -> ([(chunk đầu, phần còn lại | None, src, r_idx)] giữ đúng thứ tự tasks, {r_idx: lỗi}).
+    Nguồn thường: chunk đầu là cả DataFrame, phần còn lại None.
+    Đọc trước tới chunk có dữ liệu đầu tiên của mỗi nguồn đọc theo trang để lỗi đọc lộ ra TRƯỚC khi xóa dữ liệu cũ.
+    materialize=True (chế độ diff) thì gom hết trang thành 1 DataFrame."""
+    opened, failed = [], {}
+    for df, src, r_idx in tasks_list:
+        if not is_source_stream(df): opened.append((df, None, src, r_idx)); continue
+        try:
+            if materialize:
+                opened.append((pd.concat(list(df), ignore_index=True), None, src, r_idx)); continue
+            it = iter(df); first = next(it, None)
+            while first is not None and first.empty:
+                nxt = next(it, None)
+                if nxt is None: break
+                first = nxt
+            if first is not None: opened.append((first, it, src, r_idx))
+        except Exception as e: failed[r_idx] = str(e)
+    return opened, failed
+
+def window_spec(window):
+    """Khóa snapshot cho 1 vùng đọc ("" = cả tab)"""
+    return "" if window is None else ",".join("" if v is None else str(v) for v in window)
+
+def fetch_group_concurrent(rows, creds, target_headers=None, max_workers=FETCH_MAX_WORKERS, versions=None, known_hashes=None, engine=ETL_ENGINE):
+    """Tải song song các nguồn của 1 nhóm đích: mỗi file nguồn là 1 tác vụ (1 batchGet cho mọi tab cần),
+    tối đa max_workers file cùng lúc. Trả về (df, msg, content_hash) theo đúng thứ tự rows.
+    Dòng có content_hash trùng known_hashes (lần ghi thành công trước) -> không biến đổi, msg = STATUS_SAME_CONTENT."""
+    versions = versions or [None] * len(rows)
+    known_hashes = known_hashes or [None] * len(rows)
+    by_sheet = defaultdict(list)
+    for pos, r in enumerate(rows): by_sheet[extract_id(str(r.get(COL_SRC_LINK, '')).strip())].append(pos)
+
+    def _fetch_sheet(sid, positions):
+        sub_rows = [rows[p] for p in positions]
+        if not sid: return [(None, "Link lỗi", None)] * len(sub_rows)
+        try: batch = read_source_batch(creds, sid, sub_rows, version=versions[positions[0]])
+        except Exception as e: return [(None, f"Lỗi tải: {str(e)}", None)] * len(sub_rows)
+        res = []
+        for p, r, (data, err, content_hash, header_prefix) in zip(positions, sub_rows, batch):
+            if err: res.append((None, err, None))
+            elif not isinstance(data, list): res.append((fetch_data_stream(r, creds, target_headers, data, engine), "OK", None))
+            elif content_hash and content_hash == known_hashes[p]: res.append((None, STATUS_SAME_CONTENT, content_hash))
+            else: res.append(fetch_data(r, creds, target_headers, data=data, engine=engine, header_prefix=header_prefix) + (content_hash,))
+        return res
+
+    if not rows: return
+    slot = {p: (sid, k) for sid, positions in by_sheet.items() for k, p in enumerate(positions)}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(by_sheet)))) as ex:
+        fetch_sheet = bind_run_context(_fetch_sheet)
+        futs = {sid: ex.submit(fetch_sheet, sid, positions) for sid, positions in by_sheet.items()}
+        for p in range(len(rows)):
+            sid, k = slot[p]
+            yield futs[sid].result()[k]
+
+# --- SNAPSHOT CACHE TRÊN ĐĨA (PARQUET) ---
+def values_content_hash(values):
+    """Hash nội dung thô của 1 tab (list of lists)"""
+    h = hashlib.blake2b(digest_size=16)
+    for row in values: h.update("\x1f".join(row).encode("utf-8")); h.update(b"\x1e")
+    return h.hexdigest()
+
+def _snapshot_base(sheet_id, label, range_spec=""):
+    name = hashlib.blake2b(f"{sheet_id}\x1f{label}\x1f{range_spec}".encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(SNAPSHOT_DIR, name)
+
+def load_snapshot(sheet_id, label, version, range_spec=""):
+    """(values, content_hash, header_prefix) nếu có snapshot đúng version Drive, ngược lại None"""
+    if not SNAPSHOT_CACHE_ENABLED or not version: return None
+    base = _snapshot_base(sheet_id, label, range_spec)
     try:
-        idx_link = headers.index(SYS_COL_LINK); idx_sheet = headers.index(SYS_COL_SHEET); idx_month = headers.index(SYS_COL_MONTH)
-    except ValueError: return [] 
-    rows_to_delete = []
-    for i, row in enumerate(all_values[1:], start=2): 
-        l = row[idx_link].strip() if len(row) > idx_link else ""
-        s = row[idx_sheet].strip() if len(row) > idx_sheet else ""
-        m = row[idx_month].strip() if len(row) > idx_month else ""
-        if (l, s, m) in keys_to_delete: rows_to_delete.append(i)
-    return rows_to_delete
-
-def batch_delete_rows(sh, sheet_id, row_indices):
-    if not row_indices: return
-    row_indices.sort(reverse=True)
-    ranges = []
-    if len(row_indices) > 0:
-        start = row_indices[0]; end = start
-        for r in row_indices[1:]:
-            if r == start - 1: start = r
-            else: ranges.append((start, end)); start = r; end = r
-        ranges.append((start, end))
-    requests = []
-    for start, end in ranges:
-        requests.append({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}}})
-    batch_size = 100
-    for i in range(0, len(requests), batch_size):
-        safe_api_call(sh.batch_update, {'requests': requests[i:i+batch_size]})
-        time.sleep(1)
-
-def write_data(tasks_list, target_link, target_sheet_name, creds):
+        with open(base + ".json", encoding="utf-8") as f: meta = json.load(f)
+        if meta.get("version") != version: return None
+        values = pd.read_parquet(base + ".parquet").values.tolist()
+        os.utime(base + ".json")
+        return values, meta["content_hash"], meta.get("header_prefix", [])
+    except (OSError, ValueError, KeyError, ImportError): return None
+
+def save_snapshot(sheet_id, label, version, values, content_hash, range_spec="", header_prefix=None):
+    if not SNAPSHOT_CACHE_ENABLED or not version or not values or not values[0]: return
+    base = _snapshot_base(sheet_id, label, range_spec)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        df = pd.DataFrame(values, columns=[f"c{i}" for i in range(len(values[0]))])
+        df.to_parquet(base + f".parquet.{threading.get_ident()}.tmp", index=False)
+        os.replace(base + f".parquet.{threading.get_ident()}.tmp", base + ".parquet")
+        meta = {"sheet_id": sheet_id, "label": label, "range": range_spec, "version": version,
+                "content_hash": content_hash, "header_prefix": header_prefix or [], "rows": len(values), "saved_at": time.time()}
+        with open(base + f".json.{threading.get_ident()}.tmp", "w", encoding="utf-8") as f: json.dump(meta, f, ensure_ascii=False)
+        os.replace(base + f".json.{threading.get_ident()}.tmp", base + ".json")
+    except (OSError, ValueError, ImportError) as e:
+        print(f"  ⚠️ Không lưu được snapshot: {str(e)[:80]}")
+
+def evict_snapshots():
+    """Xóa snapshot quá SNAPSHOT_MAX_AGE_DAYS, rồi xóa cũ nhất (theo lần dùng cuối) tới khi dưới SNAPSHOT_MAX_BYTES"""
+    if not os.path.isdir(SNAPSHOT_DIR): return
+    entries = []
+    for name in os.listdir(SNAPSHOT_DIR):
+        if not name.endswith(".json"): continue
+        base = os.path.join(SNAPSHOT_DIR, name[:-5])
+        try:
+            size = os.path.getsize(base + ".json") + (os.path.getsize(base + ".parquet") if os.path.exists(base + ".parquet") else 0)
+            entries.append((os.path.getmtime(base + ".json"), size, base))
+        except OSError: continue
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    cutoff = time.time() - SNAPSHOT_MAX_AGE_DAYS * 86400
+    for mtime, size, base in entries:
+        if mtime >= cutoff and total <= SNAPSHOT_MAX_BYTES: break
+        for ext in (".json", ".parquet"):
+            try: os.remove(base + ext)
+            except OSError: pass
+        total -= size
+
+# --- GHI ĐÍCH (replace ở đây; diff / atomic ở sheet_writer.py) ---
+def write_data(tasks_list, target_link, target_sheet_name, creds, sync_mode=WRITE_SYNC_MODE, fence=None):
+    """Ghi các nguồn vào 1 đích theo sync_mode. fence: hàm gia hạn lease gọi giữa các lô (False = mất khóa -> dừng)"""
     try:
         target_id = extract_id(target_link)
         if not target_id: return False, "Link lỗi", {}
         sh = get_sh_with_retry(creds, target_id)
         real_sheet_name = str(target_sheet_name).strip() or "Tong_Hop_Data"
         
-        all_titles = [s.title for s in safe_api_call(sh.worksheets)]
-        if real_sheet_name in all_titles:
-            wks = sh.worksheet(real_sheet_name)
-        else:
-            wks = sh.add_worksheet(title=real_sheet_name, rows=1000, cols=20)
+        try:
+            wks = get_wks_with_retry(sh, real_sheet_name)
+        except gspread.WorksheetNotFound:
+            wks = add_wks_pooled(sh, real_sheet_name, rows=1000, cols=20)
             print(f"✨ Created new sheet: {real_sheet_name}")
         
-        df_new_all = pd.DataFrame()
-        for df, _, _ in tasks_list:
-            df_new_all = pd.concat([df_new_all, df], ignore_index=True)
-        
-        if df_new_all.empty: return True, "No Data", {}
+        # Nguồn đọc theo trang được ghi từng trang (diff cần toàn bộ dữ liệu nên gom lại)
+        opened, failed = open_task_streams(tasks_list, materialize=(sync_mode == "diff"))
+        for err in failed.values(): print(f"  ❌ Lỗi đọc theo trang: {err[:120]}")
+        result_map = {r_idx: ("Lỗi tải", "", 0) for r_idx in failed}
+
+        if all(first.empty for first, _, _, _ in opened): return True, "No Data", result_map
+        if sync_mode == "atomic": return write_atomic_sync(sh, wks, opened, result_map, JOB_LOG, fence)
 
         existing_headers = safe_api_call(wks.row_values, 1)
         if not existing_headers:
-            final_headers = df_new_all.columns.tolist()
+            final_headers = union_columns([first for first, _, _, _ in opened])
             wks.update(range_name="A1", values=[final_headers])
             existing_headers = final_headers
         else:
@@ -289,161 +612,422 @@ def write_data(tasks_list, target_link, target_sheet_name, creds):
                 if col not in updated: updated.append(col); added = True
             if added: wks.update(range_name="A1", values=[updated]); existing_headers = updated
 
-        df_aligned = pd.DataFrame()
-        for col in existing_headers:
-            if col in df_new_all.columns: df_aligned[col] = df_new_all[col]
-            else: df_aligned[col] = ""
-        
+        if sync_mode == "diff":
+            return write_diff_sync(sh, wks, opened, existing_headers, JOB_LOG, fence)
+
         keys = set()
-        for idx, row in df_new_all.iterrows():
-            keys.add((str(row[SYS_COL_LINK]).strip(), str(row[SYS_COL_SHEET]).strip(), str(row[SYS_COL_MONTH]).strip()))
+        for first, _, _, _ in opened: keys |= task_keys(first)
         
-        rows_to_del = get_rows_to_delete_dynamic(wks, keys)
+        all_values = safe_api_call(wks.get_all_values) or [existing_headers]
+        rows_to_del = get_rows_to_delete_dynamic(all_values, keys)
+        batcher = AppendBatcher(wks, fence)
         if rows_to_del:
-            batch_delete_rows(sh, wks.id, rows_to_del)
+            print(f"  ✂️ Xóa {len(rows_to_del)} dòng cũ ({len(contiguous_ranges(rows_to_del))} vùng)")
+            batch_delete_rows(sh, wks, rows_to_del)
+        start_row = len(all_values) - len(rows_to_del) + 1
         
-        start_row = len(safe_api_call(wks.get_all_values)) + 1
-        chunk_size = 5000
-        new_vals = df_aligned.fillna('').values.tolist()
-        for i in range(0, len(new_vals), chunk_size):
-            safe_api_call(wks.append_rows, new_vals[i:i+chunk_size], value_input_option='USER_ENTERED')
-            time.sleep(1)
-
-        result_map = {}
-        current_cursor = start_row
-        for df, _, r_idx in tasks_list:
-            count = len(df)
-            end = current_cursor + count - 1
-            result_map[r_idx] = ("Thành công", f"{current_cursor} - {end}", count)
-            current_cursor += count
-            
-        return True, f"Updated {len(df_aligned)} rows", result_map
+        counts, stream_failed = {}, {}
+        for vals in iter_aligned_slices(opened, existing_headers, APPEND_SLICE_ROWS, counts, stream_failed):
+            batcher.add(vals)
+        batcher.flush()
+
+        report_write_results(opened, counts, stream_failed, start_row, result_map, JOB_LOG)
+        return True, f"Updated {sum(counts.values())} rows", result_map
 
     except Exception as e: return False, f"Write Error: {str(e)}", {}
 
+# --- CHANGE DETECTION (DRIVE modifiedTime / version) ---
+def get_source_version(creds, sheet_id):
+    """Dấu phiên bản file nguồn trên Drive ('modifiedTime|version'), None nếu không lấy được"""
+    try:
+        resp = safe_api_call(get_gspread_client(creds).http_client.request, "get", DRIVE_FILES_URL + sheet_id,
+                             params={"fields": "modifiedTime,version", "supportsAllDrives": "true"})
+        meta = resp.json()
+        if not meta.get("modifiedTime"): return None
+        return f"{meta['modifiedTime']}|{meta.get('version', '')}"
+    except Exception as e:
+        print(f"  ⚠️ Không lấy được version {sheet_id[-6:]}: {str(e)[:80]}")
+        return None
+
+def get_source_versions(creds, rows, max_workers=FETCH_MAX_WORKERS):
+    """Version của file nguồn cho từng dòng (theo thứ tự rows), mỗi file chỉ hỏi Drive 1 lần"""
+    ids = [extract_id(str(r.get(COL_SRC_LINK, '')).strip()) for r in rows]
+    uniq = [i for i in dict.fromkeys(ids) if i]
+    if not uniq: return [None] * len(rows)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(uniq)))) as ex:
+        versions = dict(zip(uniq, ex.map(bind_run_context(lambda sid: get_source_version(creds, sid)), uniq)))
+    return [versions.get(i) for i in ids]
+
+def source_row_key(r, t_link, t_sheet):
+    """Định danh 1 dòng cấu hình (nguồn + cách lấy + đích): đổi bất kỳ thông số nào -> key mới -> không bị bỏ qua"""
+    parts = [extract_id(str(r.get(COL_SRC_LINK, '')).strip()) or r.get(COL_SRC_LINK, ''), r.get(COL_SRC_SHEET, ''),
+             r.get(COL_MONTH, ''), r.get(COL_DATA_RANGE, ''), r.get(COL_FILTER, ''), r.get(COL_HEADER, ''),
+             extract_id(t_link) or t_link, t_sheet]
+    return hashlib.blake2b("\x1f".join(str(p).strip() for p in parts).encode("utf-8"), digest_size=12).hexdigest()
+
+def write_key_of(r):
+    """Khóa (Link, Sheet, Tháng) mà chế độ thay thế dùng để xóa dữ liệu cũ ở đích (khớp 3 cột hệ thống khi ghi)"""
+    return (str(r.get(COL_SRC_LINK, '')).strip(), str(r.get(COL_SRC_SHEET, '')).strip(), str(r.get(COL_MONTH, '')).strip())
+
+_LEDGER_LOCK = threading.Lock()
+
+def load_source_ledger(sh_master):
+    """{row_key: (source_id, version, updated_at, content_hash)} từ SHEET_SOURCE_LEDGER"""
+    try: wks = get_wks_with_retry(sh_master, SHEET_SOURCE_LEDGER)
+    except gspread.WorksheetNotFound: return {}
+    try: values = safe_api_call(wks.get_all_values)
+    except Exception as e: print(f"⚠️ Không đọc được ledger: {e}"); return {}
+    return {r[0]: (r[1], r[2], r[3], r[4] if len(r) > 4 else "") for r in values[1:] if len(r) >= 4 and r[0]}
+
+def save_source_ledger(sh_master, ledger, now):
+    """Ghi lại toàn bộ ledger (bỏ các key không cập nhật quá LEDGER_RETENTION_DAYS ngày)"""
+    cutoff = now.replace(tzinfo=None) - timedelta(days=LEDGER_RETENTION_DAYS)
+    rows = []
+    for key, (sid, ver, upd, content_hash) in ledger.items():
+        try:
+            if datetime.strptime(upd, "%d/%m/%Y %H:%M:%S") < cutoff: continue
+        except ValueError: pass
+        rows.append([key, sid, ver, upd, content_hash])
+    try:
+        try: wks = get_wks_with_retry(sh_master, SHEET_SOURCE_LEDGER)
+        except gspread.WorksheetNotFound: wks = add_wks_pooled(sh_master, SHEET_SOURCE_LEDGER, rows=max(100, len(rows) + 10), cols=len(LEDGER_COLS))
+        safe_api_call(wks.clear)
+        safe_api_call(wks.update, range_name="A1", values=[LEDGER_COLS] + rows)
+    except Exception as e:
+        print(f"❌ Ledger Error: {e}")
+
 # ==========================================
 # 4. SCHEDULER LOGIC (V74 - STANDARD LOGIC)
 # ==========================================
-def is_time_in_window(target_time_str, now_dt):
-    """
-    Kiểm tra xem target_time (HH:MM) có xuất hiện trong khoảng 
-    [now - 18 phút, now] hay không.
-    Hàm này dùng chung cho Chạy Ngày, Tuần, Tháng.
-    """
-    try:
-        h_set, m_set = map(int, target_time_str.strip().split(":"))
-        # Tạo mốc thời gian chạy của ngày hôm nay
-        sched_dt = now_dt.replace(hour=h_set, minute=m_set, second=0, microsecond=0)
-        
-        # Tính độ lệch: (Hiện tại - Mốc cài đặt)
-        diff = (now_dt - sched_dt).total_seconds() / 60 
-        
-        # Nếu độ lệch từ 0 đến 18 phút -> Có nghĩa là vừa mới qua giờ chạy -> Chạy
-        if 0 <= diff <= LOOKBACK_MINUTES:
-            return True
-        return False
-    except: return False
+# --- LEDGER LỊCH: MỖI MỐC CHỈ CHẠY 1 LẦN ---
+WEEKDAY_CODES = {0: "T2", 1: "T3", 2: "T4", 3: "T5", 4: "T6", 5: "T7", 6: "CN"}
+
+def schedule_slot_key(row):
+    """Định danh 1 dòng lịch (block + loại + thông số): sửa lịch -> key mới"""
+    parts = [row.get(SCHED_COL_BLOCK, ""), row.get(SCHED_COL_TYPE, ""), row.get(SCHED_COL_VAL1, ""), row.get(SCHED_COL_VAL2, "")]
+    return hashlib.blake2b("\x1f".join(str(p).strip() for p in parts).encode("utf-8"), digest_size=12).hexdigest()
 
-def is_time_to_run_standard(row, now_dt):
+def schedule_rule(row):
+    """Dòng lịch -> ("interval", số phút) | ("day", giờ, phút, hàm kiểm tra ngày) | None nếu không có lịch hợp lệ"""
     sched_type = str(row.get(SCHED_COL_TYPE, "")).strip()
-    val1 = str(row.get(SCHED_COL_VAL1, "")).strip() # Giờ (08:00) hoặc Phút (50)
-    val2 = str(row.get(SCHED_COL_VAL2, "")).strip() # Ngày (4,8) hoặc Thứ (T2,T3)
+    val1 = str(row.get(SCHED_COL_VAL1, "")).strip()
+    val2 = str(row.get(SCHED_COL_VAL2, "")).strip()
+    try:
+        if sched_type == "Chạy theo phút": return ("interval", max(30, int(val1)))
+        h_set, m_set = map(int, val1.split(":"))
+        if not (0 <= h_set < 24 and 0 <= m_set < 60): return None
+    except (ValueError, TypeError): return None
+    if sched_type == "Hàng ngày": return ("day", h_set, m_set, lambda d: True)
+    days = {x.strip() for x in val2.split(",")}
+    if sched_type == "Hàng tuần": return ("day", h_set, m_set, lambda d: WEEKDAY_CODES[d.weekday()] in days)
+    if sched_type == "Hàng tháng": return ("day", h_set, m_set, lambda d: str(d.day) in days)
+    return None
 
-    if sched_type == "Không chạy": return False
+def latest_schedule_slot(row, now_dt):
+    """Mốc lịch gần nhất <= now_dt (datetime không tz, giờ VN); None nếu dòng không có lịch hợp lệ.
+    Chạy theo phút = bội số interval (tối thiểu 30) tính từ 00:00."""
+    rule = schedule_rule(row)
+    if rule is None: return None
+    now = now_dt.replace(tzinfo=None, second=0, microsecond=0)
+    if rule[0] == "interval":
+        total_min = now.hour * 60 + now.minute
+        return now.replace(hour=0, minute=0) + timedelta(minutes=(total_min // rule[1]) * rule[1])
+    _, h_set, m_set, day_ok = rule
+    for back in range(62):  # đủ dài để gặp lại mọi ngày trong tháng
+        d = (now - timedelta(days=back)).replace(hour=h_set, minute=m_set)
+        if d <= now and day_ok(d): return d
+    return None
 
-    # Mapping cho Thứ và Ngày
-    week_map = {0: "T2", 1: "T3", 2: "T4", 3: "T5", 4: "T6", 5: "T7", 6: "CN"}
-    current_wday_str = week_map[now_dt.weekday()]
-    current_day_str = str(now_dt.day)
+def next_schedule_slot(row, after_dt):
+    """Mốc lịch đầu tiên > after_dt (datetime không tz, giờ VN); None nếu không có"""
+    rule = schedule_rule(row)
+    if rule is None: return None
+    after = after_dt.replace(tzinfo=None, second=0, microsecond=0)
+    if rule[0] == "interval":
+        midnight = after.replace(hour=0, minute=0) + timedelta(days=1)
+        return min(latest_schedule_slot(row, after) + timedelta(minutes=rule[1]), midnight)
+    _, h_set, m_set, day_ok = rule
+    for fwd in range(62):
+        d = (after + timedelta(days=fwd)).replace(hour=h_set, minute=m_set)
+        if d > after and day_ok(d): return d
+    return None
 
-    # 1. Chạy theo phút
-    if sched_type == "Chạy theo phút":
-        try:
-            interval = int(val1)
-            if interval < 30: interval = 30 # Min 30p theo yêu cầu
-            
-            # Tính tổng số phút trong ngày hiện tại
-            curr_total_min = now_dt.hour * 60 + now_dt.minute
-            
-            # Tính thời điểm quá khứ (lùi lại để check)
-            prev_total_min = curr_total_min - LOOKBACK_MINUTES
-            
-            # Logic: Nếu số lần chia chẵn cho interval thay đổi -> Đã qua mốc
-            # Ví dụ: Interval 50. Lúc 08:10 (490p) -> 490//50 = 9
-            # Lúc 08:25 (505p) -> 505//50 = 10 -> Nhảy số -> Chạy (mốc 500 - 08:20)
-            
-            count_curr = curr_total_min // interval
-            count_prev = prev_total_min // interval
-            
-            if count_curr > count_prev:
-                return True
-        except: pass
-
-    # 2. Hàng ngày: Chỉ check giờ (val1)
-    elif sched_type == "Hàng ngày":
-        return is_time_in_window(val1, now_dt)
-
-    # 3. Hàng tuần: Check Thứ (val2) + Giờ (val1)
-    elif sched_type == "Hàng tuần":
-        # Tách danh sách thứ: "T2, T3" -> ["T2", "T3"]
-        target_days = [x.strip() for x in val2.split(",")]
-        if current_wday_str in target_days:
-            return is_time_in_window(val1, now_dt)
-
-    # 4. Hàng tháng: Check Ngày (val2) + Giờ (val1)
-    elif sched_type == "Hàng tháng":
-        # Tách danh sách ngày: "4, 8" -> ["4", "8"]
-        target_dates = [x.strip() for x in val2.split(",")]
-        if current_day_str in target_dates:
-            return is_time_in_window(val1, now_dt)
-
-    return False
-
-def run_auto_job():
-    print("🚀 Starting Auto Job (V74 - Standard Logic)...")
-    
-    creds = get_creds()
-    if not creds: return
-    
-    master_id = get_history_sheet_id()
-    if not master_id: 
-        print("❌ Chưa set HISTORY_SHEET_ID"); return
+def decide_schedule(row, now_dt, sched_ledger):
+    """Quyết định chạy 1 dòng lịch dựa trên ledger {slot_key: mốc đã xử lý gần nhất}.
+    - Mốc mới nhất chưa xử lý và trễ <= SCHEDULE_CATCHUP_HOURS -> chạy (trễ quá LOOKBACK_MINUTES = chạy bù, các mốc lỡ
+      dồn lại chỉ chạy 1 lần)
+    - Mốc đã xử lý -> bỏ qua (run GitHub trễ/chồng nhau không chạy lặp)
+    - Lỡ quá SCHEDULE_CATCHUP_HOURS, hoặc lịch mới/mới sửa mà mốc đã qua LOOKBACK_MINUTES -> bỏ qua, ghi nhận mốc
+    Trả về dict để in/kiểm tra; "record" = mốc cần lưu vào ledger (None = không đổi)."""
+    now = now_dt.replace(tzinfo=None, second=0, microsecond=0)
+    key = schedule_slot_key(row)
+    last = sched_ledger.get(key)
+    d = {"block": str(row.get(SCHED_COL_BLOCK, "")), "slot_key": key, "type": str(row.get(SCHED_COL_TYPE, "")).strip(),
+         "slot": None, "last_slot": last, "fire": False, "record": None, "reason": "không có lịch"}
+    if d["type"] == "Không chạy": d["reason"] = "Không chạy"; return d
+    slot = latest_schedule_slot(row, now_dt)
+    if slot is None: return d
+    d["slot"] = slot
+    age = (now - slot).total_seconds() / 60
+    if last is not None and slot <= last: d["reason"] = "mốc đã chạy"
+    elif last is None and age > LOOKBACK_MINUTES: d["reason"] = "lịch mới, mốc đã qua"; d["record"] = slot
+    elif age > SCHEDULE_CATCHUP_HOURS * 60: d["reason"] = f"lỡ mốc quá {SCHEDULE_CATCHUP_HOURS:g}h"; d["record"] = slot
+    else:
+        d["fire"] = True; d["record"] = slot
+        d["reason"] = "đúng mốc" if age <= LOOKBACK_MINUTES else f"chạy bù (trễ {age:.0f} phút)"
+    return d
 
-    sh_master = get_sh_with_retry(creds, master_id)
-    if not sh_master:
-        print("❌ Không thể mở Sheet Master.")
-        return
-    
+def format_schedule_decision(d):
+    slot = d["slot"].strftime(SCHED_SLOT_FMT) if d["slot"] else "-"
+    last = d["last_slot"].strftime(SCHED_SLOT_FMT) if d["last_slot"] else "-"
+    return f"{'⚡ MATCH' if d['fire'] else '· skip '}: {d['block']} | {d['type']} | mốc {slot} | đã chạy {last} | {d['reason']}"
+
+def parse_schedule_ledger(values):
+    """{slot_key: mốc đã xử lý gần nhất (datetime)} từ giá trị tab SHEET_SCHED_LEDGER"""
+    ledger = {}
+    for r in values[1:]:
+        if len(r) < 3 or not r[0]: continue
+        try: ledger[r[0]] = datetime.strptime(r[2], SCHED_SLOT_FMT)
+        except ValueError: pass
+    return ledger
+
+def load_schedule_ledger(sh_master):
+    try: wks = get_wks_with_retry(sh_master, SHEET_SCHED_LEDGER)
+    except gspread.WorksheetNotFound: return {}
+    try: return parse_schedule_ledger(safe_api_call(wks.get_all_values))
+    except Exception as e: print(f"⚠️ Không đọc được ledger lịch: {e}"); return {}
+
+def schedule_rows(values):
+    """Giá trị tab sys_config -> [dict theo header], bỏ dòng trống (thay get_as_dataframe: không cần pandas)"""
+    if not values: return []
+    header = values[0]
+    return [dict(zip(header, list(r) + [""] * (len(header) - len(r)))) for r in values[1:] if any(str(v).strip() for v in r)]
+
+def read_schedule_state(sh_master):
+    """sys_config + ledger lịch trong 1 lần values:batchGet. Trả về (các dòng lịch, ledger lịch)"""
+    titles = [SHEET_SYS_CONFIG]
+    if SHEET_SCHED_LEDGER in get_wks_map(sh_master): titles.append(SHEET_SCHED_LEDGER)
+    resp = safe_api_call(sh_master.values_batch_get, [quote_sheet_title(t) for t in titles])
+    value_ranges = [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+    value_ranges += [[]] * (2 - len(value_ranges))
+    return schedule_rows(value_ranges[0]), parse_schedule_ledger(value_ranges[1])
+
+def parse_ledger_time(text, fmt):
+    try: return datetime.strptime(str(text).strip(), fmt)
+    except ValueError: return None
+
+def update_schedule_ledger(sh_master, apply):
+    """Sửa ledger lịch tại chỗ theo Slot_Key (không xóa trắng tab): dưới khóa trên chính tab ledger, đọc mới các dòng
+    {slot_key: dòng}, apply() sửa/thêm/bỏ dòng, chỉ ghi các dòng đổi. Trả về kết quả của apply; None nếu lỗi/không lấy được khóa"""
+    for attempt in range(SCHED_LEDGER_LOCK_RETRIES):
+        lease = acquire_leases(sh_master, "AUTO_BOT", [SHEET_SCHED_LEDGER])
+        if lease["resources"]: break
+        time.sleep(2 + random.random() * 2)
+    else:
+        print("⚠️ Ledger lịch đang được lượt khác cập nhật"); return None
     try:
-        wks_sched = sh_master.worksheet(SHEET_SYS_CONFIG)
-        df_sched = get_as_dataframe(wks_sched, evaluate_formulas=True, dtype=str)
-        
-        wks_config = sh_master.worksheet(SHEET_CONFIG_NAME)
-        df_config = get_as_dataframe(wks_config, evaluate_formulas=True, dtype=str)
-        df_config['index_map'] = df_config.index
+        try: wks = get_wks_with_retry(sh_master, SHEET_SCHED_LEDGER)
+        except gspread.WorksheetNotFound: wks = add_wks_pooled(sh_master, SHEET_SCHED_LEDGER, rows=100, cols=len(SCHED_LEDGER_COLS))
+        values = safe_api_call(wks.get_all_values)
+        old = {}
+        for i, r in enumerate(values[1:], start=2):
+            if r and r[0]: old[r[0]] = (i, list(r[:len(SCHED_LEDGER_COLS)]) + [""] * (len(SCHED_LEDGER_COLS) - len(r)))
+        rows = {k: list(r) for k, (_, r) in old.items()}
+        result = apply(rows)
+        updates = [] if values and values[0][:len(SCHED_LEDGER_COLS)] == SCHED_LEDGER_COLS else [{"range": "A1", "values": [SCHED_LEDGER_COLS]}]
+        updates += [{"range": f"A{old[k][0]}", "values": [r]} for k, r in rows.items() if k in old and r != old[k][1]]
+        if updates: safe_api_call(wks.batch_update, updates)
+        added = [r for k, r in rows.items() if k not in old]
+        if added: safe_api_call(wks.append_rows, added, value_input_option="RAW")
+        batch_delete_rows(sh_master, wks, [i for k, (i, _) in old.items() if k not in rows])
+        return result
     except Exception as e:
-        print(f"❌ Lỗi đọc config: {e}"); return
+        print(f"❌ Schedule Ledger Error: {e}"); return None
+    finally: release_leases(sh_master, lease)
 
-    # Check Schedule
-    tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    now = datetime.now(tz)
-    print(f"🕒 Time Check: {now.strftime('%H:%M:%S')} (Lookback {LOOKBACK_MINUTES}m)")
-
-    blocks_to_run = []
-    if SCHED_COL_BLOCK in df_sched.columns:
-        for _, row in df_sched.iterrows():
-            blk = str(row.get(SCHED_COL_BLOCK, ""))
-            # [V74] Sử dụng hàm check chuẩn
-            if is_time_to_run_standard(row, now):
-                print(f"⚡ MATCH: {blk}")
-                blocks_to_run.append(blk)
+def claim_schedule_slots(sh_master, decisions, now):
+    """Ghi quyết định lịch vào ledger và nhận các mốc sẽ chạy. Mốc bỏ qua có record -> ghi luôn là đã xử lý.
+    Mốc chạy -> chỉ đánh dấu đang chạy (Started_Slot/Started_At); mốc đã xong, hoặc lượt khác đang chạy chưa quá
+    SCHEDULE_RUN_TIMEOUT_MINUTES phút -> không chạy. Key không còn trong sys_config bị bỏ.
+    Trả về các quyết định được nhận chạy; None nếu không ghi được ledger (không chạy gì, lượt sau chạy bù)."""
+    stamp = now.strftime("%d/%m/%Y %H:%M:%S")
+    wall = now.replace(tzinfo=None)
+    keys = {d["slot_key"] for d in decisions}
+
+    def apply(rows):
+        for k in [k for k in rows if k not in keys]: rows.pop(k)
+        claimed = []
+        for d in decisions:
+            if not d["fire"] and d["record"] is None: continue
+            r = rows.setdefault(d["slot_key"], [d["slot_key"], d["block"]] + [""] * (len(SCHED_LEDGER_COLS) - 2))
+            done = parse_ledger_time(r[2], SCHED_SLOT_FMT)
+            if not d["fire"]:
+                if done is None or d["record"] > done:
+                    r[2:7] = [d["record"].strftime(SCHED_SLOT_FMT), stamp, "BỎ QUA: " + d["reason"], "", ""]
+                continue
+            started_at = parse_ledger_time(r[6], "%d/%m/%Y %H:%M:%S")
+            if done is not None and d["slot"] <= done:
+                d["fire"], d["reason"] = False, "mốc đã chạy (lượt khác)"
+            elif parse_ledger_time(r[5], SCHED_SLOT_FMT) == d["slot"] and started_at and (wall - started_at).total_seconds() < SCHEDULE_RUN_TIMEOUT_MINUTES * 60:
+                d["fire"], d["reason"] = False, "lượt khác đang chạy mốc này"
+            else:
+                r[3:7] = [stamp, "ĐANG CHẠY: " + d["reason"], d["slot"].strftime(SCHED_SLOT_FMT), stamp]
+                claimed.append(d)
+        return claimed
+    return update_schedule_ledger(sh_master, apply)
+
+def finish_schedule_slots(sh_master, claimed, ok, note=""):
+    """Chạy xong -> ghi mốc vào Last_Slot; lỗi -> chỉ bỏ dấu đang chạy (lượt sau chạy bù nếu còn trong hạn)"""
+    stamp = datetime.now(VN_TZ).strftime("%d/%m/%Y %H:%M:%S")
+
+    def apply(rows):
+        for d in claimed:
+            slot = d["slot"].strftime(SCHED_SLOT_FMT)
+            r = rows.get(d["slot_key"])
+            if r is None or r[5] != slot: continue  # lượt khác đã nhận lại mốc (quá hạn chạy)
+            if ok: r[2], r[4] = slot, "CHẠY: " + d["reason"]
+            else: r[4] = f"LỖI: {note}"[:200]
+            r[3], r[5], r[6] = stamp, "", ""
+    update_schedule_ledger(sh_master, apply)
+
+def plan_schedule(sched_rows, sched_ledger, now):
+    """Quyết định cho mọi dòng sys_config, mốc mới ghi thẳng vào sched_ledger. Trả về (decisions, có mốc mới cần lưu không)"""
+    decisions = []
+    if sched_rows and SCHED_COL_BLOCK in sched_rows[0]:
+        decisions = [decide_schedule(row, now, sched_ledger) for row in sched_rows]
+    changed = False
+    for d in decisions:
+        if d["record"] is not None and d["record"] != d["last_slot"]:
+            sched_ledger[d["slot_key"]] = d["record"]; changed = True
+    return decisions, changed
+
+def target_lane_key(t_link, t_sheet):
+    """Khóa tuần tự hóa: nhóm ghi cùng spreadsheet + tab đích thì chung 1 làn"""
+    return (extract_id(t_link) or t_link, str(t_sheet).strip() or "Tong_Hop_Data")
+
+def run_target_group(blk, t_link, t_sheet, rows, creds, df_config, ledger, now, sh_master=None, lease=None):
+    """Tải + ghi 1 nhóm đích của 1 block. Trả về (các dòng log theo đúng thứ tự xử lý, ledger có đổi không);
+    ledger được cập nhật tại chỗ (có khóa vì nhiều nhóm chạy song song)."""
+    log_rows, ledger_dirty = [], False
+    tasks = []
+    print(f"📂 Run: {blk} -> {t_sheet}")
     
-    if not blocks_to_run:
-        print("💤 Không có lịch phù hợp.")
-        return
+    # Nguồn không đổi kể từ lần ghi thành công trước -> bỏ qua tải/biến đổi/ghi
+    need_versions = SKIP_UNCHANGED_SOURCES or SNAPSHOT_CACHE_ENABLED
+    versions = get_source_versions(creds, rows) if need_versions else [None] * len(rows)
+    pending = {}
+    run_rows, run_versions, run_hashes = [], [], []
+    # Chế độ thay thế xóa theo khóa (Link, Sheet, Tháng): nhiều dòng cấu hình cùng khóa phải nạp lại cùng nhau,
+    # chỉ bỏ qua khi MỌI dòng cùng khóa đều không đổi (nếu không, dòng bị bỏ qua sẽ mất dữ liệu khi dòng kia ghi)
+    prevs = []
+    for r, ver in zip(rows, versions):
+        rkey = source_row_key(r, t_link, t_sheet)
+        with _LEDGER_LOCK: prevs.append((rkey, ledger.get(rkey, ("", "", "", ""))))
+    changed_keys = {write_key_of(r) for r, ver, (_, prev) in zip(rows, versions, prevs) if not (ver and prev[1] == ver)}
+    for r, ver, (rkey, prev) in zip(rows, versions, prevs):
+        if ver and prev[1] == ver and write_key_of(r) not in changed_keys:
+            print(f"  ⏭️ {str(r.get(COL_SRC_LINK, ''))[-10:]} ({r.get(COL_SRC_SHEET, '')}): không đổi")
+            log_rows.append([
+                now.strftime("%d/%m/%Y %H:%M:%S"), r.get(COL_DATA_RANGE), r.get(COL_MONTH), 
+                "AUTO_BOT", r.get(COL_SRC_LINK, ''), t_link, t_sheet, r.get(COL_SRC_SHEET, ''), STATUS_SKIPPED, "0", "", blk
+            ])
+            continue
+        pending[r.get('index_map')] = (rkey, extract_id(str(r.get(COL_SRC_LINK, '')).strip()) or "", ver, None)
+        run_rows.append(r); run_versions.append(ver); run_hashes.append(prev[3] or None)
+    rows = run_rows
+    if not rows: return log_rows, ledger_dirty
+    
+    fetched = list(fetch_group_concurrent(rows, creds, versions=run_versions, known_hashes=run_hashes))
+    # Dòng "nội dung không đổi" nhưng có dòng cùng khóa sắp ghi -> phải tải + biến đổi lại để ghi cùng
+    write_keys = {write_key_of(r) for r, (df, _, _) in zip(rows, fetched) if df is not None}
+    redo = [p for p, (r, (_, msg, _)) in enumerate(zip(rows, fetched)) if msg == STATUS_SAME_CONTENT and write_key_of(r) in write_keys]
+    if redo:
+        refetched = fetch_group_concurrent([rows[p] for p in redo], creds, versions=[run_versions[p] for p in redo])
+        for p, res in zip(redo, refetched): fetched[p] = res
+    for r, (df, msg, content_hash) in zip(rows, fetched):
+        lnk = r.get(COL_SRC_LINK, ''); lbl = r.get(COL_SRC_SHEET, '')
+        idx = r.get('index_map')
+        rkey, sid, ver, _ = pending[idx]
+        pending[idx] = (rkey, sid, ver, content_hash)
+        
+        if df is not None:
+            tasks.append((df, lnk, idx))
+        elif msg == STATUS_SAME_CONTENT:
+            # File có sửa (version đổi) nhưng dữ liệu vùng lấy y hệt lần ghi trước
+            print(f"  ⏭️ {lnk[-10:]} ({lbl}): nội dung không đổi")
+            log_rows.append([
+                now.strftime("%d/%m/%Y %H:%M:%S"), r.get(COL_DATA_RANGE), r.get(COL_MONTH), 
+                "AUTO_BOT", lnk, t_link, t_sheet, lbl, STATUS_SAME_CONTENT, "0", "", blk
+            ])
+            if ver:
+                with _LEDGER_LOCK: ledger[rkey] = (sid, ver, now.strftime("%d/%m/%Y %H:%M:%S"), content_hash)
+                ledger_dirty = True
+        else:
+            print(f"  ❌ {lnk[-10:]} ({lbl}): {msg}")
+            log_rows.append([
+                now.strftime("%d/%m/%Y %H:%M:%S"), r.get(COL_DATA_RANGE), r.get(COL_MONTH), 
+                "AUTO_BOT", lnk, t_link, t_sheet, lbl, "Lỗi tải", "0", "", blk
+            ])
+
+    if tasks and lease is not None and not renew_lease(sh_master, lease):
+        print(f"  ❌ {blk} -> {t_sheet}: đã mất khóa đích (hết hạn và có người khác lấy) - không ghi")
+        tasks = []
+    if tasks:
+        ok, msg, res_map = write_data(tasks, t_link, t_sheet, creds, fence=(lambda: renew_lease(sh_master, lease)) if lease is not None else None)
+        print(f"  💾 {blk} -> {t_sheet}: {msg}")
+        
+        for df, lnk, idx in tasks:
+            status, ranges, count = res_map.get(idx, ("Lỗi Ghi", "", 0))
+            orig_r = df_config.loc[idx]
+            
+            log_rows.append([
+                now.strftime("%d/%m/%Y %H:%M:%S"), orig_r.get(COL_DATA_RANGE), orig_r.get(COL_MONTH), 
+                "AUTO_BOT", lnk, t_link, t_sheet, orig_r.get(COL_SRC_SHEET), 
+                status, str(count), ranges, blk
+            ])
+            rkey, sid, ver, content_hash = pending.get(idx, (None, "", None, None))
+            if ver and status == "Thành công":
+                with _LEDGER_LOCK: ledger[rkey] = (sid, ver, now.strftime("%d/%m/%Y %H:%M:%S"), content_hash or "")
+                ledger_dirty = True
+    return log_rows, ledger_dirty
+
+def run_groups_parallel(jobs, creds, df_config, ledger, now, max_workers=BLOCK_MAX_WORKERS, sh_master=None, lease=None):
+    """Chạy các nhóm đích [(blk, t_link, t_sheet, rows)] song song theo làn: các nhóm ghi cùng 1 đích chạy
+    nối tiếp theo thứ tự gốc, khác đích thì chạy đồng thời (quota API vẫn do quota_acquire điều phối).
+    Trả về (log ghép theo đúng thứ tự jobs - giống hệt khi chạy tuần tự, ledger có đổi không)."""
+    lanes = defaultdict(list)
+    for i, (_, t_link, t_sheet, _) in enumerate(jobs): lanes[target_lane_key(t_link, t_sheet)].append(i)
+    results = [([], False)] * len(jobs)
+
+    def run_lane(idxs):
+        for i in idxs:
+            blk, t_link, t_sheet, rows = jobs[i]
+            try: results[i] = run_target_group(blk, t_link, t_sheet, rows, creds, df_config, ledger, now, sh_master, lease)
+            except Exception as e:
+                # Nhóm lỗi giữa chừng vẫn phải có log cho từng dòng cấu hình (nếu không, lỗi chỉ nằm trong stdout)
+                print(f"❌ {blk} -> {t_sheet}: {str(e)[:200]}")
+                ts = now.strftime("%d/%m/%Y %H:%M:%S")
+                results[i] = ([[ts, r.get(COL_DATA_RANGE), r.get(COL_MONTH), "AUTO_BOT", r.get(COL_SRC_LINK, ''), t_link, t_sheet,
+                                r.get(COL_SRC_SHEET, ''), f"Lỗi: {str(e)[:200]}", "0", "", blk] for r in rows], False)
+
+    workers = max(1, min(max_workers, len(lanes)))
+    if workers > 1: print(f"🧵 {len(jobs)} nhóm đích / {len(lanes)} đích, chạy song song {workers} luồng")
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(bind_run_context(run_lane), lanes.values()))
+    return [row for log_rows, _ in results for row in log_rows], any(dirty for _, dirty in results)
 
+def read_block_config(sh_master):
+    wks_config = get_wks_with_retry(sh_master, SHEET_CONFIG_NAME)
+    df_config = gspread_dataframe.get_as_dataframe(wks_config, evaluate_formulas=True, dtype=str)
+    df_config['index_map'] = df_config.index
+    return df_config
+
+def run_blocks(blocks_to_run, creds, sh_master, df_config, now):
+    """Chạy các block đã tới lịch (nhóm theo đích, song song theo làn) rồi ghi log"""
     log_buffer = []
+    ledger = load_source_ledger(sh_master) if SKIP_UNCHANGED_SOURCES else {}
     
+    jobs = []
     for blk in blocks_to_run:
         block_rows = df_config[
             (df_config[COL_BLOCK_NAME] == blk) & 
@@ -458,58 +1042,200 @@ def run_auto_job():
         for _, r in block_rows.iterrows():
             tgt_key = (str(r.get(COL_TGT_LINK, '')).strip(), str(r.get(COL_TGT_SHEET, '')).strip())
             grouped[tgt_key].append(r)
+        for (t_link, t_sheet), rows in grouped.items(): jobs.append((blk, t_link, t_sheet, rows))
 
-        for (t_link, t_sheet), rows in grouped.items():
-            tasks = []
-            print(f"📂 Run: {blk} -> {t_sheet}")
-            
-            for r in rows:
-                lnk = r.get(COL_SRC_LINK, ''); lbl = r.get(COL_SRC_SHEET, '')
-                idx = r.get('index_map')
-                
-                df, msg = fetch_data(r, creds)
-                time.sleep(1.5)
-                
-                if df is not None:
-                    tasks.append((df, lnk, idx))
-                else:
-                    log_buffer.append([
-                        now.strftime("%d/%m/%Y %H:%M:%S"), r.get(COL_DATA_RANGE), r.get(COL_MONTH), 
-                        "AUTO_BOT", lnk, t_link, t_sheet, lbl, "Lỗi tải", "0", "", blk
-                    ])
-
-            if tasks:
-                ok, msg, res_map = write_data(tasks, t_link, t_sheet, creds)
-                print(f"  💾 {msg}")
-                
-                for df, lnk, idx in tasks:
-                    status, ranges, count = res_map.get(idx, ("Lỗi Ghi", "", 0))
-                    orig_r = df_config.loc[idx]
-                    
-                    log_buffer.append([
-                        now.strftime("%d/%m/%Y %H:%M:%S"), orig_r.get(COL_DATA_RANGE), orig_r.get(COL_MONTH), 
-                        "AUTO_BOT", lnk, t_link, t_sheet, orig_r.get(COL_SRC_SHEET), 
-                        status, str(count), ranges, blk
-                    ])
+    # Khóa các đích của lượt này (app/lượt khác đang ghi đích nào thì bỏ qua đích đó, đích khác vẫn chạy)
+    lease = acquire_leases(sh_master, "AUTO_BOT", [lock_resource(*target_lane_key(t_link, t_sheet)) for _, t_link, t_sheet, _ in jobs])
+    locked = [j for j in jobs if lock_resource(*target_lane_key(j[1], j[2])) not in lease["resources"]]
+    for blk, t_link, t_sheet, rows in locked:
+        print(f"🔒 {blk} -> {t_sheet}: đích đang bị khóa, bỏ qua")
+        for r in rows:
+            log_buffer.append([
+                now.strftime("%d/%m/%Y %H:%M:%S"), r.get(COL_DATA_RANGE), r.get(COL_MONTH),
+                "AUTO_BOT", r.get(COL_SRC_LINK, ''), t_link, t_sheet, r.get(COL_SRC_SHEET, ''), STATUS_LOCKED, "0", "", blk
+            ])
+    jobs = [j for j in jobs if lock_resource(*target_lane_key(j[1], j[2])) in lease["resources"]]
+    try: group_logs, ledger_dirty = run_groups_parallel(jobs, creds, df_config, ledger, now, sh_master=sh_master, lease=lease)
+    finally: release_leases(sh_master, lease)
+    log_buffer.extend(group_logs)
+
+    if ledger_dirty and SKIP_UNCHANGED_SOURCES: save_source_ledger(sh_master, ledger, now)
+    if SNAPSHOT_CACHE_ENABLED: evict_snapshots()
 
     if log_buffer:
         print(f"📝 Saving {len(log_buffer)} logs...")
         try:
-            wks_log = sh_master.worksheet(SHEET_LOG_NAME)
+            wks_log = get_log_partition(creds, sh_master, SHEET_LOG_NAME, LOG_RUN_HEADER, now)
             cleaned_logs = [[str(x) for x in row] for row in log_buffer]
             safe_api_call(wks_log.append_rows, cleaned_logs)
         except Exception as e:
             print(f"❌ Log Error: {e}")
 
     try:
-        wks_act = sh_master.worksheet(SHEET_ACTIVITY_NAME)
+        wks_act = get_log_partition(creds, sh_master, SHEET_ACTIVITY_NAME, LOG_ACT_HEADER, now)
         safe_api_call(wks_act.append_row, [
             now.strftime("%d/%m/%Y %H:%M:%S"), "AUTO_BOT", 
             "Scheduled Run", f"Blocks: {', '.join(blocks_to_run)}"
         ])
     except: pass
 
-    print("🏁 Done.")
+def run_scheduled(creds, sh_master, sched_rows, now, sched_ledger=None, df_config=None, explain=False):
+    """Quyết định lịch theo ledger, ghi nhận mốc rồi chạy các block tới lịch. Trả về danh sách block đã chạy.
+    sched_ledger/df_config = None -> tự đọc; luu_cau_hinh (và pandas/polars) chỉ nạp khi thực sự có block tới lịch."""
+    if sched_ledger is None: sched_ledger = load_schedule_ledger(sh_master)
+    decisions, sched_changed = plan_schedule(sched_rows, sched_ledger, now)
+    for d in decisions:
+        if d["fire"] or explain: print(format_schedule_decision(d))
+    if explain: return []
+
+    # Nhận mốc trước khi chạy (đánh dấu đang chạy): run GitHub chồng lên sau đó thấy mốc đang chạy/đã xong -> không chạy lặp
+    fired = [d for d in decisions if d["fire"]]
+    claimed = (claim_schedule_slots(sh_master, decisions, now) or []) if sched_changed else []
+    for d in fired:
+        if not d["fire"]: print(format_schedule_decision(d))
+    blocks_to_run = list(dict.fromkeys(d["block"] for d in claimed))
+
+    if not blocks_to_run:
+        print("💤 Không có lịch phù hợp.")
+        return []
+    if df_config is None:
+        try: df_config = read_block_config(sh_master)
+        except Exception as e:
+            print(f"❌ Lỗi đọc config: {e}")
+            finish_schedule_slots(sh_master, claimed, False, f"đọc config: {e}")
+            return []
+    try: run_blocks(blocks_to_run, creds, sh_master, df_config, now)
+    except Exception as e:
+        finish_schedule_slots(sh_master, claimed, False, str(e))
+        raise
+    finish_schedule_slots(sh_master, claimed, True)
+    return blocks_to_run
+
+def run_auto_job(explain=False):
+    """explain=True: chỉ in quyết định lịch của từng dòng sys_config (không chạy, không ghi ledger)"""
+    print("🚀 Starting Auto Job (V74 - Standard Logic)...")
+    
+    creds = get_creds()
+    if not creds: return
+    reset_circuit_breaker()
+    
+    master_id = get_history_sheet_id()
+    if not master_id: 
+        print("❌ Chưa set HISTORY_SHEET_ID"); return
+
+    sh_master = get_sh_with_retry(creds, master_id)
+    if not sh_master:
+        print("❌ Không thể mở Sheet Master.")
+        return
+    
+    try:
+        sched_rows, sched_ledger = read_schedule_state(sh_master)
+    except Exception as e:
+        print(f"❌ Lỗi đọc config: {e}"); return
+
+    # Check Schedule
+    now = datetime.now(VN_TZ)
+    print(f"🕒 Time Check: {now.strftime('%H:%M:%S')} (Lookback {LOOKBACK_MINUTES}m, chạy bù {SCHEDULE_CATCHUP_HOURS:g}h)")
+
+    if run_scheduled(creds, sh_master, sched_rows, now, sched_ledger=sched_ledger, explain=explain): print("🏁 Done.")
+
+# ==========================================
+# 5. DAEMON MODE (PROCESS THƯỜNG TRÚ)
+# ==========================================
+# python auto_job.py --daemon : giữ sẵn creds/client/config, hàng đợi ưu tiên theo mốc chạy kế tiếp của từng dòng
+# sys_config -> ngủ tới đúng phút chạy. Mỗi DAEMON_POLL_SECONDS (và ngay trước khi chạy) hỏi Drive version của Sheet Master
+# (1 request metadata); chỉ khi version đổi mới tải + hash giá trị sys_config + luu_cau_hinh, và chỉ nạp lại khi hash đổi
+# (version đổi cả khi lượt chạy ghi log vào chính Sheet Master, nên vẫn cần hash để không nạp lại sau mỗi lượt).
+# Quyết định chạy vẫn qua ledger lịch nên chạy song song với cron GitHub cũng không bị chạy lặp mốc.
+def build_fire_queue(sched_rows, after):
+    """Heap [(mốc kế tiếp > after, vị trí dòng sys_config)]"""
+    queue = []
+    if not sched_rows or SCHED_COL_BLOCK not in sched_rows[0]: return queue
+    for idx, row in enumerate(sched_rows):
+        if str(row.get(SCHED_COL_TYPE, "")).strip() == "Không chạy": continue
+        nxt = next_schedule_slot(row, after)
+        if nxt is not None: queue.append((nxt, idx))
+    heapq.heapify(queue)
+    return queue
+
+def pop_due_slots(queue, sched_rows, now_wall):
+    """Lấy các mốc đã tới khỏi heap, đẩy mốc kế tiếp của cùng dòng vào lại. Trả về số mốc đã tới"""
+    n = 0
+    while queue and queue[0][0] <= now_wall:
+        fire_dt, idx = heapq.heappop(queue)
+        n += 1
+        nxt = next_schedule_slot(sched_rows[idx], max(fire_dt, now_wall))
+        if nxt is not None: heapq.heappush(queue, (nxt, idx))
+    return n
+
+def config_fingerprint(sh_master):
+    """Hash giá trị sys_config + luu_cau_hinh (1 values:batchGet) - chỉ đổi khi người dùng sửa cấu hình/lịch"""
+    resp = safe_api_call(sh_master.values_batch_get, [quote_sheet_title(t) for t in (SHEET_SYS_CONFIG, SHEET_CONFIG_NAME)])
+    payload = json.dumps([vr.get("values", []) for vr in resp.get("valueRanges", [])], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+def daemon_tick(creds, master_id, state):
+    """1 vòng daemon. Trả về số giây nên ngủ tới vòng sau"""
+    now = datetime.now(VN_TZ)
+    wall = now.replace(tzinfo=None)
+    due = bool(state["queue"]) and state["queue"][0][0] <= wall
+    if due or state["sched"] is None or time.time() - state["polled_at"] >= DAEMON_POLL_SECONDS:
+        state["polled_at"] = time.time()
+        # Lấy lại từ pool mỗi vòng: handle quá SH_POOL_TTL được mở mới thay vì giữ mãi 1 handle lúc khởi động
+        sh_master = get_sh_with_retry(creds, master_id)
+        if not sh_master: raise RuntimeError("Không thể mở Sheet Master")
+        state["sh"] = sh_master
+        file_ver = get_source_version(creds, master_id)
+        if state["sched"] is not None and file_ver is not None and file_ver == state["file_version"]: ver = state["version"]
+        else: ver = config_fingerprint(sh_master)
+        state["file_version"] = file_ver
+        if state["sched"] is None or ver != state["version"]:
+            state["sched"], _ = read_schedule_state(sh_master)
+            state["df_config"] = read_block_config(sh_master)
+            state["version"] = ver
+            state["queue"] = build_fire_queue(state["sched"], wall)
+            print(f"🔄 Nạp config: {len(state['queue'])} lịch, {len(state['df_config'])} dòng cấu hình")
+            due = True  # nạp lại (lúc khởi động / sau khi sửa lịch) -> xét luôn mốc lỡ để chạy bù
+
+    if due:
+        pop_due_slots(state["queue"], state["sched"], wall)
+        reset_circuit_breaker()
+        print(f"🕒 Daemon Check: {now.strftime('%d/%m/%Y %H:%M:%S')}")
+        run_scheduled(creds, state["sh"], state["sched"], now, df_config=state["df_config"])
+
+    wait = DAEMON_POLL_SECONDS - (time.time() - state["polled_at"])
+    if state["queue"]:
+        wait = min(wait, (state["queue"][0][0] - datetime.now(VN_TZ).replace(tzinfo=None)).total_seconds())
+    return max(1.0, wait)
+
+def run_daemon():
+    print("🚀 Starting Auto Job daemon...")
+    creds = get_creds()
+    if not creds: return
+    master_id = get_history_sheet_id()
+    if not master_id:
+        print("❌ Chưa set HISTORY_SHEET_ID"); return
+
+    state = {"version": None, "file_version": None, "sh": None, "sched": None, "df_config": None, "queue": [], "polled_at": 0.0}
+    announced = None
+    while True:
+        try:
+            wait = daemon_tick(creds, master_id, state)
+            head = state["queue"][0][0] if state["queue"] else None
+            if head != announced:
+                announced = head
+                if head: print(f"⏳ Mốc kế tiếp: {head.strftime(SCHED_SLOT_FMT)}")
+        except KeyboardInterrupt:
+            print("🛑 Dừng daemon."); return
+        except Exception as e:
+            print(f"❌ Daemon Error: {str(e)[:200]}")
+            wait = DAEMON_POLL_SECONDS
+        try: time.sleep(wait)
+        except KeyboardInterrupt:
+            print("🛑 Dừng daemon."); return
 
 if __name__ == "__main__":
-    run_auto_job()
+    # python auto_job.py --explain : xem block nào sẽ chạy/bỏ qua và vì sao
+    # python auto_job.py --daemon  : chạy thường trú, tự kích hoạt block đúng phút
+    if "--daemon" in sys.argv[1:]: run_daemon()
+    else: run_auto_job(explain="--explain" in sys.argv[1:])
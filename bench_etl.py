@@ -0,0 +1,61 @@
+"""So sánh tốc độ engine biến đổi dữ liệu nguồn: pandas vs polars.
+
+Chạy:  python bench_etl.py [số_dòng ...]   (mặc định 100000 300000 1000000)
+Dữ liệu giả lập giống get_all_values (list các list str), đi qua đúng fetch_data của auto_job
+với data truyền sẵn nên không gọi API. Mỗi kịch bản đều kiểm tra 2 engine cho ra cùng kết quả.
+"""
+import sys
+import time
+import random
+
+import auto_job as aj
+
+NUM_COLS = 20
+
+SCENARIOS = [
+    ("Lấy hết", {}),
+    ("Cột + lọc số", {aj.COL_DATA_RANGE: "B:M", aj.COL_FILTER: "SoLuong > 500"}),
+    ("Lọc contains + header", {aj.COL_FILTER: "TrangThai contains 'giao'", aj.COL_HEADER: "TRUE"}),
+]
+
+def make_data(n_rows, seed=42):
+    rnd = random.Random(seed)
+    header = ["Ma", "SoLuong", "TrangThai"] + [f"Cot_{i}" for i in range(NUM_COLS - 3)]
+    status = ["Đã giao", "Chờ giao", "Huỷ", "", "null"]
+    rows = [header]
+    for i in range(n_rows):
+        rows.append([f"DH{i:07d}", str(rnd.randint(0, 1000)) if i % 50 else "", rnd.choice(status)]
+                    + [f"v{rnd.randint(0, 99999)}" for _ in range(NUM_COLS - 3)])
+    return rows
+
+def run_engine(data, extra, engine):
+    cfg = {aj.COL_SRC_LINK: "https://docs.google.com/spreadsheets/d/BENCH_SOURCE_ID/edit",
+           aj.COL_SRC_SHEET: "Data", aj.COL_MONTH: "10/2026"}
+    cfg.update(extra)
+    t0 = time.perf_counter()
+    df, msg = aj.fetch_data(cfg, creds=None, data=data, engine=engine)
+    return time.perf_counter() - t0, df, msg
+
+def same_output(df_a, df_b):
+    # Bỏ qua index: writer luôn pd.concat(..., ignore_index=True)
+    return (df_a.columns.tolist() == df_b.columns.tolist()
+            and df_a.reset_index(drop=True).astype(object).equals(df_b.reset_index(drop=True).astype(object)))
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [100_000, 300_000, 1_000_000]
+    print(f"{'Rows':>10} | {'Kịch bản':<24} | {'pandas (s)':>10} | {'polars (s)':>10} | {'x':>5} | Khớp")
+    ok = True
+    for n in sizes:
+        data = make_data(n)
+        for name, extra in SCENARIOS:
+            t_pd, df_pd, msg_pd = run_engine(data, extra, "pandas")
+            t_pl, df_pl, msg_pl = run_engine(data, extra, "polars")
+            match = msg_pd == msg_pl == "OK" and same_output(df_pd, df_pl)
+            ok &= match
+            print(f"{n:>10} | {name:<24} | {t_pd:>10.2f} | {t_pl:>10.2f} | {t_pd / t_pl:>5.1f} | {'✅' if match else '❌'}")
+            del df_pd, df_pl
+        del data
+    if not ok: sys.exit("❌ Kết quả 2 engine không khớp")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Đo thời gian khởi động của auto_job trên đường "không có lịch" và kiểm tra ngân sách.
+
+Chạy:  python bench_startup.py [ngân_sách_ms]   (mặc định STARTUP_BUDGET_MS hoặc 1000)
+Mỗi lần đo chạy 1 process Python mới (cold start): import auto_job rồi quyết định lịch cho NUM_SCHED_ROWS dòng
+sys_config giả lập (giá trị giống values:batchGet, không gọi API), không dòng nào tới mốc. Lấy trung vị REPEAT lần.
+Fail (exit != 0) nếu vượt ngân sách hoặc đường này lỡ nạp module nặng (pandas, polars, ...).
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+REPEAT = 5
+NUM_SCHED_ROWS = 200
+HEAVY_MODULES = ["pandas", "polars", "numpy", "gspread_dataframe", "smart_filter"]
+
+CHILD = r"""
+import sys, json, time
+t0 = time.perf_counter()
+import auto_job as aj
+t1 = time.perf_counter()
+from datetime import datetime
+header = [aj.SCHED_COL_BLOCK, aj.SCHED_COL_TYPE, aj.SCHED_COL_VAL1, aj.SCHED_COL_VAL2]
+values = [header] + [[f"Block_{{i}}", "Hàng ngày", "08:00", ""] for i in range({n})]
+rows = aj.schedule_rows(values)
+now = aj.VN_TZ.localize(datetime(2026, 10, 18, 15, 0))
+ledger = {{aj.schedule_slot_key(r): datetime(2026, 10, 18, 8, 0) for r in rows}}
+decisions, _ = aj.plan_schedule(rows, ledger, now)
+assert not any(d["fire"] for d in decisions)
+t2 = time.perf_counter()
+print(json.dumps({{"import_ms": (t1 - t0) * 1000, "plan_ms": (t2 - t1) * 1000,
+                   "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+ETL_CHILD = r"""
+import time
+t0 = time.perf_counter()
+import pandas, polars, gspread_dataframe, smart_filter
+print((time.perf_counter() - t0) * 1000)
+"""
+
+def run_child(code):
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True, check=True)
+    return out.stdout.strip().splitlines()[-1]
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else float(os.environ.get("STARTUP_BUDGET_MS", "1000"))
+    code = CHILD.format(n=NUM_SCHED_ROWS, heavy=HEAVY_MODULES)
+    runs = [json.loads(run_child(code)) for _ in range(REPEAT)]
+    imp = statistics.median(r["import_ms"] for r in runs)
+    plan = statistics.median(r["plan_ms"] for r in runs)
+    heavy = sorted({m for r in runs for m in r["heavy"]})
+    etl = statistics.median(float(run_child(ETL_CHILD)) for _ in range(REPEAT))
+
+    print(f"{'import auto_job':<28} | {imp:>8.0f} ms")
+    print(f"{'quyết định lịch (' + str(NUM_SCHED_ROWS) + ' dòng)':<28} | {plan:>8.0f} ms")
+    print(f"{'tổng (ngân sách ' + f'{budget:.0f}' + ')':<28} | {imp + plan:>8.0f} ms")
+    print(f"{'(tham khảo) stack ETL':<28} | {etl:>8.0f} ms  <- không nạp trên đường không có lịch")
+    print(f"Module nặng đã nạp: {', '.join(heavy) or 'không'}")
+
+    if heavy: sys.exit(f"❌ Đường không có lịch nạp module nặng: {', '.join(heavy)}")
+    if imp + plan > budget: sys.exit(f"❌ Khởi động {imp + plan:.0f} ms vượt ngân sách {budget:.0f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""So sánh bước ghi: ghép toàn bộ rồi căn cột (cách cũ) vs căn từng nguồn theo lát (iter_aligned_slices).
+
+Chạy:  python bench_write.py [tổng_số_dòng ...]   (mặc định 100000 300000)
+Mỗi lần chạy giả lập NUM_SOURCES nguồn (header lệch nhau một phần) ghi vào 1 sheet đích; append_rows được
+thay bằng hàm gom số dòng nên không gọi API. Đo thời gian và bộ nhớ đỉnh (tracemalloc) riêng từng cách,
+đồng thời kiểm tra 2 cách cho ra đúng cùng các dòng theo cùng thứ tự.
+"""
+import sys
+import time
+import hashlib
+import tracemalloc
+
+import pandas as pd
+
+import auto_job as aj
+
+NUM_SOURCES = 150
+CHUNK_SIZE = 5000  # lô append cố định của cách cũ
+
+def make_tasks(total_rows):
+    base = [f"Cot_{i}" for i in range(15)]
+    per = max(1, total_rows // NUM_SOURCES)
+    tasks = []
+    for s in range(NUM_SOURCES):
+        cols = base[:12] + ([f"Rieng_{s % 3}"] if s % 2 else [])
+        df = pd.DataFrame({c: [f"{s}-{c}-{i}" for i in range(per)] for c in cols})
+        df[aj.SYS_COL_LINK] = f"https://docs.google.com/spreadsheets/d/SRC{s:04d}/edit"
+        df[aj.SYS_COL_SHEET] = "Data"; df[aj.SYS_COL_MONTH] = "10/2026"
+        tasks.append((df, df[aj.SYS_COL_LINK].iloc[0], s))
+    headers = aj.union_columns([df for df, _, _ in tasks])
+    return tasks, headers
+
+def write_concat(tasks, headers, sink):
+    """Cách cũ: pd.concat dồn trong vòng lặp -> df_aligned từng cột -> .values.tolist() cả khối"""
+    df_new_all = pd.DataFrame()
+    for df, _, _ in tasks:
+        df_new_all = pd.concat([df_new_all, df], ignore_index=True)
+    df_aligned = pd.DataFrame()
+    for col in headers:
+        if col in df_new_all.columns: df_aligned[col] = df_new_all[col]
+        else: df_aligned[col] = ""
+    new_vals = df_aligned.fillna('').values.tolist()
+    for i in range(0, len(new_vals), CHUNK_SIZE): sink(new_vals[i:i + CHUNK_SIZE])
+
+def write_stream(tasks, headers, sink):
+    opened, _ = aj.open_task_streams(tasks)
+    counts, failed = {}, {}
+    for vals in aj.iter_aligned_slices(opened, headers, aj.APPEND_SLICE_ROWS, counts, failed): sink(vals)
+
+def run(fn, tasks, headers, trace):
+    digest, n = hashlib.blake2b(digest_size=16), [0]
+    def sink(vals):
+        n[0] += len(vals)
+        for row in vals: digest.update("\x1f".join(row).encode("utf-8"))
+    if trace: tracemalloc.start()
+    t0 = time.perf_counter()
+    fn(tasks, headers, sink)
+    elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] if trace else 0
+    if trace: tracemalloc.stop()
+    return elapsed, peak / 2**20, n[0], digest.hexdigest()
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [100_000, 300_000]
+    print(f"{'Rows':>10} | {'concat (s)':>10} | {'stream (s)':>10} | {'concat MB':>9} | {'stream MB':>9} | Khớp")
+    ok = True
+    for total in sizes:
+        tasks, headers = make_tasks(total)
+        t_old, _, n_old, h_old = run(write_concat, tasks, headers, trace=False)
+        t_new, _, n_new, h_new = run(write_stream, tasks, headers, trace=False)
+        _, m_old, _, _ = run(write_concat, tasks, headers, trace=True)
+        _, m_new, _, _ = run(write_stream, tasks, headers, trace=True)
+        match = n_old == n_new and h_old == h_new
+        ok &= match
+        print(f"{n_old:>10} | {t_old:>10.2f} | {t_new:>10.2f} | {m_old:>9.0f} | {m_new:>9.0f} | {'✅' if match else '❌'}")
+        del tasks
+    if not ok: sys.exit("❌ Kết quả 2 cách ghi không khớp")
+
+if __name__ == "__main__":
+    main()
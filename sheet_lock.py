@@ -0,0 +1,159 @@
+"""Khóa thuê (lease) theo đích trên tab sys_lock, dùng chung cho app.py và auto_job.py.
+
+sys_lock là nhật ký chỉ append: mỗi lần lấy/gia hạn/trả khóa thêm dòng mới. Thứ tự dòng do server Sheets quyết định
+nên mọi client dựng lại cùng 1 trạng thái từ nhật ký (fold_leases); ai có dòng CLAIM được nhận trước là người giữ
+(compare-and-set: ghi rồi đọc lại). Token tăng dần theo từng resource, kiểm tra trước mỗi lần ghi (fencing).
+"""
+import time
+import uuid
+import threading
+from datetime import datetime
+from collections import defaultdict
+
+import gspread
+import pytz
+
+from sheets_api import safe_api_call, api_call_once, get_wks_with_retry, add_wks_pooled, quote_sheet_title
+
+SHEET_LOCK_NAME = "sys_lock"
+
+# Lease hết hạn sau LOCK_LEASE_SECONDS nếu không gia hạn; nhật ký dài quá LOCK_COMPACT_ROWS dòng
+# thì người trả khóa dọn bớt đoạn đầu đã hết hạn
+LOCK_COLS = ["resource", "lease_id", "owner", "token", "lease_until", "event", "at", "Thời gian"]
+LOCK_EVENT_CLAIM = "CLAIM"
+LOCK_EVENT_RELEASE = "RELEASE"
+LOCK_LEASE_SECONDS = 300
+# Hạn lease ghi theo đồng hồ máy của từng client: lease của người khác coi như còn thêm LOCK_SKEW_SECONDS giây
+# (bù lệch đồng hồ giữa các máy) trước khi được lấy lại
+LOCK_SKEW_SECONDS = 30
+LOCK_COMPACT_ROWS = 500
+LOCK_VALUE_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE"}
+LOCK_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+
+def lock_resource(sheet_id, title):
+    return f"{sheet_id}/{str(title).strip()}"
+
+class LeaseLostError(Exception):
+    """Mất khóa đích giữa lúc ghi (lease hết hạn và người khác đã lấy) -> dừng ghi"""
+    pass
+
+def check_fence(fence):
+    """Gọi giữa các lô của 1 lần ghi dài: fence() gia hạn lease khi cần, False = đã mất khóa"""
+    if fence is not None and not fence(): raise LeaseLostError("Mất khóa đích giữa lúc ghi - dừng ghi")
+
+def fold_leases(values):
+    """Trạng thái khóa từ nhật ký sys_lock: ({resource: {lease_id, owner, token, until}}, token lớn nhất đã thấy).
+    CLAIM được nhận nếu resource không có ai giữ (còn hạn tại thời điểm ghi) và token lớn hơn token đã cấp trước đó;
+    CLAIM cùng lease_id khi còn hạn = gia hạn. Lease hết hạn (quá LOCK_SKEW_SECONDS) coi như mất, phải lấy lại bằng token mới."""
+    holders, last_token, max_token = {}, {}, 0
+    for r in values[1:]:
+        r = list(r) + [""] * len(LOCK_COLS)
+        res, lease_id, owner, event = str(r[0]), str(r[1]), str(r[2]), str(r[5])
+        try: token, until, at = int(float(r[3] or 0)), float(r[4] or 0), float(r[6] or 0)
+        except (TypeError, ValueError): continue
+        if not res or not lease_id: continue
+        max_token = max(max_token, token)
+        h = holders.get(res)
+        live = h is not None and h["until"] + LOCK_SKEW_SECONDS > at
+        if event == LOCK_EVENT_RELEASE:
+            if h and h["lease_id"] == lease_id: holders.pop(res)
+        elif live:
+            if h["lease_id"] == lease_id: h["until"] = max(h["until"], until)
+        elif token > last_token.get(res, 0):
+            last_token[res] = token
+            holders[res] = {"lease_id": lease_id, "owner": owner, "token": token, "until": until}
+    return holders, max_token
+
+def read_lock_table(sh):
+    """(worksheet sys_lock, giá trị). Tạo tab / đổi từ định dạng khóa toàn cục cũ nếu cần"""
+    try: wks = get_wks_with_retry(sh, SHEET_LOCK_NAME)
+    except gspread.WorksheetNotFound: wks = add_wks_pooled(sh, SHEET_LOCK_NAME, rows=1000, cols=len(LOCK_COLS))
+    values = safe_api_call(sh.values_get, quote_sheet_title(SHEET_LOCK_NAME), params=LOCK_VALUE_PARAMS).get("values", [])
+    if not values or [str(v) for v in values[0]] != LOCK_COLS:
+        safe_api_call(wks.clear); safe_api_call(wks.update, range_name="A1", values=[LOCK_COLS])
+        values = [LOCK_COLS]
+    return wks, values
+
+def claim_leases(sh, wks, lease, resources, event=LOCK_EVENT_CLAIM):
+    """Ghi dòng CLAIM/RELEASE của lease cho resources (1 append). CLAIM thì đọc lại nhật ký: trả về (các resource lease
+    đang giữ, trạng thái, số dòng nhật ký)"""
+    now = time.time()
+    until = now + LOCK_LEASE_SECONDS if event == LOCK_EVENT_CLAIM else now
+    stamp = datetime.now(LOCK_TZ).strftime("%d/%m/%Y %H:%M:%S")
+    rows = [[res, lease["id"], lease["owner"], lease["tokens"].get(res, lease["token"]), round(until, 3), event, round(now, 3), stamp] for res in resources]
+    safe_api_call(wks.append_rows, rows, value_input_option="RAW")
+    if event != LOCK_EVENT_CLAIM: return [], {}, 0
+    values = safe_api_call(sh.values_get, quote_sheet_title(SHEET_LOCK_NAME), params=LOCK_VALUE_PARAMS).get("values", [])
+    holders, _ = fold_leases(values)
+    won = [r for r in resources if r in holders and holders[r]["lease_id"] == lease["id"] and holders[r]["until"] > now]
+    return won, holders, len(values)
+
+def acquire_leases(sh, owner, resources, all_or_none=False):
+    """Lấy lease trên các resource còn trống. Mặc định (auto_job) đích nào đang bị khóa thì bỏ qua đích đó;
+    all_or_none=True (app) thì phải giữ được tất cả, không thì trả lại phần đã lấy.
+    Trả về lease, lease["resources"] = các resource giữ được"""
+    lease = {"id": uuid.uuid4().hex[:12], "owner": owner, "token": 0, "tokens": {}, "resources": [],
+             "until": float("inf"), "lock": threading.Lock()}
+    resources = list(dict.fromkeys(resources))
+    if not resources: return lease
+    try:
+        wks, values = read_lock_table(sh)
+        holders, max_token = fold_leases(values)
+        now = time.time()
+        free = [r for r in resources if not (r in holders and holders[r]["until"] + LOCK_SKEW_SECONDS > now)]
+        if not free or (all_or_none and len(free) < len(resources)): return lease
+        lease["token"] = max_token + 1
+        won, holders, n_rows = claim_leases(sh, wks, lease, free)
+        if all_or_none and len(won) < len(resources):
+            if won: claim_leases(sh, wks, lease, won, LOCK_EVENT_RELEASE)
+            return lease
+        if won:
+            lease.update(resources=won, tokens={r: holders[r]["token"] for r in won}, until=min(holders[r]["until"] for r in won), log_rows=n_rows)
+    except Exception as e:
+        print(f"⚠️ Không lấy được khóa đích: {e}")
+    return lease
+
+def renew_lease(sh, lease):
+    """Fencing trước mỗi lần ghi: còn giữ lease (gia hạn khi đã qua nửa thời hạn)? False = đã mất khóa, không được ghi"""
+    with lease["lock"]:
+        if time.time() < lease["until"] - LOCK_LEASE_SECONDS / 2: return True
+        try:
+            won, holders, _ = claim_leases(sh, get_wks_with_retry(sh, SHEET_LOCK_NAME), lease, lease["resources"])
+            if any(r not in won or holders[r]["token"] != lease["tokens"][r] for r in lease["resources"]): return False
+            lease["until"] = min(holders[r]["until"] for r in won)
+            return True
+        except Exception as e:
+            print(f"⚠️ Không gia hạn được khóa: {e}"); return False
+
+def release_leases(sh, lease):
+    if not lease["resources"]: return
+    try:
+        claim_leases(sh, get_wks_with_retry(sh, SHEET_LOCK_NAME), lease, lease["resources"], LOCK_EVENT_RELEASE)
+        if lease.get("log_rows", 0) > LOCK_COMPACT_ROWS and SHEET_LOCK_NAME not in lease["resources"]:
+            compact_lock_table(sh, lease["owner"])
+    except Exception as e:
+        print(f"⚠️ Không trả được khóa: {e}")
+
+def compact_lock_table(sh, owner):
+    """Xóa đoạn đầu nhật ký sys_lock đã chết (lease hết hạn quá 2 lần thời hạn). Chỉ 1 người dọn nhờ lease trên chính
+    tab sys_lock; các client khác chỉ append ở cuối nên vị trí đoạn đầu không đổi khi xóa"""
+    lease = acquire_leases(sh, owner, [SHEET_LOCK_NAME])
+    if not lease["resources"]: return
+    try:
+        wks, values = read_lock_table(sh)
+        cutoff = time.time() - LOCK_LEASE_SECONDS * 2
+        last_until = defaultdict(float)
+        for r in values[1:]:
+            r = list(r) + [""] * len(LOCK_COLS)
+            try: last_until[str(r[1])] = max(last_until[str(r[1])], float(r[4] or 0), float(r[6] or 0))
+            except (TypeError, ValueError): pass
+        dead = 0
+        for r in values[1:-1]:
+            if last_until[str((list(r) + ["", ""])[1])] >= cutoff: break
+            dead += 1
+        if dead:
+            # Gửi 1 lần: claim mới vẫn được append trong lúc dọn nên không kiểm lại được số dòng; gửi lại sau khi đã áp dụng
+            # sẽ xóa nhầm lease đang sống. Dọn là best-effort, lần sau dọn tiếp
+            api_call_once(wks.delete_rows, 2, dead + 1)
+            print(f"🧹 Đã dọn {dead} dòng nhật ký khóa")
+    finally: release_leases(sh, lease)
@@ -0,0 +1,443 @@
+"""Ghi dữ liệu vào sheet đích, dùng chung cho app.py và auto_job.py.
+
+- AppendBatcher: append theo byte payload, mục tiêu mỗi request tự chỉnh theo throughput đo được.
+- write_diff_sync (chế độ "diff"): so hash từng dòng theo key (Link, Sheet, Tháng), chỉ ghi dòng thay đổi.
+- AtomicWriter / write_atomic_sync (chế độ "atomic"): ghi staging xuống dưới dữ liệu cũ, header + xóa dòng cũ
+  trong 1 batchUpdate -> đích hoặc toàn cũ, hoặc toàn mới.
+Các hàm nhận log_container (st / khung trạng thái của Streamlit, hoặc PrintLog khi chạy nền) để báo tiến độ.
+Dữ liệu nguồn là DataFrame đã biến đổi; module không import pandas (auto_job nạp module này cả khi không có lịch).
+"""
+import time
+import bisect
+import hashlib
+import re
+from collections import defaultdict
+
+import gspread
+
+from sheets_api import (_QUOTA_WAIT, GridChangeUnknownError, safe_api_call, send_grid_change, is_payload_too_large,
+                        quote_sheet_title, get_grid_size)
+from sheet_lock import check_fence
+
+SYS_COL_LINK = "Link file nguồn"; SYS_COL_SHEET = "Sheet nguồn"; SYS_COL_MONTH = "Tháng"
+
+# Append theo byte payload: mục tiêu mỗi request tự chỉnh trong [MIN, MAX] để 1 request ~APPEND_TARGET_SECONDS.
+# MAX giữ dưới giới hạn kích thước request của Sheets API (~10MB); dữ liệu được căn header theo lát APPEND_SLICE_ROWS dòng
+APPEND_START_BYTES = 1024 * 1024
+APPEND_MIN_BYTES = 64 * 1024
+APPEND_MAX_BYTES = 8 * 1024 * 1024
+APPEND_TARGET_SECONDS = 5.0
+APPEND_SLICE_ROWS = 1000
+
+# Planner ghi replace: chi phí ước lượng (giây) để chọn giữa xóa từng vùng + append và ghi lại toàn bộ đích
+DELETE_BATCH_SIZE = 100                 # số vùng deleteDimension / 1 batchUpdate
+PLAN_REQUEST_SECONDS = 1.0              # 1 request ghi: round trip + 1 token quota ghi
+PLAN_DELETE_RANGE_SECONDS = 0.05        # mỗi vùng xóa: Sheets phải dời toàn bộ dòng phía dưới
+PLAN_BYTES_PER_SECOND = APPEND_START_BYTES / APPEND_TARGET_SECONDS
+TX_MAX_BYTES = APPEND_MAX_BYTES           # payload tối đa 1 lần ghi staging (values.update, chế độ atomic)
+
+class PrintLog:
+    """log_container khi chạy ngoài Streamlit (auto_job): in ra stdout"""
+    def write(self, msg): print(f"  {msg}")
+    def error(self, msg): print(f"  {msg}")
+
+
+# --- APPEND THEO BYTE ---
+def union_columns(frames):
+    """Hợp các cột theo thứ tự xuất hiện (giống cột của pd.concat(frames))"""
+    return list(dict.fromkeys(c for df in frames for c in df.columns))
+
+def task_keys(df):
+    """Tập key (Link, Sheet, Tháng) có trong df"""
+    if df.empty: return set()
+    k = df[[SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH]].drop_duplicates()
+    return set(zip(*(k[c].astype(str).str.strip() for c in k.columns)))
+
+def align_rows(df, headers):
+    """DataFrame -> list các dòng theo đúng thứ tự cột của sheet đích (cột thiếu = "")"""
+    return df.reindex(columns=headers, fill_value="").fillna('').values.tolist()
+
+def iter_aligned_slices(opened, headers, slice_rows, counts, failed):
+    """Căn từng nguồn theo header đích và trả ra lần lượt từng lát <= slice_rows dòng.
+    Không ghép dữ liệu các nguồn lại với nhau: tại mỗi thời điểm chỉ giữ 1 lát đã căn.
+    Ghi counts[r_idx] = số dòng đã đưa ra; nguồn đọc theo trang lỗi giữa chừng -> failed[r_idx] = lỗi."""
+    for first, rest, _, r_idx in opened:
+        counts[r_idx] = 0
+        parts = iter(rest) if rest is not None else iter(())
+        part = first
+        while part is not None:
+            for i in range(0, len(part), slice_rows):
+                rows = align_rows(part.iloc[i:i + slice_rows], headers)
+                counts[r_idx] += len(rows)
+                yield rows
+            try: part = next(parts, None)
+            except Exception as e: failed[r_idx] = str(e); part = None
+
+def row_payload_bytes(row):
+    """Ước lượng số byte JSON của 1 dòng trong body append_rows (ô là chuỗi có ngoặc kép + dấu phẩy)"""
+    return len(",".join(map(str, row)).encode("utf-8")) + 2 * len(row) + 2
+
+class AppendBatcher:
+    """Gom dòng thành các lần append_rows theo số byte payload thay vì số dòng cố định.
+    Mục tiêu byte/request tự chỉnh theo throughput đo được (mỗi request ~APPEND_TARGET_SECONDS, không tính
+    thời gian chờ quota); request bị từ chối vì quá lớn -> chia đôi lô, ghi lại từng nửa và hạ trần mục tiêu.
+    fence (nếu có) được gọi trước mỗi lô: ghi lâu vẫn giữ được lease, mất lease thì dừng."""
+    def __init__(self, wks, fence=None):
+        self.wks, self.fence = wks, fence
+        self.target = APPEND_START_BYTES
+        self.ceiling = APPEND_MAX_BYTES
+        self.rows, self.size = [], 0
+        self.requests = 0
+
+    def add(self, rows):
+        for row in rows:
+            self.rows.append(row); self.size += row_payload_bytes(row)
+            if self.size >= self.target: self.flush()
+
+    def flush(self):
+        if not self.rows: return
+        rows, size = self.rows, self.size
+        self.rows, self.size = [], 0
+        check_fence(self.fence)
+        self.send(rows, size)
+
+    def send(self, rows, size):
+        _QUOTA_WAIT.seconds = 0.0
+        t0 = time.time()
+        try:
+            safe_api_call(self.wks.append_rows, rows, value_input_option='USER_ENTERED')
+        except Exception as e:
+            if len(rows) < 2 or not is_payload_too_large(e): raise
+            self.ceiling = max(APPEND_MIN_BYTES, size // 2)
+            self.target = min(self.target, self.ceiling)
+            mid = len(rows) // 2
+            left = sum(row_payload_bytes(r) for r in rows[:mid])
+            self.send(rows[:mid], left); self.send(rows[mid:], size - left)
+            return
+        self.requests += 1
+        # Lô nhỏ (lô cuối) bị chi phối bởi độ trễ cố định -> không dùng để chỉnh
+        if size < self.target // 2: return
+        elapsed = time.time() - t0 - _QUOTA_WAIT.seconds
+        want = size / elapsed * APPEND_TARGET_SECONDS if elapsed > 0.05 else self.target * 2
+        self.target = int(max(APPEND_MIN_BYTES, min(self.ceiling, self.target * 2, (self.target + want) / 2)))
+
+# --- [REPLACE] XÓA DÒNG CŨ THEO KEY ---
+def get_rows_to_delete_dynamic(all_values, keys_to_delete):
+    """Số dòng (tính từ 1) trên sheet đích thuộc các key (Link, Sheet, Tháng) cần thay"""
+    if not all_values: return []
+    headers = all_values[0]
+    try:
+        idx_link = headers.index(SYS_COL_LINK); idx_sheet = headers.index(SYS_COL_SHEET); idx_month = headers.index(SYS_COL_MONTH)
+    except ValueError: return [] 
+    rows_to_delete = []
+    for i, row in enumerate(all_values[1:], start=2): 
+        l = row[idx_link].strip() if len(row) > idx_link else ""
+        s = row[idx_sheet].strip() if len(row) > idx_sheet else ""
+        m = row[idx_month].strip() if len(row) > idx_month else ""
+        if (l, s, m) in keys_to_delete: rows_to_delete.append(i)
+    return rows_to_delete
+
+def contiguous_ranges(row_indices):
+    """Các số dòng -> [(start, end)] liên tiếp, xếp từ dưới lên (xóa không làm lệch vùng phía trên)"""
+    ranges = []
+    for r in sorted(row_indices, reverse=True):
+        if ranges and r == ranges[-1][0] - 1: ranges[-1] = (r, ranges[-1][1])
+        else: ranges.append((r, r))
+    return ranges
+
+def plan_replace_write(all_values, rows_to_del):
+    """Chọn cách ghi chế độ atomic cho 1 đích theo chi phí API ước lượng (giây):
+    - "delete": commit xóa từng vùng liên tiếp của dòng cũ
+    - "rewrite": commit xóa 1 vùng gồm mọi dòng dữ liệu cũ, các dòng của key khác được đọc lại (công thức) và ghi staging
+    Ở atomic mọi deleteDimension nằm trong 1 batchUpdate commit -> commit = 1 request + chi phí dời dòng mỗi vùng.
+    Phần ghi dữ liệu mới như nhau ở 2 cách nên không tính vào chi phí. Chỉ dùng trong chế độ atomic: "rewrite"
+    ngoài atomic lỗi giữa chừng sẽ mất dữ liệu của key khác (replace luôn xóa theo dòng)."""
+    ranges = contiguous_ranges(rows_to_del)
+    plan = {"strategy": "delete", "ranges": len(ranges), "kept": len(all_values) - 1 - len(rows_to_del),
+            "cost_delete": 0.0, "cost_rewrite": 0.0}
+    if not ranges: return plan
+    plan["cost_delete"] = PLAN_REQUEST_SECONDS + len(ranges) * PLAN_DELETE_RANGE_SECONDS
+    del_set = set(rows_to_del)
+    kept_bytes = sum(row_payload_bytes(row) for i, row in enumerate(all_values[1:], start=2) if i not in del_set)
+    # commit (1 vùng) + 1 lần đọc công thức + số lô staging thêm cho phần giữ lại
+    plan["cost_rewrite"] = ((2 + -(-kept_bytes // TX_MAX_BYTES)) * PLAN_REQUEST_SECONDS + PLAN_DELETE_RANGE_SECONDS
+                            + kept_bytes / PLAN_BYTES_PER_SECOND)
+    if plan["cost_rewrite"] < plan["cost_delete"]: plan["strategy"] = "rewrite"
+    return plan
+
+# Dòng giữ lại khi ghi lại toàn bộ: đọc công thức + số thô (ghi lại chuỗi hiển thị sẽ mất công thức, lệch locale)
+KEEP_VALUE_PARAMS = {"valueRenderOption": "FORMULA", "dateTimeRenderOption": "FORMATTED_STRING"}
+
+def kept_row_values(row):
+    """1 dòng đọc theo KEEP_VALUE_PARAMS -> giá trị ghi USER_ENTERED ra đúng ô cũ (chuỗi bắt đầu bằng ' được escape
+    như set_with_dataframe, nếu không Sheets sẽ nuốt dấu ' đầu)"""
+    return [("'" + v) if isinstance(v, str) and v.startswith("'") else v for v in row]
+
+def delete_rows_request(sheet_id, start, end):
+    """deleteDimension cho các dòng start..end (tính từ 1, gồm cả 2 đầu)"""
+    return {"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}}}
+
+def batch_delete_rows(sh, wks, row_indices, log_container=None):
+    """Xóa các dòng (tính từ 1) theo vùng liên tiếp, DELETE_BATCH_SIZE vùng / batchUpdate. Mỗi lô gửi qua send_grid_change
+    (không retry mù: lô bị gửi lại sau khi đã áp dụng sẽ xóa nhầm dòng dữ liệu phía trên)"""
+    if not row_indices: return
+    ranges = contiguous_ranges(row_indices)
+    grid = get_grid_size(sh, wks)
+    for i in range(0, len(ranges), DELETE_BATCH_SIZE):
+        if log_container: log_container.write(f"✂️ Xóa batch {i//DELETE_BATCH_SIZE + 1}...")
+        batch = ranges[i:i+DELETE_BATCH_SIZE]
+        after = (grid[0] - sum(end - start + 1 for start, end in batch), grid[1])
+        send_grid_change(sh, wks, [delete_rows_request(wks.id, start, end) for start, end in batch], grid, after)
+        grid = after
+
+# --- [DIFF SYNC] CHỈ GHI DÒNG THAY ĐỔI ---
+# Đích đọc giá trị thô (số không theo định dạng cột đích), nguồn là chuỗi hiển thị -> cả 2 phía qua diff_cell_key
+DIFF_VALUE_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}
+NUM_TEXT_RE = re.compile(r"[-+]?(?:\d{1,3}(?:,\d{3})+|\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?%?")
+
+def diff_cell_key(v):
+    """Dạng chuẩn 1 ô để so hash: số thô của đích và chuỗi số hiển thị của nguồn ("1,234.5", "12%") về cùng 1 dạng,
+    TRUE/FALSE viết hoa, còn lại là chuỗi bỏ khoảng trắng 2 đầu. Khác locale (1.234,5) thì không khớp -> ghi lại như cũ."""
+    if isinstance(v, bool): return "TRUE" if v else "FALSE"
+    if isinstance(v, (int, float)): return format(v, ".15g")
+    s = str(v).strip()
+    if s.upper() in ("TRUE", "FALSE"): return s.upper()
+    if any(ch.isdigit() for ch in s) and NUM_TEXT_RE.fullmatch(s):
+        x = float(s.rstrip("%").replace(",", ""))
+        return format(x / 100 if s.endswith("%") else x, ".15g")
+    return s
+
+def row_hash(values):
+    """Hash nội dung 1 dòng (đã căn theo header đích), từng ô qua diff_cell_key"""
+    return hashlib.blake2b("\x1f".join(diff_cell_key(v) for v in values).encode("utf-8"), digest_size=16).digest()
+
+def plan_diff_sync(all_values, headers, new_rows_by_key):
+    """So khớp hash theo key (Link, Sheet, Tháng) giữa dữ liệu đích hiện có và dữ liệu mới.
+    Dòng trùng hash -> giữ nguyên; dòng cũ thừa -> ghi đè bằng dòng mới lệch hash, còn thừa thì xóa;
+    dòng mới còn lại -> append. Trả về (updates [(số dòng, values)], deletes [số dòng], appends [values],
+    layout {key: ([số dòng cũ còn giữ], số dòng append)})."""
+    n_cols = len(headers)
+    idx_link = headers.index(SYS_COL_LINK); idx_sheet = headers.index(SYS_COL_SHEET); idx_month = headers.index(SYS_COL_MONTH)
+    wanted = {tuple(diff_cell_key(v) for v in key): key for key in new_rows_by_key}
+    old_by_key = defaultdict(list)
+    for i, row in enumerate(all_values[1:], start=2):
+        cells = (list(row) + [""] * n_cols)[:n_cols]
+        key = wanted.get((diff_cell_key(cells[idx_link]), diff_cell_key(cells[idx_sheet]), diff_cell_key(cells[idx_month])))
+        if key is not None: old_by_key[key].append((i, row_hash(cells)))
+
+    updates, deletes, appends, layout = [], [], [], {}
+    for key, new_rows in new_rows_by_key.items():
+        pending = defaultdict(list)
+        for j, vals in enumerate(new_rows): pending[row_hash(vals)].append(j)
+        keep_rows, free_rows = [], []
+        for row_num, h in old_by_key.get(key, []):
+            if pending.get(h): pending[h].pop(0); keep_rows.append(row_num)
+            else: free_rows.append(row_num)
+        unmatched = sorted(j for lst in pending.values() for j in lst)
+        for row_num, j in zip(free_rows, unmatched):
+            updates.append((row_num, new_rows[j])); keep_rows.append(row_num)
+        deletes.extend(free_rows[len(unmatched):])
+        key_appends = [new_rows[j] for j in unmatched[len(free_rows):]]
+        appends.extend(key_appends)
+        layout[key] = (keep_rows, len(key_appends))
+    return updates, deletes, appends, layout
+
+def write_diff_sync(sh, wks, opened, headers, log_container, fence=None):
+    log_container.write("🔍 Diff: so khớp hash với dữ liệu cũ...")
+    all_values = safe_api_call(sh.values_get, quote_sheet_title(wks.title), params=DIFF_VALUE_PARAMS).get("values", []) or [headers]
+    new_rows_by_key = defaultdict(list)
+    for df, _, _, _ in opened:
+        if df.empty: continue
+        keys = zip(*(df[c].astype(str).str.strip() for c in (SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH)))
+        for key, vals in zip(keys, df.reindex(columns=headers, fill_value="").fillna('').astype(str).values.tolist()):
+            new_rows_by_key[key].append(vals)
+
+    updates, deletes, appends, layout = plan_diff_sync(all_values, headers, new_rows_by_key)
+    kept = sum(len(v[0]) for v in layout.values()) - len(updates)
+    log_container.write(f"🧮 Giữ {kept} | Sửa {len(updates)} | Xóa {len(deletes)} | Thêm {len(appends)}")
+
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip("0123456789")
+    batch = 500
+    for i in range(0, len(updates), batch):
+        check_fence(fence)
+        data = [{"range": f"A{r}:{last_col}{r}", "values": [v]} for r, v in updates[i:i+batch]]
+        safe_api_call(wks.batch_update, data, value_input_option='USER_ENTERED')
+    if deletes:
+        check_fence(fence)
+        batch_delete_rows(sh, wks, list(deletes), log_container)
+    batcher = AppendBatcher(wks, fence)
+    batcher.add(appends); batcher.flush()
+
+    # Vị trí cuối cùng của từng key sau khi xóa (dòng phía dưới bị đẩy lên) + append
+    deleted_sorted = sorted(deletes)
+    cursor = len(all_values) - len(deletes) + 1
+    key_span = {}
+    for key, (keep_rows, n_app) in layout.items():
+        pos = [r - bisect.bisect_left(deleted_sorted, r) for r in keep_rows]
+        if n_app: pos += [cursor, cursor + n_app - 1]; cursor += n_app
+        key_span[key] = f"{min(pos)} - {max(pos)}" if pos else ""
+
+    result_map = {}
+    for df, _, _, r_idx in opened:
+        if df.empty: result_map[r_idx] = ("Thành công", "", 0); continue
+        key = (str(df[SYS_COL_LINK].iloc[0]).strip(), str(df[SYS_COL_SHEET].iloc[0]).strip(), str(df[SYS_COL_MONTH].iloc[0]).strip())
+        result_map[r_idx] = ("Thành công", key_span.get(key, ""), len(df))
+    msg = f"Diff: sửa {len(updates)}, xóa {len(deletes)}, thêm {len(appends)} (giữ {kept})"
+    return True, msg, result_map
+
+# --- [ATOMIC] GHI STAGING + HEADER/XÓA TRONG 1 BATCHUPDATE ---
+class AtomicWriter:
+    """Ghi dữ liệu mới của 1 đích theo kiểu staging + commit nguyên tử.
+    Dữ liệu mới được ghi trước (staging) xuống dưới dữ liệu cũ bằng values.update USER_ENTERED (parse giống
+    append_rows của chế độ replace), theo lô TX_MAX_BYTES. batchUpdate cuối (commit, nguyên tử) mới sửa header
+    và xóa dòng cũ -> staging dồn lên đúng chỗ. Lỗi trước commit -> rollback xóa phần staging
+    => đích hoặc giữ nguyên dữ liệu cũ, hoặc có đủ dữ liệu mới. fence (nếu có) được gọi trước mỗi lô staging và commit.
+    Thêm/xóa dòng đi qua send_grid_change (gửi 1 lần, lỗi tạm thời thì đọc lại kích thước lưới) nên committed luôn đúng:
+    False = commit chắc chắn chưa áp dụng (được rollback), True = đã áp dụng, None = không xác định (không được rollback)."""
+    def __init__(self, sh, wks, base_rows, grid_rows, grid_cols, fence=None):
+        self.sh, self.wks, self.sheet_id, self.title, self.fence = sh, wks, wks.id, wks.title, fence
+        self.base_rows = base_rows          # số dòng đang có dữ liệu (kể cả header) -> staging bắt đầu ngay dưới
+        self.grid_rows, self.grid_cols = grid_rows, grid_cols
+        self.staged = 0
+        self.rows, self.size, self.width = [], 0, 0
+        self.limit = TX_MAX_BYTES
+        self.requests = 0
+        self.committed = False
+
+    def add(self, rows):
+        for row in rows:
+            row = list(row)
+            self.rows.append(row); self.size += row_payload_bytes(row); self.width = max(self.width, len(row))
+            if self.size >= self.limit: self.stage()
+
+    def grow(self, n_rows, n_cols):
+        """Nới lưới cho đủ n_rows x n_cols (values.update không tự thêm dòng/cột), 1 batchUpdate riêng"""
+        reqs = []
+        if n_rows > self.grid_rows:
+            reqs.append({"appendDimension": {"sheetId": self.sheet_id, "dimension": "ROWS", "length": n_rows - self.grid_rows}})
+        if n_cols > self.grid_cols:
+            reqs.append({"appendDimension": {"sheetId": self.sheet_id, "dimension": "COLUMNS", "length": n_cols - self.grid_cols}})
+        if not reqs: return
+        after = (max(n_rows, self.grid_rows), max(n_cols, self.grid_cols))
+        try: send_grid_change(self.sh, self.wks, reqs, (self.grid_rows, self.grid_cols), after)
+        except GridChangeUnknownError:
+            self.grid_rows, self.grid_cols = get_grid_size(self.sh, self.wks)
+            raise
+        self.grid_rows, self.grid_cols = after
+        self.requests += 1
+
+    def stage(self, rows=None):
+        if rows is None: rows, self.rows, self.size = self.rows, [], 0
+        if not rows: return
+        check_fence(self.fence)
+        at = self.base_rows + self.staged
+        # +1 dòng: commit xóa dòng cũ cần luôn còn ít nhất 1 dòng dưới dữ liệu (Sheets không cho xóa hết dòng không cố định)
+        self.grow(at + len(rows) + 1, self.width)
+        try:
+            safe_api_call(self.sh.values_update, f"{quote_sheet_title(self.title)}!A{at + 1}",
+                          params={"valueInputOption": "USER_ENTERED"}, body={"values": rows})
+        except Exception as e:
+            if len(rows) < 2 or not is_payload_too_large(e): raise
+            self.limit = max(APPEND_MIN_BYTES, self.limit // 2)
+            mid = len(rows) // 2
+            self.stage(rows[:mid]); self.stage(rows[mid:])
+            return
+        self.requests += 1
+        self.staged += len(rows)
+
+    def commit(self, header, delete_rows):
+        """Ghi nốt phần dữ liệu còn lại rồi batchUpdate cuối: header (nếu cần) + xóa delete_rows (số dòng tính từ 1, trước staging).
+        Chỉ sửa header thì batchUpdate idempotent (retry bình thường); có xóa dòng thì gửi 1 lần qua send_grid_change"""
+        self.stage()
+        self.grow(self.base_rows + self.staged + 1, len(header or []))
+        reqs = []
+        if header is not None:
+            reqs.append({"updateCells": {"range": {"sheetId": self.sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": len(header)},
+                                         "rows": [{"values": [{"userEnteredValue": {"stringValue": str(h)}} for h in header]}], "fields": "userEnteredValue"}})
+        for start, end in contiguous_ranges(delete_rows):
+            reqs.append(delete_rows_request(self.sheet_id, start, end))
+        if not reqs:
+            self.committed = True; return
+        check_fence(self.fence)
+        grid = (self.grid_rows, self.grid_cols)
+        self.committed = None
+        try:
+            if delete_rows: send_grid_change(self.sh, self.wks, reqs, grid, (grid[0] - len(delete_rows), grid[1]))
+            else: safe_api_call(self.sh.batch_update, {"requests": reqs})
+        except GridChangeUnknownError: raise
+        except Exception:
+            self.committed = False
+            raise
+        self.committed = True
+        self.requests += 1
+        self.grid_rows -= len(delete_rows)
+
+    def rollback(self):
+        """Xóa các dòng staging đã ghi (dữ liệu cũ phía trên không bị đụng tới). Chỉ gọi khi committed là False"""
+        if not self.staged: return
+        grid = get_grid_size(self.sh, self.wks)
+        send_grid_change(self.sh, self.wks, [delete_rows_request(self.sheet_id, self.base_rows + 1, self.base_rows + self.staged)],
+                         grid, (grid[0] - self.staged, grid[1]))
+        self.staged = 0
+
+def report_write_results(opened, counts, stream_failed, start_row, result_map, log_container):
+    """Ghi (trạng thái, vùng dòng, số dòng) của từng nguồn theo thứ tự đã ghi, bắt đầu từ start_row"""
+    current_cursor = start_row
+    for _, _, _, r_idx in opened:
+        count = counts.get(r_idx, 0)
+        end = current_cursor + count - 1
+        if r_idx in stream_failed:
+            log_container.error(f"❌ Lỗi đọc/ghi theo trang (đã ghi {count} dòng): {stream_failed[r_idx][:120]}")
+            result_map[r_idx] = ("Lỗi tải", f"{current_cursor} - {end}" if count else "", count)
+        else:
+            result_map[r_idx] = ("Thành công", f"{current_cursor} - {end}", count)
+        current_cursor += count
+    return result_map
+
+def write_atomic_sync(sh, wks, opened, result_map, log_container, fence=None):
+    """Chế độ "atomic": cùng kết quả với replace nhưng dữ liệu mới ghi trước xuống dưới (staging), sửa header +
+    xóa dòng cũ nằm trong 1 batchUpdate (commit) -> đích hoặc toàn cũ, hoặc toàn mới.
+    Round trip: get_all_values + metadata lưới (+ 1 lần đọc công thức nếu ghi lại toàn bộ) + số batchUpdate."""
+    log_container.write("🔒 Ghi nguyên tử: ghi staging, header + xóa trong 1 batchUpdate...")
+    all_values = safe_api_call(wks.get_all_values)
+    grid_rows, grid_cols = get_grid_size(sh, wks)
+    old_headers = list(all_values[0]) if all_values else []
+    while old_headers and old_headers[-1] == "": old_headers.pop()
+    headers = old_headers.copy() if old_headers else union_columns([first for first, _, _, _ in opened])
+    for col in [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH]:
+        if col not in headers: headers.append(col)
+    values = all_values or [headers]
+
+    keys = set()
+    for first, _, _, _ in opened: keys |= task_keys(first)
+    rows_to_del = get_rows_to_delete_dynamic(values, keys)
+    plan = plan_replace_write(values, rows_to_del)
+    writer = AtomicWriter(sh, wks, len(values), grid_rows, grid_cols, fence)
+    if not rows_to_del:
+        log_container.write("🧮 Không có dòng cũ cần xóa -> chỉ ghi thêm")
+    elif plan["strategy"] == "rewrite":
+        log_container.write(f"🧮 Ghi lại toàn bộ (giữ {plan['kept']} dòng) ≈ {plan['cost_rewrite']:.1f}s < xóa {plan['ranges']} vùng ≈ {plan['cost_delete']:.1f}s")
+    else:
+        log_container.write(f"🧮 Xóa {len(rows_to_del)} dòng cũ ({plan['ranges']} vùng) ≈ {plan['cost_delete']:.1f}s ≤ ghi lại toàn bộ ≈ {plan['cost_rewrite']:.1f}s")
+    if plan["strategy"] == "rewrite": delete_rows, kept = list(range(2, len(values) + 1)), plan["kept"]
+    else: delete_rows, kept = rows_to_del, 0
+
+    counts, stream_failed = {}, {}
+    try:
+        if plan["strategy"] == "rewrite":
+            del_set = set(rows_to_del)
+            raw = safe_api_call(sh.values_get, quote_sheet_title(wks.title), params=KEEP_VALUE_PARAMS).get("values", [])
+            writer.add(kept_row_values(raw[i - 1] if i <= len(raw) else []) for i in range(2, len(values) + 1) if i not in del_set)
+        for vals in iter_aligned_slices(opened, headers, APPEND_SLICE_ROWS, counts, stream_failed):
+            writer.add(vals)
+        writer.commit(headers if headers != old_headers else None, delete_rows)
+    except Exception:
+        if writer.committed is None:
+            log_container.error("⚠️ Không rõ commit đã áp dụng chưa - không rollback, cần kiểm tra lại sheet đích")
+            raise
+        try: writer.rollback()
+        except Exception as e: log_container.error(f"⚠️ Rollback staging lỗi: {str(e)[:120]}")
+        raise
+
+    report_write_results(opened, counts, stream_failed, len(values) - len(delete_rows) + kept + 1, result_map, log_container)
+    return True, f"Cập nhật {sum(counts.values())} dòng ({writer.requests} request)", result_map
@@ -0,0 +1,299 @@
+"""Lớp gọi Google Sheets API dùng chung cho app.py và auto_job.py.
+
+- safe_api_call: retry có phân loại lỗi (quota / tạm thời / vĩnh viễn), backoff + jitter, circuit breaker theo spreadsheet.
+- Quota: token bucket read/write trong SQLite (QUOTA_DB_PATH) nên app Streamlit và auto_job.py chạy cùng máy chia sẻ
+  chung quota; mọi request tới Sheets API đi qua QuotaHTTPClient.
+- Pool kết nối: client gspread + handle Spreadsheet/Worksheet theo sheet id, hết hạn sau SH_POOL_TTL.
+Trạng thái (pool, bucket dự phòng) là biến module: sống suốt process, dùng chung giữa các phiên Streamlit.
+Riêng circuit breaker thuộc về từng lượt chạy (contextvar, xem reset_circuit_breaker / bind_run_context).
+"""
+import os
+import time
+import random
+import sqlite3
+import contextvars
+import tempfile
+import threading
+import email.utils
+
+import gspread
+import requests
+import urllib3
+
+# Pool kết nối: thời gian sống (giây) của client/handle Spreadsheet
+SH_POOL_TTL = 600
+
+# Retry & circuit breaker cho API
+API_MAX_RETRIES = 5
+API_BACKOFF_BASE = 1.0         # giây, lỗi tạm thời (5xx, mạng)
+API_QUOTA_BACKOFF_BASE = 5.0   # giây, lỗi quota (429)
+API_BACKOFF_MAX = 64.0
+CIRCUIT_FAIL_THRESHOLD = 2     # số lỗi quyền/404 trước khi ngừng gọi 1 spreadsheet
+
+# Quota Sheets API (request / phút / user) - dùng chung giữa các process qua file SQLite
+QUOTA_READ_PER_MIN = int(os.environ.get("QUOTA_READ_PER_MIN", "60"))
+QUOTA_WRITE_PER_MIN = int(os.environ.get("QUOTA_WRITE_PER_MIN", "60"))
+QUOTA_DB_PATH = os.environ.get("QUOTA_DB_PATH") or os.path.join(tempfile.gettempdir(), "kinkin_sheets_quota.sqlite")
+
+# ==========================================
+# RETRY + CIRCUIT BREAKER
+# ==========================================
+class CircuitOpenError(Exception):
+    """Spreadsheet đã lỗi vĩnh viễn (mất quyền/404) nhiều lần trong lượt chạy này -> không gọi nữa"""
+
+# Circuit breaker của lượt chạy hiện tại ({"lock", "fails"}); None = ngoài lượt chạy -> không ngắt.
+# Theo context (luồng phiên Streamlit / lượt auto_job) nên 1 phiên reset không xóa trạng thái của phiên khác
+_CIRCUIT_RUN = contextvars.ContextVar("circuit_run", default=None)
+
+def reset_circuit_breaker():
+    """Bắt đầu lượt chạy mới: circuit breaker mới cho context hiện tại"""
+    _CIRCUIT_RUN.set({"lock": threading.Lock(), "fails": {}})
+
+def bind_run_context(fn):
+    """Bọc fn chạy trong ThreadPoolExecutor: luồng pool không kế thừa contextvars nên chụp context lúc bọc,
+    mọi worker dùng chung circuit breaker của lượt chạy"""
+    ctx = contextvars.copy_context()
+    def run(*args, **kwargs): return ctx.copy().run(fn, *args, **kwargs)
+    return run
+
+# Lỗi mạng/timeout ở tầng HTTP (gspread đi qua requests/urllib3) -> gửi lại được
+TRANSIENT_NETWORK_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                            urllib3.exceptions.ProtocolError, urllib3.exceptions.TimeoutError)
+
+def classify_api_error(e):
+    """Phân loại lỗi: 'quota' (429/rate limit), 'retryable' (5xx, ConnectionError/Timeout của requests/urllib3),
+    'permanent' (403/404/400, lỗi logic và mọi lỗi khác)"""
+    if isinstance(e, CircuitOpenError): return "permanent"
+    err = e
+    while getattr(err, "response", None) is None and err.__cause__ is not None: err = err.__cause__
+    code = getattr(getattr(err, "response", None), "status_code", None)
+    text = str(err).lower()
+    if code == 429 or "ratelimitexceeded" in text or "resource_exhausted" in text: return "quota"
+    if code is not None:
+        if code == 403 and "quota" in text: return "quota"
+        if code in (408, 500, 502, 503, 504): return "retryable"
+        if 400 <= code < 500: return "permanent"
+        return "retryable"
+    if isinstance(e, (gspread.WorksheetNotFound, gspread.SpreadsheetNotFound, PermissionError)): return "permanent"
+    if isinstance(e, TRANSIENT_NETWORK_ERRORS) or isinstance(err, TRANSIENT_NETWORK_ERRORS): return "retryable"
+    if "429" in text or "quota" in text: return "quota"
+    return "permanent"
+
+def is_access_error(e):
+    """Lỗi do spreadsheet (mất quyền / không tồn tại) -> tính vào circuit breaker"""
+    if isinstance(e, (gspread.SpreadsheetNotFound, PermissionError)): return True
+    err = e
+    while getattr(err, "response", None) is None and err.__cause__ is not None: err = err.__cause__
+    return getattr(getattr(err, "response", None), "status_code", None) in (403, 404)
+
+def is_payload_too_large(e):
+    """Request bị từ chối vì body quá lớn (413, hoặc 400 báo vượt giới hạn kích thước)"""
+    err = e
+    while getattr(err, "response", None) is None and err.__cause__ is not None: err = err.__cause__
+    code = getattr(getattr(err, "response", None), "status_code", None)
+    text = str(e).lower()
+    return code == 413 or (code in (400, None) and any(k in text for k in ("too large", "payload size", "request entity", "exceeds the maximum")))
+
+def get_retry_after(e):
+    """Giá trị header Retry-After (giây) nếu server gửi về"""
+    err = e
+    while getattr(err, "response", None) is None and err.__cause__ is not None: err = err.__cause__
+    val = getattr(getattr(err, "response", None), "headers", {}).get("Retry-After")
+    if not val: return None
+    try: return max(0.0, float(val))
+    except ValueError: pass
+    try: return max(0.0, email.utils.parsedate_to_datetime(val).timestamp() - time.time())
+    except Exception: return None
+
+def backoff_delay(attempt, kind, e=None):
+    """Exponential backoff + full jitter, tôn trọng Retry-After"""
+    base = API_QUOTA_BACKOFF_BASE if kind == "quota" else API_BACKOFF_BASE
+    delay = random.uniform(base, min(API_BACKOFF_MAX, base * (2 ** attempt)))
+    retry_after = get_retry_after(e) if e is not None else None
+    return max(delay, retry_after) if retry_after is not None else delay
+
+def _api_target_id(func, args):
+    """Spreadsheet id mà func (bound method của Client/Spreadsheet/Worksheet) đang gọi tới"""
+    owner = getattr(func, "__self__", None)
+    if owner is None: return None
+    if getattr(owner, "spreadsheet_id", None): return owner.spreadsheet_id
+    if isinstance(owner, gspread.Spreadsheet): return owner.id
+    if isinstance(owner, gspread.Client) and args: return str(args[0])
+    return None
+
+def safe_api_call(func, *args, **kwargs):
+    """Bọc API Call: retry có phân loại lỗi + circuit breaker theo spreadsheet"""
+    return _call_api(func, args, kwargs, ("quota", "retryable"))
+
+def api_call_once(func, *args, **kwargs):
+    """Như safe_api_call nhưng chỉ retry lỗi quota (429: request bị từ chối, chắc chắn chưa áp dụng).
+    Dùng cho request không idempotent (thêm/xóa dòng): lỗi tạm thời (5xx, timeout, mạng) có thể đã áp dụng ở server
+    -> ném ra để caller kiểm tra lại trạng thái thay vì gửi lại mù"""
+    return _call_api(func, args, kwargs, ("quota",))
+
+def _call_api(func, args, kwargs, retry_kinds):
+    circuit = _CIRCUIT_RUN.get()
+    sheet_key = _api_target_id(func, args)
+    if sheet_key and circuit is not None:
+        with circuit["lock"]:
+            if circuit["fails"].get(sheet_key, 0) >= CIRCUIT_FAIL_THRESHOLD:
+                raise CircuitOpenError(f"Bỏ qua {sheet_key}: lỗi quyền/404 lặp lại trong lượt chạy này")
+    for i in range(API_MAX_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            kind = classify_api_error(e)
+            if kind == "permanent":
+                if sheet_key and is_access_error(e):
+                    if circuit is not None:
+                        with circuit["lock"]: circuit["fails"][sheet_key] = circuit["fails"].get(sheet_key, 0) + 1
+                    invalidate_sh_pool(sheet_key)
+                raise
+            if kind not in retry_kinds or i == API_MAX_RETRIES - 1: raise
+            wait_time = backoff_delay(i, kind, e)
+            print(f"⚠️ {'Quota exceeded' if kind == 'quota' else 'Lỗi tạm thời'}: {str(e)[:80]}. Waiting {wait_time:.1f}s...")
+            time.sleep(wait_time)
+
+# ==========================================
+# QUOTA LIMITER (TOKEN BUCKET DÙNG CHUNG QUA SQLITE)
+# ==========================================
+def quota_bucket_params(kind):
+    """(burst, token/giây) sao cho burst + 60s * rate <= quota/phút -> không cửa sổ 60s nào vượt quota"""
+    per_min = QUOTA_READ_PER_MIN if kind == "read" else QUOTA_WRITE_PER_MIN
+    burst = max(1, per_min // 10)
+    return float(burst), max(per_min - burst, 1) / 60.0
+
+def _quota_reserve(tokens, ts, now, cap, rate, cost):
+    # Cho phép token âm (đặt chỗ trước): mỗi caller biết chính xác phải chờ bao lâu, không tranh nhau
+    tokens = min(cap, tokens + max(0.0, now - ts) * rate) - cost
+    return tokens, max(0.0, -tokens / rate)
+
+_QUOTA_MEM = {"lock": threading.Lock(), "buckets": {}}
+_QUOTA_WAIT = threading.local()  # tổng giây đã ngủ chờ quota trong luồng (AppendBatcher trừ ra khi đo độ trễ)
+
+def quota_acquire(kind, cost=1):
+    """Lấy `cost` token từ bucket read/write rồi ngủ đúng thời gian cần thiết.
+    Bucket nằm trong SQLite nên auto_job.py và app Streamlit chạy cùng máy chia sẻ chung quota;
+    nếu không mở được file thì dùng bucket trong process."""
+    cap, rate = quota_bucket_params(kind)
+    now = time.time()
+    try:
+        con = sqlite3.connect(QUOTA_DB_PATH, timeout=30, isolation_level=None)
+        try:
+            con.execute("CREATE TABLE IF NOT EXISTS quota_bucket (name TEXT PRIMARY KEY, tokens REAL, ts REAL)")
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute("SELECT tokens, ts FROM quota_bucket WHERE name = ?", (kind,)).fetchone()
+            tokens, wait = _quota_reserve(row[0] if row else cap, row[1] if row else now, now, cap, rate, cost)
+            con.execute("INSERT OR REPLACE INTO quota_bucket (name, tokens, ts) VALUES (?, ?, ?)", (kind, tokens, now))
+            con.execute("COMMIT")
+        finally: con.close()
+    except sqlite3.Error:
+        with _QUOTA_MEM["lock"]:
+            tokens, ts = _QUOTA_MEM["buckets"].get(kind, (cap, now))
+            tokens, wait = _quota_reserve(tokens, ts, now, cap, rate, cost)
+            _QUOTA_MEM["buckets"][kind] = (tokens, now)
+    if wait > 0:
+        _QUOTA_WAIT.seconds = getattr(_QUOTA_WAIT, "seconds", 0.0) + wait
+        time.sleep(wait)
+
+class QuotaHTTPClient(gspread.HTTPClient):
+    """HTTPClient của gspread: mọi request tới Sheets API (kể cả từ gspread_dataframe) đều qua quota_acquire"""
+    def request(self, method, endpoint, *args, **kwargs):
+        if "sheets.googleapis.com" in str(endpoint):
+            is_read = str(method).lower() == "get" or str(endpoint).endswith(":batchGetByDataFilter")
+            quota_acquire("read" if is_read else "write")
+        return super().request(method, endpoint, *args, **kwargs)
+
+# ==========================================
+# POOL KẾT NỐI (DÙNG CHUNG TRONG PROCESS)
+# ==========================================
+_SHEET_POOL = {"lock": threading.RLock(), "clients": {}, "sheets": {}}
+
+def get_gspread_client(creds):
+    key = getattr(creds, "service_account_email", None) or id(creds)
+    with _SHEET_POOL["lock"]:
+        ent = _SHEET_POOL["clients"].get(key)
+        if ent and time.time() - ent[1] < SH_POOL_TTL: return ent[0]
+        client = gspread.authorize(creds, http_client=QuotaHTTPClient)
+        _SHEET_POOL["clients"][key] = (client, time.time())
+        return client
+
+def get_sh_with_retry(creds, sheet_id, fresh=False):
+    if not fresh:
+        with _SHEET_POOL["lock"]:
+            ent = _SHEET_POOL["sheets"].get(sheet_id)
+            if ent and time.time() - ent["ts"] < SH_POOL_TTL: return ent["sh"]
+    masked_id = sheet_id[:5] + "..." + sheet_id[-5:] if sheet_id and len(sheet_id) > 10 else "N/A"
+    print(f"🔗 Connecting to Sheet ID: {masked_id}")
+    sh = safe_api_call(get_gspread_client(creds).open_by_key, sheet_id)
+    if sh is not None:
+        with _SHEET_POOL["lock"]: _SHEET_POOL["sheets"][sheet_id] = {"sh": sh, "ts": time.time(), "wks": None}
+    return sh
+
+def invalidate_sh_pool(sheet_id=None):
+    with _SHEET_POOL["lock"]:
+        if sheet_id is None: _SHEET_POOL["sheets"].clear()
+        else: _SHEET_POOL["sheets"].pop(sheet_id, None)
+
+def get_wks_map(sh, refresh=False):
+    """Danh sách worksheet {title: Worksheet} của file, chỉ đọc metadata 1 lần / TTL"""
+    if not refresh:
+        with _SHEET_POOL["lock"]:
+            ent = _SHEET_POOL["sheets"].get(sh.id)
+            if ent and ent["sh"] is sh and ent["wks"] is not None: return ent["wks"]
+    wks_map = {w.title: w for w in safe_api_call(sh.worksheets)}
+    with _SHEET_POOL["lock"]:
+        ent = _SHEET_POOL["sheets"].get(sh.id)
+        if ent and ent["sh"] is sh: ent["wks"] = wks_map
+    return wks_map
+
+def get_wks_with_retry(sh, title=None):
+    """Thay cho sh.worksheet()/sh.sheet1: lấy từ pool, làm mới 1 lần nếu chưa thấy"""
+    wks_map = get_wks_map(sh)
+    if title is None: return next(iter(wks_map.values()))
+    if title not in wks_map: wks_map = get_wks_map(sh, refresh=True)
+    if title not in wks_map: raise gspread.WorksheetNotFound(title)
+    return wks_map[title]
+
+def add_wks_pooled(sh, title, rows, cols):
+    wks = sh.add_worksheet(title=title, rows=rows, cols=cols)
+    get_wks_map(sh)[title] = wks
+    return wks
+
+def quote_sheet_title(title):
+    return "'" + str(title).replace("'", "''") + "'"
+
+def get_grid_size(sh, wks):
+    """(số dòng, số cột) hiện tại của lưới worksheet - đọc mới, không dùng metadata trong pool"""
+    meta = safe_api_call(sh.fetch_sheet_metadata, {"fields": "sheets.properties(sheetId,gridProperties(rowCount,columnCount))"})
+    for s in meta.get("sheets", []):
+        p = s.get("properties", {})
+        if p.get("sheetId") == wks.id:
+            g = p.get("gridProperties", {})
+            return g.get("rowCount", 0), g.get("columnCount", 0)
+    return wks.row_count, wks.col_count
+
+# ==========================================
+# THÊM/XÓA DÒNG: GỬI 1 LẦN, KIỂM TRA LẠI THAY VÌ RETRY
+# ==========================================
+class GridChangeUnknownError(Exception):
+    """batchUpdate thêm/xóa dòng lỗi tạm thời và không xác định được đã áp dụng hay chưa -> không được gửi lại / hoàn tác"""
+
+def send_grid_change(sh, wks, requests, before, after):
+    """1 batchUpdate đổi kích thước lưới của wks từ before thành after ((số dòng, số cột), phải khác nhau).
+    Thêm/xóa dòng không idempotent: gửi lại sau khi mất response sẽ xóa nhầm dòng khác. Vì vậy lỗi tạm thời thì đọc lại
+    kích thước lưới: = after là đã áp dụng, = before là chưa (batchUpdate nguyên tử) -> gửi lại sau backoff,
+    khác -> GridChangeUnknownError. Lỗi quota / lỗi vĩnh viễn: request bị từ chối, chưa áp dụng -> ném ra như cũ"""
+    for i in range(API_MAX_RETRIES):
+        try: return api_call_once(sh.batch_update, {"requests": requests})
+        except Exception as e:
+            if classify_api_error(e) != "retryable": raise
+            try: grid = get_grid_size(sh, wks)
+            except Exception: grid = None
+            if grid == tuple(after): return None
+            if grid != tuple(before):
+                raise GridChangeUnknownError(f"Không rõ batchUpdate đã áp dụng chưa (lưới {grid}, trước {tuple(before)}, sau {tuple(after)}): {str(e)[:120]}") from e
+            if i == API_MAX_RETRIES - 1: raise
+            wait_time = backoff_delay(i, "retryable", e)
+            print(f"⚠️ Lỗi tạm thời, batchUpdate chưa áp dụng: {str(e)[:80]}. Waiting {wait_time:.1f}s...")
+            time.sleep(wait_time)
@@ -0,0 +1,165 @@
+"""Bộ lọc Dieu_Kien_Loc dùng chung cho app.py và auto_job.py.
+
+Cú pháp: nhiều điều kiện nối bằng dấu chấm phẩy (;), tất cả phải đúng (AND).
+    Cột > 100; Trạng thái contains 'giao'; Ngày >= 01/10/2026
+Toán tử: contains, ==, !=, >=, <=, >, <, =
+
+Chuỗi lọc được biên dịch 1 lần thành danh sách điều kiện (cache theo chuỗi), sau đó
+gộp thành 1 mask boolean duy nhất rồi lọc 1 lần - không copy DataFrame theo từng điều kiện.
+So sánh lớn/bé có kiểu: giá trị là số -> so sánh số, là ngày -> so sánh ngày, còn lại -> so sánh chuỗi.
+"""
+import re
+import functools
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+OPERATORS = [" contains ", "==", "!=", ">=", "<=", ">", "<", "="]
+DATE_FORMATS = ["%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%m/%Y"]
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+EMPTY_FILTER_VALUES = ['nan', 'none', 'null', '']
+
+# kind: "contains" | "eq" | "ne" | "number" | "date" | "text" (so sánh lớn/bé theo chuỗi)
+FilterCond = namedtuple("FilterCond", ["source", "column", "op", "kind", "value"])
+
+class FilterError(ValueError):
+    pass
+
+def parse_date(val):
+    for fmt in DATE_FORMATS:
+        try: return datetime.strptime(val, fmt)
+        except ValueError: pass
+    return None
+
+@functools.lru_cache(maxsize=512)
+def compile_filter(filter_str):
+    """Chuỗi lọc -> tuple FilterCond (cache theo chuỗi). Lỗi cú pháp -> FilterError."""
+    if not filter_str or str(filter_str).strip().lower() in EMPTY_FILTER_VALUES: return ()
+    conds = []
+    for cond in str(filter_str).split(';'):
+        fs = cond.strip()
+        if not fs: continue
+        selected_op = next((op for op in OPERATORS if op in fs), None)
+        if not selected_op: raise FilterError(f"Lỗi cú pháp: Không tìm thấy toán tử trong '{fs}'")
+
+        parts = fs.split(selected_op, 1)
+        user_col = parts[0].strip().replace("`", "").replace("'", "").replace('"', "")
+        user_val = parts[1].strip()
+        if (user_val.startswith("'") and user_val.endswith("'")) or (user_val.startswith('"') and user_val.endswith('"')):
+            clean_val = user_val[1:-1]
+        else:
+            clean_val = user_val
+
+        if selected_op == " contains ":
+            try: rx = re.compile(clean_val, re.IGNORECASE)
+            except re.error as e: raise FilterError(f"Lỗi xử lý điều kiện '{fs}': {str(e)}")
+            conds.append(FilterCond(fs, user_col, "contains", "contains", rx))
+        elif selected_op in ["=", "=="]:
+            conds.append(FilterCond(fs, user_col, "==", "eq", clean_val))
+        elif selected_op == "!=":
+            conds.append(FilterCond(fs, user_col, "!=", "ne", clean_val))
+        else:
+            try: conds.append(FilterCond(fs, user_col, selected_op, "number", float(clean_val))); continue
+            except ValueError: pass
+            date_val = parse_date(clean_val)
+            if date_val is not None: conds.append(FilterCond(fs, user_col, selected_op, "date", pd.Timestamp(date_val)))
+            else: conds.append(FilterCond(fs, user_col, selected_op, "text", clean_val))
+    return tuple(conds)
+
+def resolve_column(columns, user_col):
+    if user_col in columns: return user_col
+    for col in columns:
+        if str(col).strip() == user_col: return col
+    raise FilterError(f"Không tìm thấy cột '{user_col}'")
+
+def to_number(s):
+    return pd.to_numeric(s, errors='coerce')
+
+def to_date(s):
+    s = s.astype(str).str.strip()
+    out = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+    for fmt in DATE_FORMATS:
+        todo = out.isna()
+        if not todo.any(): break
+        out[todo] = pd.to_datetime(s[todo], format=fmt, errors='coerce')
+    return out
+
+def compare(left, op, right):
+    if op == ">": return left > right
+    if op == "<": return left < right
+    if op == ">=": return left >= right
+    return left <= right
+
+def build_mask(df, conds):
+    """Gộp mọi điều kiện thành 1 mask numpy; cột số/ngày chỉ parse 1 lần dù nhiều điều kiện dùng chung"""
+    mask = np.ones(len(df), dtype=bool)
+    typed_cache = {}
+    for c in conds:
+        col = resolve_column(df.columns, c.column)
+        try:
+            s = df[col]
+            if c.kind in ("number", "date"):
+                key = (col, c.kind)
+                if key not in typed_cache: typed_cache[key] = to_number(s) if c.kind == "number" else to_date(s)
+                m = compare(typed_cache[key], c.op, c.value)
+            else:
+                s_str = s if pd.api.types.is_string_dtype(s) else s.astype(str)
+                if c.kind == "contains":
+                    # Pattern có nhóm (...) thì str.contains cảnh báo -> search trực tiếp
+                    m = s_str.map(lambda v: bool(c.value.search(v))) if c.value.groups else s_str.str.contains(c.value, na=False)
+                elif c.kind == "eq": m = s_str == c.value
+                elif c.kind == "ne": m = s_str != c.value
+                else: m = compare(s_str, c.op, c.value)
+            mask &= np.asarray(m, dtype=bool)
+        except Exception as e: raise FilterError(f"Lỗi xử lý điều kiện '{c.source}': {str(e)}")
+    return mask
+
+def apply_smart_filter(df, filter_str):
+    """Lọc DataFrame pandas. Trả về (df, lỗi)"""
+    try:
+        conds = compile_filter(filter_str)
+        if not conds: return df, None
+        return df[build_mask(df, conds)], None
+    except FilterError as e: return None, str(e)
+
+def polars_typed(df, col, kind):
+    """Cột Polars -> số/ngày bằng đúng bộ parse của nhánh pandas (chạy trên giá trị duy nhất rồi ánh xạ lại)"""
+    uniq = df.get_column(col).unique().to_list()
+    conv = to_number(pd.Series(uniq, dtype=object)) if kind == "number" else to_date(pd.Series(uniq, dtype=object))
+    mapping = {u: (None if pd.isna(v) else (float(v) if kind == "number" else v.to_pydatetime())) for u, v in zip(uniq, conv)}
+    return pl.col(col).replace_strict(mapping, return_dtype=pl.Float64 if kind == "number" else pl.Datetime("us"))
+
+def polars_expr(df, c, typed_cache):
+    col = resolve_column(df.columns, c.column)
+    e = pl.col(col)
+    if c.kind == "contains":
+        if any(ch in REGEX_SPECIAL_CHARS for ch in c.value.pattern):
+            # Regex thật -> dùng đúng engine `re` như nhánh pandas
+            return e.map_elements(lambda v: bool(c.value.search(v)), return_dtype=pl.Boolean)
+        return e.str.contains("(?i)" + c.value.pattern)
+    if c.kind == "eq": return e == c.value
+    if c.kind == "ne": return e != c.value
+    if c.kind == "text": return compare(e, c.op, c.value)
+    key = (col, c.kind)
+    if key not in typed_cache: typed_cache[key] = polars_typed(df, col, c.kind)
+    return compare(typed_cache[key], c.op, c.value.to_pydatetime() if c.kind == "date" else c.value)
+
+def apply_smart_filter_polars(df, filter_str):
+    """Lọc DataFrame Polars, cùng ngữ nghĩa với apply_smart_filter. Trả về (df, lỗi)"""
+    try:
+        conds = compile_filter(filter_str)
+        if not conds or df.height == 0:
+            for c in conds: resolve_column(df.columns, c.column)
+            return df, None
+        typed_cache = {}
+        exprs = []
+        for c in conds:
+            try: exprs.append(polars_expr(df, c, typed_cache))
+            except FilterError: raise
+            except Exception as e: raise FilterError(f"Lỗi xử lý điều kiện '{c.source}': {str(e)}")
+        try: return df.filter(pl.all_horizontal(exprs)), None
+        except Exception as e: return None, f"Lỗi thực thi lọc: {str(e)}"
+    except FilterError as e: return None, str(e)